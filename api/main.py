@@ -1,73 +1,358 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
 from schemas import (
     InputText, Outline, OutputText, FullUserPromptInputTexts, FullUserPromptOutline,
-    FromFileRequest, FromFileWithOutlineRequest, CreateOutlineOnlyRequest, FromWebRequest
+    FromFileRequest, FromFileWithOutlineRequest, CreateOutlineOnlyRequest, FromOutlineRequest, FromWebRequest, OutputVariants
 )
 from writer_agent import WriterAgent
 from outline_agent import OutlineAgent
-from system_prompts import from_file_system_prompt, from_file_with_outline_system_prompt, outline_system_prompt
-from typing import List
+from system_prompts import build_from_file_system_prompt, build_from_file_with_outline_system_prompt, build_outline_system_prompt, from_web_system_prompt
+from streaming import get_paragraphs
+from pipeline import MapReducePipeline, ParallelSectionWriter, VariantWriter
+from outline_store import OutlineStore
+from jobs import JobStore, JobQueue, job_status, current_job_id
+from retry import RetryPolicy
+from dedup import Deduplicator
+from relevance import RelevanceIndex
+from tokenizer import TokenizerService
+from metrics import metrics
+from profiling import profile
+from typing import AsyncIterator, List, Optional, Union
+from pathlib import Path
+import asyncio, datetime, json
 
 # Fixed configuration for all agents
 MODEL_NAME = 'openai:gpt-4o-mini'
 MCP_SERVERS = None  # or provide a list of MCPServerConfig if you want to use MCP servers
+PROMPT_ENCODING = 'json'  # or 'compact' / 'markdown' to send fewer prompt tokens
+PROMPT_LAYOUT = 'combined'  # or 'prefix' to keep the input texts in a stable prefix the provider can cache
+JOBS_DB_PATH = Path(__file__).resolve().parent.parent / '.cache' / 'jobs.sqlite'
+OUTLINES_DB_PATH = Path(__file__).resolve().parent.parent / '.cache' / 'outlines.sqlite'
+PROFILES_DIR = Path(__file__).resolve().parent.parent / 'outputs' / 'profiles'
+NUM_WORKERS = 4
+RETRY_POLICY = RetryPolicy(max_retries=3, timeout=600)  # Shared by all agents
+AGENT_CONCURRENCY = {'writer_agent': 2, 'outline_agent': 2, 'writer_agent_with_outline': 2, 'web_agent': 1}
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    # Release shared MCP servers on shutdown
+    for agent in (writer_agent, outline_agent, writer_agent_with_outline, web_agent):
+        await agent.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Create agents on startup with fixed config
 writer_agent = WriterAgent(
     server_configs=MCP_SERVERS,
     model_name=MODEL_NAME,
-    system_prompt=from_file_system_prompt
+    system_prompt=build_from_file_system_prompt(PROMPT_ENCODING, PROMPT_LAYOUT),
+    prompt_encoding=PROMPT_ENCODING,
+    prompt_layout=PROMPT_LAYOUT,
+    retry_policy=RETRY_POLICY
 )
 outline_agent = OutlineAgent(
     server_configs=MCP_SERVERS,
     model_name=MODEL_NAME,
-    system_prompt=outline_system_prompt
+    system_prompt=build_outline_system_prompt(PROMPT_ENCODING, PROMPT_LAYOUT),
+    prompt_encoding=PROMPT_ENCODING,
+    prompt_layout=PROMPT_LAYOUT,
+    retry_policy=RETRY_POLICY
 )
 writer_agent_with_outline = WriterAgent(
     server_configs=MCP_SERVERS,
     model_name=MODEL_NAME,
-    system_prompt=from_file_with_outline_system_prompt
+    system_prompt=build_from_file_with_outline_system_prompt(PROMPT_ENCODING, PROMPT_LAYOUT),
+    prompt_encoding=PROMPT_ENCODING,
+    prompt_layout=PROMPT_LAYOUT,
+    retry_policy=RETRY_POLICY
+)
+web_agent = WriterAgent(
+    server_configs=MCP_SERVERS,
+    model_name=MODEL_NAME,
+    system_prompt=from_web_system_prompt,
+    retry_policy=RETRY_POLICY
 )
+# Outlines of outline jobs, stored under the job id so they can be reused with /from-outline
+outline_store = OutlineStore(str(OUTLINES_DB_PATH))
 
 @app.get('/')
 def read_root():
     return {'message': 'Summarizer Agent API'}
 
-@app.post('/from-file')
-def from_file(request: FromFileRequest):
-    # Placeholder: use writer_agent
-    return {
-        'message': 'from-file endpoint called',
-        'input_texts': [x.model_dump() for x in request.input_texts],
-        'user_prompt': request.user_prompt
-    }
-
-@app.post('/from-file-with-outline')
-def from_file_with_outline(request: FromFileWithOutlineRequest):
-    # Placeholder: use outline_agent and writer_agent_with_outline
-    return {
-        'message': 'from-file-with-outline endpoint called',
-        'input_texts': [x.model_dump() for x in request.input_texts],
-        'outline_prompt': request.outline_prompt,
-        'content_prompt': request.content_prompt
-    }
-
-@app.post('/create-outline-only')
-def create_outline_only(request: CreateOutlineOnlyRequest):
-    # Placeholder: use outline_agent
-    return {
-        'message': 'create-outline-only endpoint called',
-        'input_texts': [x.model_dump() for x in request.input_texts],
-        'user_prompt': request.user_prompt
-    }
-
-@app.post('/from-web')
-def from_web(request: FromWebRequest):
-    # Placeholder for future web agent
-    return {
-        'message': 'from-web endpoint called',
-        'search_terms': request.search_terms,
-        'user_prompt': request.user_prompt
-    }
\ No newline at end of file
+@app.get('/metrics')
+def get_metrics():
+    '''
+    Stage latencies, token usage, cache hits and retries of this process in the Prometheus text format.
+    '''
+    return PlainTextResponse(metrics.render_prometheus(), media_type='text/plain; version=0.0.4')
+
+async def prepare_input_texts(request: Union[FromFileRequest, FromFileWithOutlineRequest, CreateOutlineOnlyRequest]) -> List[InputText]:
+    '''
+    Counts the words and tokens of the input texts of a request and applies its optional preprocessing steps.
+    CPU-bound steps run in a thread.
+    '''
+    input_texts = request.input_texts
+    await asyncio.to_thread(TokenizerService(MODEL_NAME).fill_counts, input_texts)
+    if request.dedup_threshold is not None:
+        input_texts, _ = await asyncio.to_thread(Deduplicator(threshold=request.dedup_threshold).deduplicate, input_texts)
+    if request.max_input_tokens is not None:
+        # Both prompts of the outline workflow decide what is relevant
+        prompt = request.user_prompt if hasattr(request, 'user_prompt') else f'{request.outline_prompt}\n{request.content_prompt}'
+        input_texts, _ = await asyncio.to_thread(lambda: RelevanceIndex(input_texts, TokenizerService(MODEL_NAME)).trim(prompt, request.max_input_tokens))
+    return input_texts
+
+# Profiling | ?profile=true or the header X-Profile: true profiles a request, see profiling.py. One at a time
+
+def profiling_requested(http_request: Request) -> bool:
+    return 'true' in (http_request.query_params.get('profile', '').lower(), http_request.headers.get('X-Profile', '').lower())
+
+def profiled(handler):
+    '''
+    Profiles a job handler if its job was submitted with profiling. The reports are written to outputs/profiles/<job id>.
+    If another session is active when the job runs, the job runs without profiling and its profiling is skipped.
+    '''
+    async def run(request):
+        job_id = current_job_id.get()
+        if job_queue.store.get(job_id)['profile'] != 'requested':
+            return await handler(request)
+        with profile(str(PROFILES_DIR / job_id)) as session:
+            job_queue.store.set_profile(job_id, 'profiled' if session is not None else 'skipped')
+            return await handler(request)
+    return run
+
+# Jobs | The agents run in a bounded worker pool, the endpoints only submit jobs and return their id
+
+async def run_from_file(request: FromFileRequest) -> OutputText:
+    input_texts = await prepare_input_texts(request)
+    full_user_prompt = writer_agent._construct_user_prompt_from_input_texts(input_texts, request.user_prompt)
+    async with job_queue.limit('writer_agent'):
+        result = await writer_agent.run(full_user_prompt)
+    return result.output
+
+def store_outline(outline: Outline, user_prompt: str, input_texts: List[InputText]):
+    outline_store.save(outline, user_prompt, [x.metadata.source for x in input_texts], outline_id=current_job_id.get())
+
+async def create_outline(input_texts: List[InputText], user_prompt: str, max_chunk_tokens: Optional[int]) -> Outline:
+    if max_chunk_tokens:
+        # Every chunk run takes its own slot of the agent limit, so one job can't exceed it
+        pipeline = MapReducePipeline(outline_agent, max_chunk_tokens=max_chunk_tokens, semaphore=job_queue.semaphore('outline_agent'))
+        return await pipeline.create_outline(input_texts, user_prompt)
+    async with job_queue.limit('outline_agent'):
+        return (await outline_agent.run(outline_agent._construct_user_prompt(input_texts, user_prompt))).output
+
+async def run_from_file_with_outline(request: FromFileWithOutlineRequest) -> OutputText:
+    input_texts = await prepare_input_texts(request)
+    outline = await create_outline(input_texts, request.outline_prompt, request.max_chunk_tokens)
+    store_outline(outline, request.outline_prompt, input_texts)
+    if request.parallel_sections:
+        # Every section run takes its own slot of the agent limit
+        section_writer = ParallelSectionWriter(
+            writer_agent_with_outline,
+            paragraphs_per_section=request.paragraphs_per_section,
+            semaphore=job_queue.semaphore('writer_agent_with_outline')
+        )
+        return await section_writer.write(outline, request.content_prompt)
+    async with job_queue.limit('writer_agent_with_outline'):
+        full_user_prompt = writer_agent_with_outline._construct_user_prompt_from_outline(outline, request.content_prompt)
+        return (await writer_agent_with_outline.run(full_user_prompt)).output
+
+async def run_create_outline_only(request: CreateOutlineOnlyRequest) -> Outline:
+    input_texts = await prepare_input_texts(request)
+    outline = await create_outline(input_texts, request.user_prompt, request.max_chunk_tokens)
+    store_outline(outline, request.user_prompt, input_texts)
+    return outline
+
+async def run_from_outline(request: FromOutlineRequest) -> OutputVariants:
+    outline = request.outline or outline_store.get(request.outline_id)
+    if outline is None:
+        raise ValueError(f'No stored outline with the id {request.outline_id}')
+    # Variants with their own system prompt instructions get agents with the configuration of writer_agent_with_outline.
+    # They only live as long as the job, every variant run takes its own slot of the agent limit
+    variant_writer = VariantWriter(writer_agent_with_outline, semaphore=job_queue.semaphore('writer_agent_with_outline'))
+    try:
+        return await variant_writer.write(outline, request.variants)
+    finally:
+        await variant_writer.close()
+
+async def run_from_web(request: FromWebRequest) -> OutputText:
+    if not MCP_SERVERS:
+        raise ValueError('A connection to the Firecrawl MCP server is required for from-web')
+    async with job_queue.limit('web_agent'):
+        result = await web_agent.run(f'Search the web for: {request.search_terms}\n\n{request.user_prompt}')
+    return result.output
+
+
+job_queue = JobQueue(JobStore(str(JOBS_DB_PATH)), num_workers=NUM_WORKERS, agent_limits=AGENT_CONCURRENCY)
+job_queue.register('from-file', FromFileRequest, profiled(run_from_file))
+job_queue.register('from-file-with-outline', FromFileWithOutlineRequest, profiled(run_from_file_with_outline))
+job_queue.register('create-outline-only', CreateOutlineOnlyRequest, profiled(run_create_outline_only))
+job_queue.register('from-outline', FromOutlineRequest, profiled(run_from_outline))
+job_queue.register('from-web', FromWebRequest, profiled(run_from_web))
+
+
+def submit_job(kind: str, request, http_request: Request) -> JSONResponse:
+    if not profiling_requested(http_request):
+        job_id = job_queue.submit(kind, request)
+        return JSONResponse(status_code=202, content={'job_id': job_id, 'status': 'queued'})
+    job_id = job_queue.submit(kind, request, profile=True)
+    return JSONResponse(status_code=202, content={'job_id': job_id, 'status': 'queued', 'profile_dir': str(PROFILES_DIR / job_id)})
+
+@app.post('/from-file', status_code=202)
+async def from_file(request: FromFileRequest, http_request: Request):
+    return submit_job('from-file', request, http_request)
+
+@app.post('/from-file-with-outline', status_code=202)
+async def from_file_with_outline(request: FromFileWithOutlineRequest, http_request: Request):
+    return submit_job('from-file-with-outline', request, http_request)
+
+@app.post('/create-outline-only', status_code=202)
+async def create_outline_only(request: CreateOutlineOnlyRequest, http_request: Request):
+    return submit_job('create-outline-only', request, http_request)
+
+@app.post('/from-outline', status_code=202)
+async def from_outline(request: FromOutlineRequest, http_request: Request):
+    if request.outline_id is not None and outline_store.get(request.outline_id) is None:
+        raise HTTPException(status_code=404, detail='Outline not found')
+    return submit_job('from-outline', request, http_request)
+
+@app.post('/from-web', status_code=202)
+async def from_web(request: FromWebRequest, http_request: Request):
+    return submit_job('from-web', request, http_request)
+
+@app.get('/jobs/{job_id}')
+async def get_job(job_id: str):
+    job = job_queue.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail='Job not found')
+    return job_status(job)
+
+@app.get('/outlines')
+async def list_outlines(limit: int = 10):
+    '''
+    The id, prompt, number of paragraphs and creation time of the latest stored outlines, newest first.
+    '''
+    return outline_store.recent(min(max(limit, 1), 100))
+
+@app.get('/outlines/{outline_id}')
+async def get_outline(outline_id: str):
+    outline = outline_store.get(outline_id)
+    if outline is None:
+        raise HTTPException(status_code=404, detail='Outline not found')
+    return outline
+
+@app.get('/jobs/{job_id}/result')
+async def get_job_result(job_id: str):
+    job = job_queue.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail='Job not found')
+    if job['status'] != 'done':
+        raise HTTPException(status_code=409, detail=job_status(job))
+    return {**job_status(job), 'result': json.loads(job['result'])}
+
+
+# Streaming endpoints | Server-sent events: one event per completed paragraph, then one event with the complete output
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f'event: {event}\ndata: {json.dumps(data, default=str, ensure_ascii=False)}\n\n'
+
+
+async def paragraph_events(stream: AsyncIterator[Union[OutputText, Outline]], paragraph_event: str, output_event: str) -> AsyncIterator[str]:
+    '''
+    Turns a stream of partial outputs into server-sent events. Paragraphs are sent once, as soon as they are completed.
+    '''
+    sent = 0
+    output = None
+    async for output in stream:
+        paragraphs = get_paragraphs(output)
+        for index, paragraph in enumerate(paragraphs[sent:], start=sent):
+            yield sse_event(paragraph_event, {'index': index, **paragraph.model_dump()})
+        sent = max(sent, len(paragraphs))
+    if output is not None:
+        yield sse_event(output_event, output.model_dump(mode='json'))
+
+
+def profile_events(events: AsyncIterator[str], http_request: Request) -> AsyncIterator[str]:
+    '''
+    Profiles the stream until its last event if profiling is requested. The reports are written to
+    outputs/profiles/<time>_<endpoint>.
+    '''
+    if not profiling_requested(http_request):
+        return events
+    name = f'{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}_{http_request.url.path.strip("/").replace("/", "-")}'
+    async def profiled_events():
+        with profile(str(PROFILES_DIR / name)):
+            async for event in events:
+                yield event
+    return profiled_events()
+
+
+async def limited_stream(agent_name: str, stream: AsyncIterator) -> AsyncIterator:
+    '''
+    Holds a slot of the concurrency limit of the agent (see JobQueue.limit()) until the stream ends, so streams and
+    jobs share the limits.
+    '''
+    async with job_queue.limit(agent_name):
+        async for item in stream:
+            yield item
+
+
+@app.post('/from-file/stream')
+async def from_file_stream(request: FromFileRequest, http_request: Request):
+    full_user_prompt = writer_agent._construct_user_prompt_from_input_texts(await prepare_input_texts(request), request.user_prompt)
+    return StreamingResponse(
+        profile_events(paragraph_events(limited_stream('writer_agent', writer_agent.run_stream(full_user_prompt)), 'paragraph', 'output'), http_request),
+        media_type='text/event-stream',
+        headers=SSE_HEADERS
+    )
+
+async def stream_outline(request: Union[FromFileWithOutlineRequest, CreateOutlineOnlyRequest], user_prompt: str, max_chunk_tokens: Optional[int]) -> AsyncIterator[Outline]:
+    '''
+    Streams the outline, or creates it with the map-reduce pipeline if a chunk budget is given.
+    '''
+    input_texts = await prepare_input_texts(request)
+    if max_chunk_tokens:
+        yield await create_outline(input_texts, user_prompt, max_chunk_tokens)
+    else:
+        async for outline in limited_stream('outline_agent', outline_agent.run_stream(outline_agent._construct_user_prompt(input_texts, user_prompt))):
+            yield outline
+
+@app.post('/from-file-with-outline/stream')
+async def from_file_with_outline_stream(request: FromFileWithOutlineRequest, http_request: Request):
+    async def events():
+        outline = None
+        async def outline_stream():
+            nonlocal outline
+            async for outline in stream_outline(request, request.outline_prompt, request.max_chunk_tokens):
+                yield outline
+        async for event in paragraph_events(outline_stream(), 'outline_paragraph', 'outline'):
+            yield event
+        if request.parallel_sections:
+            section_writer = ParallelSectionWriter(
+                writer_agent_with_outline,
+                paragraphs_per_section=request.paragraphs_per_section,
+                semaphore=job_queue.semaphore('writer_agent_with_outline')
+            )
+            output_stream = section_writer.write_stream(outline, request.content_prompt)
+        else:
+            full_user_prompt = writer_agent_with_outline._construct_user_prompt_from_outline(outline, request.content_prompt)
+            output_stream = limited_stream('writer_agent_with_outline', writer_agent_with_outline.run_stream(full_user_prompt))
+        async for event in paragraph_events(output_stream, 'paragraph', 'output'):
+            yield event
+    return StreamingResponse(profile_events(events(), http_request), media_type='text/event-stream', headers=SSE_HEADERS)
+
+@app.post('/create-outline-only/stream')
+async def create_outline_only_stream(request: CreateOutlineOnlyRequest, http_request: Request):
+    return StreamingResponse(
+        profile_events(paragraph_events(stream_outline(request, request.user_prompt, request.max_chunk_tokens), 'paragraph', 'outline'), http_request),
+        media_type='text/event-stream',
+        headers=SSE_HEADERS
+    )
@@ -0,0 +1,135 @@
+from contextlib import AsyncExitStack
+from pydantic_ai import Agent
+from pydantic_ai.agent import AgentRunResult
+from typing import AsyncIterator, List, Optional, Union
+from schemas import MCPServerConfig, FullUserPromptInputTexts, FullUserPromptOutline, PromptEncoding, PromptLayout
+from mcp_sessions import MCPSessionManager
+from response_cache import ResponseCache, CachedRunResult
+from streaming import stream_completed_paragraphs
+from prompt_serializer import UserPromptSerializer
+from retry import RetryPolicy
+from metrics import metrics, record_usage, run_instrumented
+from dotenv import load_dotenv
+from pathlib import Path
+
+
+load_dotenv(dotenv_path=Path(__file__).parent / '.env')
+
+
+class BaseAgent():
+    '''
+    The runs shared by WriterAgent and OutlineAgent: prompt serialization, response cache, MCP sessions, retries,
+    streaming and metrics. Subclasses set the output type and build the user prompts.
+    '''
+    def __init__(
+        self,
+        server_configs: Optional[List[MCPServerConfig]],
+        model_name: str,
+        system_prompt: str,
+        output_type: type,
+        cache: Optional[ResponseCache] = None,
+        prompt_encoding: PromptEncoding = 'json',
+        retry_policy: Optional[RetryPolicy] = None,
+        prompt_layout: PromptLayout = 'combined'
+    ):
+        self.server_configs = server_configs
+        self.model_name = model_name
+        self.system_prompt = system_prompt
+        self.output_type = output_type
+        self.cache = cache
+        self.retry_policy = retry_policy
+        # The system prompt has to describe the same encoding and layout, see system_prompts.py
+        self.prompt_serializer = UserPromptSerializer(prompt_encoding, prompt_layout)
+        # MCP servers are shared with other agents through the process-wide registry and passed in per run
+        self.mcp_sessions = MCPSessionManager(server_configs) if server_configs else None
+        self.agent = Agent(
+            model_name,
+            system_prompt=system_prompt,
+            output_type=output_type
+        )
+
+
+    async def close(self):
+        '''
+        Releases the MCP servers used by this agent (async).
+        '''
+        if self.mcp_sessions is not None:
+            await self.mcp_sessions.close()
+
+
+    def get_system_prompt(self):
+        '''
+        Returns the current system prompt.
+        '''
+        return self.system_prompt
+
+
+    async def run(self, full_user_prompt: Union[FullUserPromptInputTexts, FullUserPromptOutline, str]) -> Union[AgentRunResult, CachedRunResult]:
+        '''
+        Runs the agent with a full user prompt (async).
+        If a cache is set, identical requests are answered from the cache. If a retry policy is set, failed runs are retried.
+        '''
+        name = type(self).__name__
+        with metrics.span('prompt', agent=name):
+            prompt = self.prompt_serializer.to_model_prompt(full_user_prompt)
+        if self.cache is not None:
+            cache_key = self.cache.make_key(self.model_name, self.system_prompt, self.output_type, prompt)
+            cached = self.cache.get(cache_key, self.output_type)
+            metrics.inc('response_cache', agent=name, result='miss' if cached is None else 'hit')
+            if cached is not None:
+                return cached
+        async def run_agent():
+            if self.mcp_sessions is None:
+                return await run_instrumented(self.agent, prompt, name)
+            async with AsyncExitStack() as stack:
+                # Waits for the MCP servers to be started the first time they are used
+                with metrics.span('mcp_session', agent=name):
+                    mcp_servers = await stack.enter_async_context(self.mcp_sessions.session())
+                return await run_instrumented(self.agent, prompt, name, toolsets=mcp_servers)
+        try:
+            with metrics.span('run', agent=name):
+                result = await self.retry_policy.run(run_agent) if self.retry_policy is not None else await run_agent()
+        except Exception:
+            metrics.inc('runs', agent=name, status='failed')
+            raise
+        metrics.inc('runs', agent=name, status='done')
+        record_usage(name, result.usage())
+        if self.cache is not None:
+            self.cache.set(cache_key, result.output, self.output_type, result.usage())
+        return result
+
+
+    async def run_stream(self, full_user_prompt: Union[FullUserPromptInputTexts, FullUserPromptOutline, str]) -> AsyncIterator:
+        '''
+        Runs the agent like run() but yields a partial output each time a paragraph has been completed (async).
+        The last item is the complete output. Streamed runs are not retried, since paragraphs may already have been yielded.
+        '''
+        name = type(self).__name__
+        with metrics.span('prompt', agent=name):
+            prompt = self.prompt_serializer.to_model_prompt(full_user_prompt)
+        if self.cache is not None:
+            cache_key = self.cache.make_key(self.model_name, self.system_prompt, self.output_type, prompt)
+            cached = self.cache.get(cache_key, self.output_type)
+            metrics.inc('response_cache', agent=name, result='miss' if cached is None else 'hit')
+            if cached is not None:
+                yield cached.output
+                return
+        output = None
+        # The stream stage includes the time the caller spends between the outputs
+        with metrics.span('stream', agent=name):
+            async with AsyncExitStack() as stack:
+                toolsets = None
+                if self.mcp_sessions is not None:
+                    with metrics.span('mcp_session', agent=name):
+                        toolsets = await stack.enter_async_context(self.mcp_sessions.session())
+                result = await stack.enter_async_context(self.agent.run_stream(prompt, toolsets=toolsets))
+                async for output in stream_completed_paragraphs(result, self.output_type):
+                    yield output
+        record_usage(name, result.usage())
+        if output is None:
+            # Nothing to cache and no complete output for the caller
+            metrics.inc('runs', agent=name, status='failed')
+            raise ValueError('The model streamed no output')
+        metrics.inc('runs', agent=name, status='done')
+        if self.cache is not None:
+            self.cache.set(cache_key, output, self.output_type, result.usage())
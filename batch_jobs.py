@@ -0,0 +1,245 @@
+import asyncio, json, os, time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+from pydantic import ValidationError
+from schemas import BatchJob, InputText, MCPServerConfig, Outline, OutputText, PromptEncoding, PromptLayout
+from writer_agent import WriterAgent
+from outline_agent import OutlineAgent
+from system_prompts import build_from_file_system_prompt, build_from_file_with_outline_system_prompt, build_outline_system_prompt
+from input_parser import InputParser
+from input_cache import ParsedInputCache
+from pipeline import MapReducePipeline, ParallelSectionWriter
+from response_cache import ResponseCache
+from retry import RetryPolicy
+from tokenizer import TokenizerService
+from dedup import Deduplicator
+from relevance import RelevanceIndex
+from prompt_serializer import output_to_markdown
+from outline_store import OutlineStore
+from batch_runs import JsonlSink, atomic_write, usage_to_dict
+from metrics import metrics, usage_scope
+
+
+def read_jobs(path: Union[str, Path]) -> List[BatchJob]:
+    '''
+    Reads a JSONL job file. Jobs without an id get their line number. Raises a ValueError naming the line of the
+    first invalid job, so a nightly run fails before any job has started.
+    '''
+    jobs = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                job = BatchJob.model_validate_json(line)
+            except ValidationError as e:
+                raise ValueError(f'Invalid job in line {number} of {path}: {e}') from e
+            if job.id is None:
+                job.id = str(number)
+            jobs.append(job)
+    ids = [x.id for x in jobs]
+    duplicates = sorted({x for x in ids if ids.count(x) > 1})
+    if duplicates:
+        raise ValueError(f'Duplicate job ids in {path}: {", ".join(duplicates)}')
+    return jobs
+
+
+def done_job_ids(results_path: Union[str, Path]) -> set:
+    '''
+    Returns the ids of the jobs whose last result record in an existing results file is done.
+    '''
+    status = {}
+    if os.path.exists(results_path):
+        with open(results_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    status[record['id']] = record['status']
+    return {job_id for job_id, x in status.items() if x == 'done'}
+
+
+class BatchRunner():
+    '''
+    Runs the jobs of cli.py batch concurrently. All jobs share the same agents (and through them the MCP servers),
+    response cache, retry policy and input cache. Input files are parsed once, even if several jobs use them.
+    Every job writes one result record with its status, timings and token usage.
+
+    Args:
+        - model_name: The model of all agents.
+        - server_configs: The MCP servers of all agents.
+        - prompt_encoding, prompt_layout: The prompt encoding and layout of all agents.
+        - max_concurrency: The maximum number of jobs running at the same time. Map-reduce outlines and parallel
+          sections of a job run concurrently within the job on top of that.
+        - cache, retry_policy, input_cache: Shared by all jobs, see ResponseCache, RetryPolicy and ParsedInputCache.
+        - outline_store: Stores the outlines of with-outline and outline-only jobs, their id is added to the result record.
+    '''
+    def __init__(
+        self,
+        model_name: str,
+        server_configs: Optional[List[MCPServerConfig]] = None,
+        prompt_encoding: PromptEncoding = 'json',
+        prompt_layout: PromptLayout = 'combined',
+        max_concurrency: int = 4,
+        cache: Optional[ResponseCache] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        input_cache: Optional[ParsedInputCache] = None,
+        outline_store: Optional[OutlineStore] = None
+    ):
+        self.model_name = model_name
+        self.server_configs = server_configs
+        self.prompt_encoding = prompt_encoding
+        self.prompt_layout = prompt_layout
+        self.max_concurrency = max_concurrency
+        self.cache = cache
+        self.retry_policy = retry_policy
+        self.input_cache = input_cache
+        self.outline_store = outline_store
+        self._agents: Dict[str, Union[WriterAgent, OutlineAgent]] = {}
+        self._parsed: Dict[Tuple, asyncio.Task] = {}
+        self._tokenizer: Optional[TokenizerService] = None
+
+
+    @property
+    def tokenizer(self) -> TokenizerService:
+        if self._tokenizer is None:
+            self._tokenizer = TokenizerService(self.model_name)
+        return self._tokenizer
+
+
+    def agent(self, name: str) -> Union[WriterAgent, OutlineAgent]:
+        '''
+        Returns the shared agent for a role ('writer', 'outline' or 'outline_writer'), created on first use.
+        '''
+        if name not in self._agents:
+            options = dict(
+                server_configs=self.server_configs,
+                model_name=self.model_name,
+                cache=self.cache,
+                retry_policy=self.retry_policy,
+                prompt_encoding=self.prompt_encoding,
+                prompt_layout=self.prompt_layout
+            )
+            if name == 'outline':
+                self._agents[name] = OutlineAgent(system_prompt=build_outline_system_prompt(self.prompt_encoding, self.prompt_layout), **options)
+            elif name == 'outline_writer':
+                self._agents[name] = WriterAgent(system_prompt=build_from_file_with_outline_system_prompt(self.prompt_encoding, self.prompt_layout), **options)
+            else:
+                self._agents[name] = WriterAgent(system_prompt=build_from_file_system_prompt(self.prompt_encoding, self.prompt_layout), **options)
+        return self._agents[name]
+
+
+    def _parse(self, input_path: str, include: Optional[List[str]], exclude: Optional[List[str]]) -> List[InputText]:
+        if not os.path.exists(input_path):
+            raise FileNotFoundError(f'Input path not found: {input_path}')
+        input_parser = InputParser(cache=self.input_cache, tokenizer=self.tokenizer)
+        input_texts = input_parser.parse(input_path, include=include, exclude=exclude)
+        for error in input_parser.errors:
+            print(f'Skipped invalid {error}')
+        return input_texts
+
+
+    async def load_input_texts(self, job: BatchJob) -> List[InputText]:
+        '''
+        Returns the input texts of a job with their word and token counts after the optional dedup and relevance
+        trimming. Files are parsed on a thread.
+        '''
+        if job.input_texts is not None:
+            input_texts = job.input_texts
+            await asyncio.to_thread(self.tokenizer.fill_counts, input_texts)
+        else:
+            key = (os.path.abspath(job.input_path), tuple(job.include or ()), tuple(job.exclude or ()))
+            if key not in self._parsed:
+                self._parsed[key] = asyncio.create_task(asyncio.to_thread(self._parse, job.input_path, job.include, job.exclude))
+            input_texts = await self._parsed[key]
+        if not input_texts:
+            raise ValueError(f'No input texts in {job.input_path}' if job.input_path is not None else 'No input texts')
+        if job.dedup_threshold is not None:
+            input_texts, _ = await asyncio.to_thread(Deduplicator(threshold=job.dedup_threshold).deduplicate, input_texts)
+        if job.max_input_tokens is not None:
+            prompt = job.prompt if job.content_prompt is None else f'{job.prompt}\n{job.content_prompt}'
+            input_texts, _ = await asyncio.to_thread(lambda: RelevanceIndex(input_texts, self.tokenizer).trim(prompt, job.max_input_tokens))
+        return input_texts
+
+
+    async def _create_outline(self, job: BatchJob, input_texts: List[InputText]) -> Outline:
+        outline_agent = self.agent('outline')
+        if job.max_chunk_tokens:
+            return await MapReducePipeline(outline_agent, max_chunk_tokens=job.max_chunk_tokens).create_outline(input_texts, job.prompt)
+        return (await outline_agent.run(outline_agent._construct_user_prompt(input_texts, job.prompt))).output
+
+
+    async def _write_from_outline(self, job: BatchJob, outline: Outline) -> OutputText:
+        writer_agent = self.agent('outline_writer')
+        if job.parallel_sections:
+            return await ParallelSectionWriter(writer_agent, paragraphs_per_section=job.paragraphs_per_section).write(outline, job.content_prompt)
+        return (await writer_agent.run(writer_agent._construct_user_prompt_from_outline(outline, job.content_prompt))).output
+
+
+    async def run_job(self, job: BatchJob) -> dict:
+        '''
+        Runs one job and returns its result record. Errors are recorded instead of raised.
+        '''
+        record = {'id': job.id, 'action': job.action, 'status': 'failed', 'error': None, 'output_path': job.output_path}
+        seconds = {}
+        started_at = time.time()
+        with usage_scope() as usage:
+            try:
+                start = time.perf_counter()
+                input_texts = await self.load_input_texts(job)
+                seconds['inputs'] = time.perf_counter() - start
+                if job.action == 'from-file':
+                    start = time.perf_counter()
+                    writer_agent = self.agent('writer')
+                    output = (await writer_agent.run(writer_agent._construct_user_prompt_from_input_texts(input_texts, job.prompt))).output
+                    seconds['write'] = time.perf_counter() - start
+                else:
+                    start = time.perf_counter()
+                    output = await self._create_outline(job, input_texts)
+                    seconds['outline'] = time.perf_counter() - start
+                    if self.outline_store is not None:
+                        record['outline_id'] = self.outline_store.save(output, job.prompt, [x.metadata.source for x in input_texts])
+                    if job.action == 'with-outline':
+                        start = time.perf_counter()
+                        output = await self._write_from_outline(job, output)
+                        seconds['write'] = time.perf_counter() - start
+                if job.output_path is None:
+                    record['output'] = output.model_dump(mode='json')
+                elif job.output_path.endswith('.json'):
+                    atomic_write(job.output_path, output.model_dump_json(indent=2))
+                else:
+                    atomic_write(job.output_path, output_to_markdown(output))
+                record['status'] = 'done'
+            except Exception as e:
+                record['error'] = f'{type(e).__name__}: {e}'
+        metrics.inc('batch_jobs', action=job.action, status=record['status'])
+        seconds['total'] = time.time() - started_at
+        record['seconds'] = {key: round(value, 3) for key, value in seconds.items()}
+        record['usage'] = usage_to_dict(usage)
+        record['started_at'] = started_at
+        record['finished_at'] = time.time()
+        return record
+
+
+    async def run(self, jobs: List[BatchJob], sink: JsonlSink) -> dict:
+        '''
+        Runs the jobs with at most max_concurrency at a time and adds every result record to the sink as soon as
+        its job has finished. Returns the number of done and failed jobs.
+        '''
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        stats = {'done': 0, 'failed': 0}
+
+        async def run_job(job: BatchJob):
+            async with semaphore:
+                record = await self.run_job(job)
+            sink.add([record])
+            stats[record['status']] += 1
+            print(f'Job {job.id}: {record["status"]} in {record["seconds"]["total"]:.1f}s' + (f' ({record["error"]})' if record['error'] else ''))
+
+        await asyncio.gather(*(run_job(x) for x in jobs))
+        sink.flush()
+        return stats
+
+
+    async def close(self):
+        for agent in self._agents.values():
+            await agent.close()
@@ -0,0 +1,174 @@
+import json, os, tempfile, threading, time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+from metrics import cached_tokens
+
+
+def atomic_write(path: Union[str, Path], text: str):
+    '''
+    Writes a text file through a temporary file in the same directory that replaces the target when it is complete,
+    so a crash never leaves a half-written file behind.
+    '''
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def usage_to_dict(usage: Any) -> dict:
+    '''
+    The token counts of a pydantic-ai Usage as a plain dict for the manifest.
+    '''
+    return {
+        'requests': usage.requests,
+        'request_tokens': usage.request_tokens or 0,
+        'response_tokens': usage.response_tokens or 0,
+        'cached_tokens': cached_tokens(usage),
+        'total_tokens': usage.total_tokens or (usage.request_tokens or 0) + (usage.response_tokens or 0)
+    }
+
+
+class RunManifest():
+    '''
+    Records the status of every item of a batch run in a JSON file, so a rerun after a crash skips the items
+    that are already done. An item is running, done or failed, and keeps its number of attempts, the usage of its
+    successful run and its last error. The file is rewritten atomically after every change.
+
+    Args:
+        - path: The manifest file. Created on the first change if it doesn't exist.
+    '''
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.items: Dict[str, dict] = {}
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.items = json.load(f)['items']
+
+
+    def _save(self):
+        atomic_write(self.path, json.dumps({'items': self.items}, ensure_ascii=False, indent=2))
+
+
+    def _update(self, key: str, **fields):
+        with self._lock:
+            item = self.items.setdefault(key, {'status': None, 'attempts': 0, 'usage': None, 'error': None})
+            item.update(fields, updated_at=time.time())
+            self._save()
+
+
+    def is_done(self, key: str) -> bool:
+        return self.items.get(key, {}).get('status') == 'done'
+
+
+    def pending(self, keys: Iterable[str]) -> List[str]:
+        '''
+        Returns the keys that are not done yet, in their original order. Failed and interrupted items are pending again.
+        '''
+        return [x for x in keys if not self.is_done(x)]
+
+
+    def mark_running(self, key: str):
+        self._update(key, status='running', attempts=self.items.get(key, {}).get('attempts', 0) + 1)
+
+
+    def mark_done(self, key: str, usage: Optional[Any] = None):
+        self._update(key, status='done', usage=usage_to_dict(usage) if usage is not None else None, error=None)
+
+
+    def mark_failed(self, key: str, error: str):
+        self._update(key, status='failed', error=error)
+
+
+    def stats(self) -> dict:
+        statuses = [x['status'] for x in self.items.values()]
+        return {
+            'done': statuses.count('done'),
+            'failed': statuses.count('failed'),
+            'running': statuses.count('running'),
+            'total_tokens': sum((x['usage'] or {}).get('total_tokens', 0) for x in self.items.values())
+        }
+
+
+class JsonlSink():
+    '''
+    Append-only JSONL output file with batched writes. Records are buffered and written together once
+    flush_every records are waiting, followed by an fsync. Callbacks passed to add() run only after their
+    records have been flushed, e.g. to mark an item as done in the RunManifest.
+    A line that was cut off by a crash is removed when the file is opened again.
+
+    Args:
+        - path: The JSONL file. Existing records are kept and new ones appended.
+        - flush_every: How many records are buffered before they are written.
+    '''
+    def __init__(self, path: Union[str, Path], flush_every: int = 20):
+        self.path = Path(path)
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._buffer: List[str] = []
+        self._callbacks: List[Callable[[], None]] = []
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'ab+')
+        self._truncate_partial_line()
+
+
+    def _truncate_partial_line(self):
+        size = self._file.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        self._file.seek(max(size - 65536, 0))
+        tail = self._file.read()
+        if tail.endswith(b'\n'):
+            return
+        last_newline = tail.rfind(b'\n')
+        if last_newline == -1 and size > len(tail):
+            # The partial line is longer than the tail, search the whole file
+            self._file.seek(0)
+            last_newline = self._file.read().rfind(b'\n')
+            self._file.truncate(last_newline + 1)
+        else:
+            self._file.truncate(size - len(tail) + last_newline + 1)
+
+
+    def add(self, records: Iterable[Any], on_flush: Optional[Callable[[], None]] = None):
+        '''
+        Buffers records (dicts or pydantic models) and flushes the buffer once it is full.
+        '''
+        with self._lock:
+            for record in records:
+                line = record.model_dump_json() if hasattr(record, 'model_dump_json') else json.dumps(record, ensure_ascii=False)
+                self._buffer.append(line + '\n')
+            if on_flush is not None:
+                self._callbacks.append(on_flush)
+            if len(self._buffer) >= self.flush_every:
+                self._flush()
+
+
+    def _flush(self):
+        if self._buffer:
+            # One write per batch, so a crash cuts off at most the last line, which is removed on the next open
+            self._file.write(''.join(self._buffer).encode('utf-8'))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._buffer = []
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+
+    def close(self):
+        self.flush()
+        self._file.close()
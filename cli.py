@@ -1,116 +1,358 @@
 from writer_agent import WriterAgent
 from outline_agent import OutlineAgent
-from schemas import MCPServerConfig, OutputText, Outline
-import argparse, json, os, datetime, asyncio
-from system_prompts import from_file_system_prompt, from_file_with_outline_system_prompt, outline_system_prompt, from_web_system_prompt
+from schemas import MCPServerConfig, InputText, OutputText, Outline, FullUserPromptInputTexts, FullUserPromptOutline, WriterVariant, check_variants
+import argparse, json, os, re, datetime, asyncio
+from system_prompts import build_from_file_system_prompt, build_from_file_with_outline_system_prompt, build_outline_system_prompt, from_web_system_prompt
 from input_parser import InputParser
-from typing import Union
+from input_cache import ParsedInputCache
+from pipeline import MapReducePipeline, ParallelSectionWriter, VariantWriter
+from outline_store import OutlineStore
+from response_cache import ResponseCache
+from retry import RetryPolicy
+from streaming import get_paragraphs
+from prompt_serializer import UserPromptSerializer, output_to_markdown
+from tokenizer import count_tokens, TokenizerService
+from dedup import Deduplicator
+from relevance import RelevanceIndex
+from metrics import metrics
+from profiling import profile
+from batch_jobs import BatchRunner, read_jobs, done_job_ids
+from batch_runs import JsonlSink
+from pydantic import TypeAdapter
+from typing import AsyncIterator, List, Optional, Union
 
 
-def write_to_markdown(output: Union[OutputText, Outline]):
+def write_to_markdown(output: Union[OutputText, Outline], name: Optional[str] = None):
     '''
     Only used in cli at this moment.
     Takes the OutputText object and writes it to an markdown file in the output directory.
+    The name (e.g. of a variant) is added to the file name, so outputs written at the same time don't collide.
     '''
     script_dir = os.path.dirname(os.path.abspath(__file__))
     outputs_dir = os.path.join(script_dir, 'outputs')
     os.makedirs(outputs_dir, exist_ok=True)
-    output_file = os.path.join(outputs_dir, f'{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.md')
-    lines = []
-    if isinstance(output, OutputText):
-        if output.headline:
-            lines.append(f'# {output.headline}\n')
-        if output.teaser:
-            lines.append(f'*{output.teaser}*\n')
-        for paragraph in output.body:
-            if paragraph.subheadline:
-                lines.append(f'## {paragraph.subheadline}\n')
-            lines.append(f'{paragraph.text}\n')
-        with open(output_file, 'w', encoding='utf-8') as file:
-            file.writelines(lines)        
-    elif isinstance(output, Outline):
-        for paragraph in output.paragraphs:
+    file_name = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + (f'_{re.sub(r"[^A-Za-z0-9_-]+", "-", name)}' if name else '')
+    output_file = os.path.join(outputs_dir, f'{file_name}.md')
+    with open(output_file, 'w', encoding='utf-8') as file:
+        file.write(output_to_markdown(output))
+
+async def print_stream(stream: AsyncIterator[Union[OutputText, Outline]]) -> Union[OutputText, Outline]:
+    '''
+    Only used in cli at this moment.
+    Prints the paragraphs of a streamed output as soon as they are completed and returns the complete output.
+    '''
+    printed = 0
+    printed_headline = False
+    output = None
+    async for output in stream:
+        if not printed_headline and isinstance(output, OutputText):
+            printed_headline = True
+            if output.headline:
+                print(f'# {output.headline}\n', flush=True)
+            if output.teaser:
+                print(f'*{output.teaser}*\n', flush=True)
+        paragraphs = get_paragraphs(output)
+        for paragraph in paragraphs[printed:]:
             if paragraph.subheadline:
-                lines.append(f'## {paragraph.subheadline}\n')
-            lines.append(f'{paragraph.text}\n')
-        with open(output_file, 'w', encoding='utf-8') as file:
-            file.writelines(lines)
+                print(f'## {paragraph.subheadline}\n', flush=True)
+            print(f'{paragraph.text}\n', flush=True)
+        printed = max(printed, len(paragraphs))
+    return output
+
+
+def load_input_texts(args, input_cache: Optional[ParsedInputCache]) -> List[InputText]:
+    '''
+    Parses the input files with their word and token counts and removes near-duplicate paragraphs if --dedup is set.
+    '''
+    with metrics.span('load_inputs'):
+        input_parser = InputParser(cache=input_cache, tokenizer=TokenizerService(args.model_name))
+        input_texts = input_parser.parse(args.file_path, include=args.include, exclude=args.exclude)
+    for error in input_parser.errors:
+        print(f'Skipped invalid {error}')
+    if args.dedup:
+        with metrics.span('dedup'):
+            input_texts, report = Deduplicator(threshold=args.dedup_threshold).deduplicate(input_texts)
+        print(report)
+    return input_texts
+
+
+def build_relevance_index(args, input_texts: List[InputText]) -> Optional[RelevanceIndex]:
+    '''
+    Indexes the input texts for select_input_texts() if --max-input-tokens is set.
+    '''
+    if not args.max_input_tokens:
+        return None
+    with metrics.span('relevance_index'):
+        return RelevanceIndex(input_texts, TokenizerService(args.model_name))
+
+
+def select_input_texts(input_texts: List[InputText], relevance_index: Optional[RelevanceIndex], user_prompt: str, max_tokens: Optional[int]) -> List[InputText]:
+    '''
+    Trims the input texts to the paragraphs most relevant to the prompt if --max-input-tokens is set.
+    '''
+    if relevance_index is None:
+        return input_texts
+    with metrics.span('relevance'):
+        input_texts, report = relevance_index.trim(user_prompt, max_tokens)
+    print(report)
+    return input_texts
+
+
+def read_variants(path: str) -> List[WriterVariant]:
+    '''
+    Reads the variants of --variants from a JSON file with a list of variants.
+    '''
+    with open(path, 'r', encoding='utf-8') as f:
+        variants = TypeAdapter(List[WriterVariant]).validate_json(f.read())
+    check_variants(variants)
+    return variants
+
+
+def parse_outline_command(user_prompt: str) -> Optional[str]:
+    '''
+    Returns the id if the outline prompt is "outline <id>", i.e. a stored outline should be used instead of creating one.
+    Only hex ids (of the CLI or of API jobs) count, so prompts like "outline everything" still create an outline.
+    '''
+    match = re.fullmatch(r'outline\s+([0-9a-f]{12,32})', user_prompt.strip(), re.IGNORECASE)
+    return match.group(1).lower() if match else None
+
+
+def token_totals() -> List[float]:
+    '''
+    Returns the input, cached input and output tokens of the session so far.
+    '''
+    return [metrics.total('tokens', direction='input'), metrics.total('cached_tokens'), metrics.total('tokens', direction='output')]
+
+
+def print_turn_tokens(before: List[float]):
+    '''
+    Only used in cli at this moment.
+    Prints the tokens used since token_totals() returned before, including the input tokens the provider read
+    from its prompt cache.
+    '''
+    input_tokens, cached, output_tokens = (after - x for after, x in zip(token_totals(), before))
+    print(f'Tokens: {input_tokens:g} input ({cached:g} cached, {cached / max(input_tokens, 1):.0%}), {output_tokens:g} output')
+
+
+def print_token_savings(agent: Union[WriterAgent, OutlineAgent], full_user_prompt: Union[FullUserPromptInputTexts, FullUserPromptOutline], baseline_serializer: UserPromptSerializer):
+    '''
+    Only used in cli at this moment.
+    Prints how many prompt tokens the agent's prompt encoding saves compared to indented JSON.
+    '''
+    tokens = count_tokens(agent.prompt_serializer.serialize(full_user_prompt), agent.model_name)
+    baseline_tokens = count_tokens(baseline_serializer.serialize(full_user_prompt), agent.model_name)
+    saved = baseline_tokens - tokens
+    print(f'Prompt: {tokens} tokens with {agent.prompt_serializer.encoding} encoding, {baseline_tokens} with json ({saved} saved, {saved / max(baseline_tokens, 1):.0%})')
+
 
 async def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--model-name', default='openai:gpt-4o-mini', help='Model name. Default is 4o-mini')
     parser.add_argument('--write-to-file', action='store_true', help='Write outputs to md files. If not set, output will be printed to console.')
     parser.add_argument('--mcp-servers', default=None, help='A list of mcp server configurations (see docs)')
+    parser.add_argument('--prompt-encoding', choices=['json', 'compact', 'markdown'], default='json', help='How input texts and outlines are encoded in the prompt: indented json (default), compact json without empty fields or a markdown-like layout. Token savings are printed for each run.')
+    parser.add_argument('--prompt-layout', choices=['combined', 'prefix'], default='combined', help='How the user message is laid out: input texts or outline and user prompt in one block (default), or the input texts or outline first and the user prompt as a separate part after them, so the system prompt and the inputs form a stable prefix the provider can cache between turns.')
+    parser.add_argument('--stream', action='store_true', help='Print paragraphs as soon as they are written instead of waiting for the whole text.')
+    parser.add_argument('--cache', action='store_true', help='Answer repeated identical requests from a local response cache instead of calling the model again.')
+    parser.add_argument('--input-cache', action='store_true', help='Keep parsed input files in a local cache and only parse files again when they have changed.')
+    parser.add_argument('--input-cache-path', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'inputs.sqlite'), help='Path to the SQLite file of the input cache. Default is .cache/inputs.sqlite')
+    parser.add_argument('--outline-store-path', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'outlines.sqlite'), help='Path to the SQLite file created outlines are stored in, so they can be reused by id. Default is .cache/outlines.sqlite')
+    parser.add_argument('--profile', action='store_true', help='Profile every stage with cProfile and tracemalloc and write CPU and allocation reports and collapsed stacks for flamegraphs to outputs/profiles/.')
+    parser.add_argument('--metrics', action='store_true', help='Print the tokens of every turn, including cached input tokens, and a table of stage latencies, token usage, cache hits and retries at the end of the session.')
+    parser.add_argument('--retries', type=int, default=3, help='How often a failed model request is retried after server, connection and validation errors (rate limits are retried more often). Default is 3')
+    parser.add_argument('--cache-path', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'responses.sqlite'), help='Path to the SQLite file of the response cache. Default is .cache/responses.sqlite')
     
     subparsers = parser.add_subparsers(dest='action', required=True)
 
     # from-file
     from_file_parser = subparsers.add_parser('from-file', help='Work with text from one or more files')
     from_file_parser.add_argument('--file-path', required=True, help='Path to the input file or directory')
+    from_file_parser.add_argument('--include', action='append', default=None, help='Glob pattern of files to read from a directory, e.g. "*.md" or "2024/*". Can be repeated. Directories are searched recursively')
+    from_file_parser.add_argument('--exclude', action='append', default=None, help='Glob pattern of files or directories to skip. Can be repeated')
+    from_file_parser.add_argument('--dedup', action='store_true', help='Remove near-duplicate paragraphs across the input texts before prompting, e.g. the same press release quoted in several newsletters')
+    from_file_parser.add_argument('--dedup-threshold', type=float, default=0.8, help='Similarity (0-1) from which paragraphs count as near-duplicates with --dedup. Default is 0.8')
+    from_file_parser.add_argument('--max-input-tokens', type=int, default=None, help='Token budget for the paragraphs of the input texts of every prompt, without headlines, teasers, metadata and prompt syntax. Larger input sets are trimmed to the paragraphs most relevant to the prompt (BM25)')
     from_file_parser.add_argument('--with-outline', action='store_true', help='Create an outline first, then generate content from the outline')
+    from_file_parser.add_argument('--chunk-tokens', type=int, default=None, help='Token budget per outline run. Larger input sets are split into chunks which are outlined concurrently and merged into one outline (implies --with-outline)')
+    from_file_parser.add_argument('--parallel-sections', action='store_true', help='Write the sections of the outline concurrently and stitch them together instead of writing the whole text in one go (implies --with-outline)')
+    from_file_parser.add_argument('--paragraphs-per-section', type=int, default=1, help='Number of outline paragraphs written together as one section with --parallel-sections. Default is 1')
+    from_file_parser.add_argument('--outline-id', default=None, help='Start with a stored outline instead of creating one (implies --with-outline). Stored outlines can also be reused by entering "outline <id>" as the outline prompt')
+    from_file_parser.add_argument('--variants', default=None, help='JSON file with a list of variants, e.g. [{"name": "blog", "user_prompt": "...", "system_prompt": "..."}]. All variants are written concurrently from every outline instead of asking how to write the content (implies --with-outline)')
+    from_file_parser.add_argument('--max-concurrency', type=int, default=4, help='Maximum number of concurrent outline runs with --chunk-tokens, section runs with --parallel-sections and variant runs with --variants. Default is 4')
 
     # create-outline-only
     create_outline_only_parser = subparsers.add_parser('create-outline-only', help='Create an outline from input texts without writing the actual content')
     create_outline_only_parser.add_argument('--file-path', required=True, help='Path to the input file or directory')
+    create_outline_only_parser.add_argument('--include', action='append', default=None, help='Glob pattern of files to read from a directory, e.g. "*.md" or "2024/*". Can be repeated. Directories are searched recursively')
+    create_outline_only_parser.add_argument('--exclude', action='append', default=None, help='Glob pattern of files or directories to skip. Can be repeated')
+    create_outline_only_parser.add_argument('--dedup', action='store_true', help='Remove near-duplicate paragraphs across the input texts before prompting, e.g. the same press release quoted in several newsletters')
+    create_outline_only_parser.add_argument('--dedup-threshold', type=float, default=0.8, help='Similarity (0-1) from which paragraphs count as near-duplicates with --dedup. Default is 0.8')
+    create_outline_only_parser.add_argument('--max-input-tokens', type=int, default=None, help='Token budget for the paragraphs of the input texts of every prompt, without headlines, teasers, metadata and prompt syntax. Larger input sets are trimmed to the paragraphs most relevant to the prompt (BM25)')
+    create_outline_only_parser.add_argument('--chunk-tokens', type=int, default=None, help='Token budget per outline run. Larger input sets are split into chunks which are outlined concurrently and merged into one outline')
+    create_outline_only_parser.add_argument('--max-concurrency', type=int, default=4, help='Maximum number of concurrent outline runs with --chunk-tokens. Default is 4')
 
     # from-web
     from_web_parser = subparsers.add_parser('from-web', help='Work with text gathered from a web search')
     from_web_parser.add_argument('--with-outline', action='store_true', help='Create an outline first, then generate content from the outline (dummy for now)')
 
+    # batch
+    batch_parser = subparsers.add_parser('batch', help='Run the jobs of a JSONL job file concurrently without prompting, see the README for the format')
+    batch_parser.add_argument('--jobs-file', required=True, help='JSONL file with one job per line')
+    batch_parser.add_argument('--results', default=None, help='JSONL file the result record of every job is appended to. Default is <jobs file>.results.jsonl')
+    batch_parser.add_argument('--max-concurrency', type=int, default=4, help='Maximum number of jobs running at the same time. Default is 4')
+    batch_parser.add_argument('--resume', action='store_true', help='Skip the jobs that are already done according to the results file')
+
     args = parser.parse_args()
+    if args.action == 'from-file' and args.variants and args.parallel_sections:
+        parser.error('--variants can\'t be combined with --parallel-sections')
+    if not args.profile:
+        await run_session(args)
+        return
+    profile_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'outputs', 'profiles', datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    with profile(profile_dir):
+        await run_session(args)
+    print(f'Profile: {profile_dir}')
+
+
+async def run_session(args):
+    '''
+    Runs the action of the parsed command line arguments until the user exits.
+    '''
+    cache = ResponseCache(db_path=args.cache_path) if args.cache else None
+    input_cache = ParsedInputCache(args.input_cache_path) if args.input_cache else None
+    retry_policy = RetryPolicy(max_retries=args.retries, validation_retries=min(args.retries, 1))
+    baseline_serializer = UserPromptSerializer('json')
+    outline_store = OutlineStore(args.outline_store_path) if args.action in ('from-file', 'create-outline-only', 'batch') else None
 
     if args.action == 'from-file':
-        input_parser = InputParser()
-        input_data = input_parser.parse(args.file_path)
+        input_data = load_input_texts(args, input_cache)
+        relevance_index = build_relevance_index(args, input_data)
         if args.mcp_servers:
             servers_list = json.loads(args.mcp_servers)
             mcp_configs = [MCPServerConfig(**server) for server in servers_list]
         else:
             mcp_configs = None
-        if args.with_outline:
+        if args.with_outline or args.chunk_tokens or args.parallel_sections or args.outline_id or args.variants:
             # Outline + writer workflow
             outline_agent = OutlineAgent(
                 server_configs=mcp_configs,
                 model_name=args.model_name,
-                system_prompt=outline_system_prompt
+                system_prompt=build_outline_system_prompt(args.prompt_encoding, args.prompt_layout),
+                cache=cache,
+                retry_policy=retry_policy,
+                prompt_encoding=args.prompt_encoding,
+                prompt_layout=args.prompt_layout
             )
             writer_agent = WriterAgent(
                 server_configs=mcp_configs,
                 model_name=args.model_name,
-                system_prompt=from_file_with_outline_system_prompt
+                system_prompt=build_from_file_with_outline_system_prompt(args.prompt_encoding, args.prompt_layout),
+                cache=cache,
+                retry_policy=retry_policy,
+                prompt_encoding=args.prompt_encoding,
+                prompt_layout=args.prompt_layout
             )
+            pipeline = MapReducePipeline(outline_agent, writer_agent, args.chunk_tokens, args.max_concurrency) if args.chunk_tokens else None
+            section_writer = ParallelSectionWriter(writer_agent, args.max_concurrency, args.paragraphs_per_section) if args.parallel_sections else None
+            variants = read_variants(args.variants) if args.variants else None
+            variant_writer = VariantWriter(writer_agent, args.max_concurrency) if variants else None
+            outline_id = args.outline_id
             while True:
-                user_prompt_outline = input('How would you like me to create the outline? ')
-                if user_prompt_outline.strip().lower() == 'exit':
-                    break
-                user_prompt_outline_full = outline_agent._construct_user_prompt(input_data, user_prompt_outline)
-                response_outline = await outline_agent.run(user_prompt_outline_full)
+                tokens_before = token_totals()
+                if outline_id is None:
+                    user_prompt_outline = input('How would you like me to create the outline? ')
+                    if user_prompt_outline.strip().lower() == 'exit':
+                        break
+                    outline_id = parse_outline_command(user_prompt_outline)
+                if outline_id is not None:
+                    # Reuse a stored outline, e.g. to only retry the writing step
+                    outline = outline_store.get(outline_id)
+                    if outline is None:
+                        print(f'No stored outline with the id {outline_id}')
+                        outline_id = None
+                        continue
+                    print(f'Using outline {outline_id}')
+                    outline_id = None
+                else:
+                    prompt_input_data = select_input_texts(input_data, relevance_index, user_prompt_outline, args.max_input_tokens)
+                    user_prompt_outline_full = outline_agent._construct_user_prompt(prompt_input_data, user_prompt_outline)
+                    if args.prompt_encoding != 'json':
+                        print_token_savings(outline_agent, user_prompt_outline_full, baseline_serializer)
+                    if pipeline is not None:
+                        outline = await pipeline.create_outline(prompt_input_data, user_prompt_outline)
+                    elif args.stream:
+                        outline = await print_stream(outline_agent.run_stream(user_prompt_outline_full))
+                    else:
+                        outline = (await outline_agent.run(user_prompt_outline_full)).output
+                    stored_id = outline_store.save(outline, user_prompt_outline, [x.metadata.source for x in prompt_input_data])
+                    print(f'Outline {stored_id} (enter "outline {stored_id}" to write from it again)')
+                if variant_writer is not None:
+                    result = await variant_writer.write(outline, variants)
+                    for name, output in result.outputs.items():
+                        if args.write_to_file:
+                            write_to_markdown(output, name)
+                        else:
+                            print(f'{name}: {output}')
+                    for name, error in result.errors.items():
+                        print(f'Variant {name} failed: {error}')
+                    if args.metrics:
+                        print_turn_tokens(tokens_before)
+                    continue
                 user_prompt_writer = input('How would you like me to write the content? ')
                 if user_prompt_writer.strip().lower() == 'exit':
                     break
-                user_prompt_writer_full = writer_agent._construct_user_prompt_from_outline(response_outline.output, user_prompt_writer)
-                response_from_writer = await writer_agent.run(user_prompt_writer_full)
-                if args.write_to_file:
-                    write_to_markdown(response_from_writer.output)
+                user_prompt_writer_full = writer_agent._construct_user_prompt_from_outline(outline, user_prompt_writer)
+                if args.prompt_encoding != 'json':
+                    print_token_savings(writer_agent, user_prompt_writer_full, baseline_serializer)
+                if section_writer is not None and args.stream:
+                    output = await print_stream(section_writer.write_stream(outline, user_prompt_writer))
+                elif section_writer is not None:
+                    output = await section_writer.write(outline, user_prompt_writer)
+                elif args.stream:
+                    output = await print_stream(writer_agent.run_stream(user_prompt_writer_full))
                 else:
-                    print(response_from_writer.output)
+                    output = (await writer_agent.run(user_prompt_writer_full)).output
+                if args.write_to_file:
+                    write_to_markdown(output)
+                elif not args.stream:
+                    print(output)
+                if args.metrics:
+                    print_turn_tokens(tokens_before)
+            if variant_writer is not None:
+                await variant_writer.close()
+            await outline_agent.close()
+            await writer_agent.close()
         else:
             # Writer only workflow
             agent = WriterAgent(
                 server_configs=mcp_configs,
                 model_name=args.model_name,
-                system_prompt=from_file_system_prompt
+                system_prompt=build_from_file_system_prompt(args.prompt_encoding, args.prompt_layout),
+                cache=cache,
+                retry_policy=retry_policy,
+                prompt_encoding=args.prompt_encoding,
+                prompt_layout=args.prompt_layout
             )
             while True:
                 user_prompt = input('What would you like me to do? ')
                 if user_prompt.strip().lower() == 'exit':
                     break
-                user_prompt_full = agent._construct_user_prompt_from_input_texts(input_data, user_prompt)
-                response = await agent.run(user_prompt_full)
-                if args.write_to_file:
-                    write_to_markdown(response.output)
+                tokens_before = token_totals()
+                prompt_input_data = select_input_texts(input_data, relevance_index, user_prompt, args.max_input_tokens)
+                user_prompt_full = agent._construct_user_prompt_from_input_texts(prompt_input_data, user_prompt)
+                if args.prompt_encoding != 'json':
+                    print_token_savings(agent, user_prompt_full, baseline_serializer)
+                if args.stream:
+                    output = await print_stream(agent.run_stream(user_prompt_full))
                 else:
-                    print(response.output)
+                    output = (await agent.run(user_prompt_full)).output
+                if args.write_to_file:
+                    write_to_markdown(output)
+                elif not args.stream:
+                    print(output)
+                if args.metrics:
+                    print_turn_tokens(tokens_before)
+            await agent.close()
     elif args.action == 'from-web':
         if not args.mcp_servers:
             raise ValueError('A connection to the Firecrawl MCP server is required for from-web')
@@ -124,20 +366,55 @@ async def main():
             agent = WriterAgent(
                 server_configs=mcp_configs,
                 model_name=args.model_name,
-                system_prompt=from_web_system_prompt
+                system_prompt=from_web_system_prompt,
+                cache=cache,
+                retry_policy=retry_policy
             )
             while True:
                 user_prompt = input('What would you like me to do? ')
                 if user_prompt.strip().lower() == 'exit':
                     break
-                response = await agent.run(user_prompt)
-                if args.write_to_file:
-                    write_to_markdown(response.output)
+                tokens_before = token_totals()
+                if args.stream:
+                    output = await print_stream(agent.run_stream(user_prompt))
                 else:
-                    print(response.output)
+                    output = (await agent.run(user_prompt)).output
+                if args.write_to_file:
+                    write_to_markdown(output)
+                elif not args.stream:
+                    print(output)
+                if args.metrics:
+                    print_turn_tokens(tokens_before)
+            await agent.close()
+    elif args.action == 'batch':
+        jobs = read_jobs(args.jobs_file)
+        results_path = args.results or f'{os.path.splitext(args.jobs_file)[0]}.results.jsonl'
+        if args.resume:
+            done = done_job_ids(results_path)
+            print(f'Skipping {sum(x.id in done for x in jobs)} jobs that are already done')
+            jobs = [x for x in jobs if x.id not in done]
+        mcp_configs = [MCPServerConfig(**server) for server in json.loads(args.mcp_servers)] if args.mcp_servers else None
+        runner = BatchRunner(
+            model_name=args.model_name,
+            server_configs=mcp_configs,
+            prompt_encoding=args.prompt_encoding,
+            prompt_layout=args.prompt_layout,
+            max_concurrency=args.max_concurrency,
+            cache=cache,
+            retry_policy=retry_policy,
+            input_cache=input_cache,
+            outline_store=outline_store
+        )
+        sink = JsonlSink(results_path, flush_every=1)
+        try:
+            stats = await runner.run(jobs, sink)
+        finally:
+            sink.close()
+            await runner.close()
+        print(f'Batch: {stats["done"]} done, {stats["failed"]} failed, results in {results_path}')
     elif args.action == 'create-outline-only':
-        input_parser = InputParser()
-        input_data = input_parser.parse(args.file_path)
+        input_data = load_input_texts(args, input_cache)
+        relevance_index = build_relevance_index(args, input_data)
         if args.mcp_servers:
             servers_list = json.loads(args.mcp_servers)
             mcp_configs = [MCPServerConfig(**server) for server in servers_list]
@@ -146,18 +423,49 @@ async def main():
         agent = OutlineAgent(
             server_configs=mcp_configs,
             model_name=args.model_name,
-            system_prompt=outline_system_prompt
+            system_prompt=build_outline_system_prompt(args.prompt_encoding, args.prompt_layout),
+            cache=cache,
+            retry_policy=retry_policy,
+            prompt_encoding=args.prompt_encoding,
+            prompt_layout=args.prompt_layout
         )
+        pipeline = MapReducePipeline(agent, max_chunk_tokens=args.chunk_tokens, max_concurrency=args.max_concurrency) if args.chunk_tokens else None
         while True:
             user_prompt = input('What would you like me to do? ')
             if user_prompt.strip().lower() == 'exit':
                 break
-            user_prompt_full = agent._construct_user_prompt(input_data, user_prompt)
-            response = await agent.run(user_prompt_full)
-            if args.write_to_file:
-                write_to_markdown(response.output)
+            tokens_before = token_totals()
+            prompt_input_data = select_input_texts(input_data, relevance_index, user_prompt, args.max_input_tokens)
+            user_prompt_full = agent._construct_user_prompt(prompt_input_data, user_prompt)
+            if args.prompt_encoding != 'json':
+                print_token_savings(agent, user_prompt_full, baseline_serializer)
+            if pipeline is not None:
+                output = await pipeline.create_outline(prompt_input_data, user_prompt)
+            elif args.stream:
+                output = await print_stream(agent.run_stream(user_prompt_full))
             else:
-                print(response.output)
+                output = (await agent.run(user_prompt_full)).output
+            outline_id = outline_store.save(output, user_prompt, [x.metadata.source for x in prompt_input_data])
+            if args.write_to_file:
+                write_to_markdown(output)
+            elif pipeline is not None or not args.stream:
+                print(output)
+            print(f'Outline {outline_id}')
+            if args.metrics:
+                print_turn_tokens(tokens_before)
+        await agent.close()
+    if outline_store is not None:
+        outline_store.close()
+    if input_cache is not None:
+        print(f'Input cache: {input_cache.stats()}')
+        input_cache.close()
+    if retry_policy.calls:
+        print(f'Retries: {retry_policy.stats()}')
+    if cache is not None:
+        print(f'Response cache: {cache.stats()}')
+        cache.close()
+    if args.metrics:
+        print(metrics.summary())
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,235 @@
+import hashlib, re
+import numpy as np
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List, Literal, Optional, Tuple
+from schemas import InputText, InputTextMetadata
+from metrics import metrics
+
+
+_word_re = re.compile(r'\w+')
+# Upper bound for the number of hash values computed at once, about 128 MB
+_max_block_values = 1 << 24
+
+
+@lru_cache(maxsize=1 << 16)
+def word_hash(word: str) -> int:
+    '''
+    A 64-bit hash of a word that is the same in every process. The built-in hash() of strings is salted per process,
+    so signatures and with them the removed paragraphs would change between runs.
+    '''
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def remove_counts(metadata: InputTextMetadata, tokens: int, words: int) -> InputTextMetadata:
+    '''
+    Returns a copy of the metadata of an input text without the tokens and words of removed paragraphs in its
+    counts (see TokenizerService.fill_counts()). The num_words of the input is left as given.
+    '''
+    update = {}
+    if metadata.num_tokens is not None:
+        update['num_tokens'] = metadata.num_tokens - tokens
+    if metadata.word_count is not None:
+        update['word_count'] = metadata.word_count - words
+    return metadata.model_copy(update=update)
+
+
+@dataclass
+class DedupReport():
+    '''
+    What the Deduplicator removed. duplicates holds one (kept source, removed source) pair per removed paragraph,
+    removed_sources the sources of input texts that were dropped because all their paragraphs were duplicates.
+    removed_tokens is the sum of the num_tokens of the removed paragraphs, see TokenizerService.fill_counts().
+    '''
+    paragraphs: int = 0
+    removed_paragraphs: int = 0
+    removed_input_texts: int = 0
+    removed_words: int = 0
+    removed_tokens: int = 0
+    duplicates: List[Tuple[Optional[str], Optional[str]]] = field(default_factory=list)
+    removed_sources: List[Optional[str]] = field(default_factory=list)
+
+
+    def __str__(self):
+        return (
+            f'Removed {self.removed_paragraphs} of {self.paragraphs} paragraphs as near-duplicates '
+            f'({self.removed_tokens} tokens, {self.removed_words} words) and {self.removed_input_texts} input texts without unique paragraphs'
+        )
+
+
+class _UnionFind():
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+
+
+    def find(self, x: int) -> int:
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+
+    def union(self, a: int, b: int):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+
+class Deduplicator():
+    '''
+    Removes near-duplicate paragraphs across input texts, e.g. the same press release quoted in several newsletters.
+    Paragraphs are compared by the Jaccard similarity of their word shingles, estimated with MinHash signatures
+    that are computed with NumPy for all paragraphs at once. Locality-sensitive hashing over bands of the signatures
+    finds the candidate pairs, so not every pair of paragraphs has to be compared.
+    Of every group of near-duplicates only one paragraph is kept. Input texts keep their metadata, and input texts
+    that have no paragraphs left are dropped.
+
+    Args:
+        - threshold: The estimated Jaccard similarity from which paragraphs count as duplicates.
+        - num_perm: The number of hash functions of the MinHash signatures. More are more precise but slower.
+        - shingle_size: The number of consecutive words that form one shingle.
+        - min_words: Paragraphs with fewer words are never removed, short lines are often equal by chance.
+        - keep: Keep the first paragraph of a group (in input order) or the longest one.
+        - seed: Seed of the hash functions.
+    '''
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        num_perm: int = 128,
+        shingle_size: int = 5,
+        min_words: int = 8,
+        keep: Literal['first', 'longest'] = 'first',
+        seed: int = 1
+    ):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.min_words = max(min_words, shingle_size)
+        self.keep = keep
+        rng = np.random.default_rng(seed)
+        # Odd multipliers, so every hash function is a permutation of the 64 bit shingle hashes
+        self._a = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+        self.bands, self.rows = self._choose_bands()
+
+
+    def _choose_bands(self) -> Tuple[int, int]:
+        '''
+        Chooses the LSH bands so that pairs at the threshold become candidates with a high probability.
+        The similarity at which the candidate probability is 50% is about (1 / bands) ** (1 / rows).
+        '''
+        best = (self.num_perm, 1)
+        for rows in range(1, self.num_perm + 1):
+            bands = self.num_perm // rows
+            if (1 / bands) ** (1 / rows) <= self.threshold * 0.9:
+                best = (bands, rows)
+        return best
+
+
+    def signatures(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Computes the MinHash signatures of the texts with at least min_words words.
+        Returns the indexes of these texts and their signatures (one row per text).
+        '''
+        k = self.shingle_size
+        word_hashes = []
+        lengths = []
+        indexes = []
+        for i, text in enumerate(texts):
+            words = _word_re.findall(text.lower())
+            if len(words) >= self.min_words:
+                indexes.append(i)
+                lengths.append(len(words))
+                word_hashes.extend(map(word_hash, words))
+        indexes = np.array(indexes, dtype=np.int64)
+        if len(indexes) == 0:
+            return indexes, np.empty((0, self.num_perm), dtype=np.uint64)
+        word_hashes = np.array(word_hashes, dtype=np.uint64)
+        lengths = np.array(lengths, dtype=np.int64)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        # Hash of the shingle starting at every word, combined with overflowing multiplications
+        shingles = np.zeros(len(word_hashes) - k + 1, dtype=np.uint64)
+        for j in range(k):
+            shingles = shingles * np.uint64(1000003) + word_hashes[j:len(word_hashes) - k + 1 + j]
+        # Only shingles that lie within one paragraph
+        counts = lengths - k + 1
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        positions = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(offsets, counts)
+        shingles = shingles[positions]
+        signatures = np.empty((len(indexes), self.num_perm), dtype=np.uint64)
+        step = max(1, _max_block_values // len(shingles))
+        for p in range(0, self.num_perm, step):
+            a = self._a[p:p + step, None]
+            b = self._b[p:p + step, None]
+            # Multiply-add hashing modulo 2 ** 64 (the overflow), a modulo by a prime is several times slower in NumPy
+            values = a * shingles[None, :] + b
+            signatures[:, p:p + step] = np.minimum.reduceat(values, offsets, axis=1).T
+        return indexes, signatures
+
+
+    def find_duplicates(self, texts: List[str]) -> List[int]:
+        '''
+        Groups near-duplicate texts. Returns the group of every text as the index of its first member.
+        '''
+        groups = _UnionFind(len(texts))
+        indexes, signatures = self.signatures(texts)
+        for band in range(self.bands):
+            rows = np.ascontiguousarray(signatures[:, band * self.rows:(band + 1) * self.rows])
+            keys = rows.view(np.dtype((np.void, rows.dtype.itemsize * self.rows))).ravel()
+            _, buckets, counts = np.unique(keys, return_inverse=True, return_counts=True)
+            members = np.flatnonzero(counts[buckets] > 1)
+            if len(members) == 0:
+                continue
+            order = members[np.argsort(buckets[members], kind='stable')]
+            bucket_ids = buckets[order]
+            firsts = np.concatenate(([True], bucket_ids[1:] != bucket_ids[:-1]))
+            first_of_bucket = order[firsts][np.cumsum(firsts) - 1]
+            # Verify the candidates against the first paragraph of their bucket with the estimated similarity
+            candidates = order[~firsts]
+            firsts_of_candidates = first_of_bucket[~firsts]
+            similarity = (signatures[candidates] == signatures[firsts_of_candidates]).mean(axis=1)
+            for candidate, first in zip(candidates[similarity >= self.threshold], firsts_of_candidates[similarity >= self.threshold]):
+                groups.union(int(indexes[candidate]), int(indexes[first]))
+        return [groups.find(i) for i in range(len(texts))]
+
+
+    def deduplicate(self, input_texts: List[InputText]) -> Tuple[List[InputText], DedupReport]:
+        '''
+        Returns the input texts without near-duplicate paragraphs and a report of what was removed.
+        The input texts that are passed in are not changed.
+        '''
+        paragraphs = [(i, paragraph) for i, input_text in enumerate(input_texts) for paragraph in input_text.body]
+        groups = self.find_duplicates([x.text for _, x in paragraphs])
+        kept = {}
+        for index, group in enumerate(groups):
+            if group not in kept or self.keep == 'longest' and len(paragraphs[index][1].text) > len(paragraphs[kept[group]][1].text):
+                kept[group] = index
+        report = DedupReport(paragraphs=len(paragraphs))
+        bodies = [[] for _ in input_texts]
+        removed_tokens = [0 for _ in input_texts]
+        removed_words = [0 for _ in input_texts]
+        for index, ((i, paragraph), group) in enumerate(zip(paragraphs, groups)):
+            if kept[group] == index:
+                bodies[i].append(paragraph)
+                continue
+            report.removed_paragraphs += 1
+            words = paragraph.num_words if paragraph.num_words is not None else len(paragraph.text.split())
+            report.removed_words += words
+            report.removed_tokens += paragraph.num_tokens or 0
+            removed_tokens[i] += paragraph.num_tokens or 0
+            removed_words[i] += words
+            report.duplicates.append((input_texts[paragraphs[kept[group]][0]].metadata.source, input_texts[i].metadata.source))
+        output = []
+        for input_text, body, tokens, words in zip(input_texts, bodies, removed_tokens, removed_words):
+            if len(body) == len(input_text.body):
+                output.append(input_text)
+            elif body:
+                metadata = remove_counts(input_text.metadata, tokens, words)
+                output.append(input_text.model_copy(update={'body': body, 'metadata': metadata}))
+            else:
+                report.removed_input_texts += 1
+                report.removed_sources.append(input_text.metadata.source)
+        # Also reported in the API, which doesn't print the report
+        metrics.inc('dedup_removed_paragraphs', report.removed_paragraphs)
+        metrics.inc('dedup_removed_tokens', report.removed_tokens)
+        return output, report
@@ -0,0 +1,92 @@
+import json, os, sqlite3, threading, time, zlib
+from typing import List, Optional
+from schemas import InputText
+from prompt_serializer import input_texts_adapter
+
+
+class ParsedInputCache():
+    '''
+    Keeps the parsed input texts of every input file in a local SQLite file, so unchanged files don't have to be
+    read and parsed again in the next session. Entries are keyed on the absolute path of the file and are only valid
+    as long as the size and modification time of the file and the version of the parser are the same.
+    The input texts are stored as zlib-compressed compact JSON and validated straight from it when loaded.
+    Token and word counts are not part of the JSON of an input text, so they are stored in a second line next to it.
+
+    Args:
+        - db_path: Path to the SQLite file.
+    '''
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.hits = 0
+        self.reparsed = 0
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS parsed_inputs ('
+            'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+            'parser_version TEXT NOT NULL, value BLOB NOT NULL, parsed_at REAL NOT NULL)'
+        )
+        self._db.commit()
+
+
+    def get(self, file_path: str, stat: os.stat_result, parser_version: str) -> Optional[List[InputText]]:
+        '''
+        Returns the cached input texts of a file, or None if the file is not cached or has changed since.
+        parser_version identifies the parser and tokenizer the entry was created with.
+        '''
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value FROM parsed_inputs WHERE path = ? AND size = ? AND mtime_ns = ? AND parser_version = ?',
+                (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, parser_version)
+            ).fetchone()
+            if row is None:
+                self.reparsed += 1
+                return None
+            self.hits += 1
+        # Compact JSON doesn't contain raw newlines, so the first one separates the input texts from the counts
+        data, counts = zlib.decompress(row[0]).split(b'\n', 1)
+        input_texts = input_texts_adapter.validate_json(data)
+        for input_text, (num_tokens, word_count, paragraph_counts) in zip(input_texts, json.loads(counts)):
+            input_text.metadata.num_tokens = num_tokens
+            input_text.metadata.word_count = word_count
+            for paragraph, (num_words, paragraph_tokens) in zip(input_text.body, paragraph_counts):
+                paragraph.num_words = num_words
+                paragraph.num_tokens = paragraph_tokens
+        return input_texts
+
+
+    def set(self, file_path: str, stat: os.stat_result, parser_version: str, input_texts: List[InputText]):
+        counts = [
+            [x.metadata.num_tokens, x.metadata.word_count, [[p.num_words, p.num_tokens] for p in x.body]]
+            for x in input_texts
+        ]
+        value = zlib.compress(
+            input_texts_adapter.dump_json(input_texts, exclude_none=True) + b'\n' + json.dumps(counts, separators=(',', ':')).encode('utf-8'),
+            1
+        )
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO parsed_inputs (path, size, mtime_ns, parser_version, value, parsed_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, parser_version, value, time.time())
+            )
+            # Commit in batches, a directory with thousands of small files would otherwise spend most of its time on commits
+            self._uncommitted += 1
+            if self._uncommitted >= 100:
+                self._db.commit()
+                self._uncommitted = 0
+
+
+    def stats(self) -> dict:
+        '''
+        Returns the number of files loaded from the cache and the number of files that had to be parsed.
+        '''
+        return {'hits': self.hits, 'reparsed': self.reparsed}
+
+
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
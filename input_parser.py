@@ -1,79 +1,201 @@
-import os, json
+import io, os, re, json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from fnmatch import fnmatch
+from pydantic import ValidationError
+from typing import Iterable, Iterator, Optional, Union
 from schemas import InputText, InputTextMetadata, Paragraph
+from prompt_serializer import input_texts_adapter
+from input_cache import ParsedInputCache
+from tokenizer import TokenizerService
+from metrics import metrics
+
+
+SUPPORTED_EXTENSIONS = ('.json', '.jsonl', '.md', '.txt')
+# Increase when the parsing results or the cache format change, so files cached by an older version are parsed again
+PARSER_VERSION = 5
+
+_non_space_str = re.compile(r'\S')
+# The first characters of headlines, setext underlines, fences and thematic breaks
+_markup_chars = frozenset('#=-`~*_')
+_non_space_bytes = re.compile(rb'\S')
+
+
+@dataclass
+class ParseError():
+    '''
+    An input record that couldn't be validated and was skipped.
+    record is the index in a JSON array or the line number in a JSONL file.
+    '''
+    source: Optional[str]
+    record: int
+    message: str
+
+
+    def __str__(self):
+        return f'{self.source or "input"} record {self.record}: {self.message}'
 
 
 class InputParser:
     '''
     Flexibly parse input data into a list of InputText objects for the summarizer agent.
+    Invalid records in JSON arrays and JSONL files are skipped and collected in errors, unless strict is set.
+    If a cache is set, files that haven't changed since they were last parsed are loaded from it.
+    If a tokenizer is set, the word and token counts of every input text and paragraph are filled in while parsing.
     '''
+    def __init__(
+        self,
+        strict: bool = False,
+        cache: Optional[ParsedInputCache] = None,
+        tokenizer: Optional[TokenizerService] = None
+    ):
+        self.strict = strict
+        self.cache = cache
+        self.tokenizer = tokenizer
+        self.errors: list[ParseError] = []
+
 
-    def _parse_json(self, input_string: str) -> list[InputText]:
+    def _record_error(self, source: Optional[str], record: int, error: ValidationError):
+        if self.strict:
+            raise error
+        message = '; '.join(f"{'.'.join(str(x) for x in e['loc']) or 'record'}: {e['msg']}" for e in error.errors()[:3])
+        self.errors.append(ParseError(source=source, record=record, message=message))
+
+
+    def _parse_json(self, input_data: Union[str, bytes], source: Optional[str] = None) -> list[InputText]:
         '''
-        Parses input data from a JSON string.
-        Handles one or more input texts, but doesn't currently handle malformed JSON.
+        Parses input data from a JSON string or bytes with one input text or an array of them.
+        The whole document is validated at once straight from JSON. Only if some records are invalid, the array is
+        validated record by record to keep the valid ones.
 
         Args:
-            - input_str: The JSON string to parse.
+            - input_data: The JSON string to parse.
+            - source: The file name used in error reports.
         '''
+        first = (_non_space_bytes if isinstance(input_data, bytes) else _non_space_str).search(input_data)
+        is_array = first is not None and first.group() in ('[', b'[')
         try:
-            input_data = json.loads(input_string)
-            if isinstance(input_data, list):
-                return [InputText.model_validate(x) for x in input_data]
-            else:
-                return [InputText.model_validate(input_data)]
-        except json.JSONDecodeError:
-            raise ValueError('Invalid JSON string')
+            if is_array:
+                return input_texts_adapter.validate_json(input_data)
+            return [InputText.model_validate_json(input_data)]
+        except ValidationError as e:
+            if any(x['type'] == 'json_invalid' for x in e.errors()):
+                raise ValueError('Invalid JSON string')
+            if not is_array or self.strict:
+                raise
+        input_texts = []
+        for i, item in enumerate(json.loads(input_data)):
+            try:
+                input_texts.append(InputText.model_validate(item))
+            except ValidationError as e:
+                self._record_error(source, i, e)
+        return input_texts
+
+
+    def _iter_parse_jsonl(self, lines: Iterable[Union[str, bytes]], source: Optional[str] = None) -> Iterator[InputText]:
+        '''
+        Parses JSON Lines with one input text per line, validating line by line so only one record is held at a time.
+        Empty lines are ignored.
+        '''
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                yield InputText.model_validate_json(line)
+            except ValidationError as e:
+                self._record_error(source, line_number, e)
         
 
-    def _parse_markdown(self, input_string: str) -> list[InputText]:
+    def _iter_parse_markdown(self, lines: Iterable[str]) -> Iterator[InputText]:
         '''
-        Parses input data from a markdown string.
+        Parses markdown line by line, e.g. straight from a file handle, so large files are never held in memory at once.
+        Every "# " headline (or setext headline underlined with ===) starts a new input text, "## " headlines
+        (or setext headlines underlined with ---) are the subheadline of the following paragraph, and paragraphs
+        are separated by blank lines. Fenced code blocks are kept as they are in a paragraph of their own.
         '''
         headline = None
         paragraphs = []
-        current_subheadline = None
-        current_text = []
-        for line in input_string.splitlines():
-            if line.startswith('# '):
-                headline = line[2:].strip()
-            elif line.startswith('## '):
-                if current_text:
-                    paragraphs.append(
-                        Paragraph(
-                            subheadline=current_subheadline,
-                            text='\n'.join(current_text).strip()
-                        )
-                    )
-                    current_text = []
-                current_subheadline = line[3:].strip()
-            elif line.strip() == '':
-                if current_text:
-                    paragraphs.append(
-                        Paragraph(
-                            subheadline=current_subheadline,
-                            text='\n'.join(current_text).strip()
-                        )
-                    )
-                    current_text = []
-                    current_subheadline = None
+        subheadline = None
+        current = []
+        fence = None
+
+        def flush():
+            nonlocal subheadline
+            if current:
+                # Validating in pydantic-core is faster than model_construct(), which fills the defaults in Python
+                paragraphs.append(Paragraph(subheadline=subheadline, text='\n'.join(current).strip()))
+                current.clear()
+                subheadline = None
+
+        def document():
+            return InputText.model_construct(metadata=InputTextMetadata(), headline=headline, teaser=None, body=list(paragraphs))
+
+        for line in lines:
+            line = line.rstrip('\r\n')
+            stripped = line.strip()
+            if fence is None:
+                # Fast paths for the most common lines: blank lines end a paragraph, and only lines starting with one
+                # of the markup characters can be anything else than paragraph text
+                if not stripped:
+                    if current:
+                        flush()
+                    continue
+                if stripped[0] not in _markup_chars:
+                    current.append(line)
+                    continue
             else:
-                current_text.append(line)
-        # Add any remaining text as a paragraph
-        if current_text:
-            paragraphs.append(
-                Paragraph(
-                    subheadline=current_subheadline,
-                    text='\n'.join(current_text).strip()
-                )
-            )
-        return [
-            InputText(
-                metadata=InputTextMetadata(),
-                headline=headline,
-                body=paragraphs
-            )
-        ]
-    
+                current.append(line)
+                if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                    fence = None
+                    flush()
+                continue
+            if stripped.startswith(('```', '~~~')) and len(line) - len(line.lstrip(' ')) < 4:
+                flush()
+                fence = stripped[:len(stripped) - len(stripped.lstrip(stripped[0]))]
+                current.append(line)
+                continue
+            setext = None
+            if stripped and not stripped.strip('='):
+                setext = '='
+            elif stripped and not stripped.strip('-'):
+                setext = '-'
+            if line.startswith('# ') or setext == '=' and current:
+                if setext:
+                    title = ' '.join(x.strip() for x in current)
+                    current.clear()
+                else:
+                    title = line[2:].strip()
+                flush()
+                # Every headline starts a new input text. Text before the first headline becomes an input text of its own
+                if headline is not None or paragraphs:
+                    yield document()
+                    paragraphs.clear()
+                    subheadline = None
+                headline = title
+            elif line.startswith('## ') or setext == '-' and current:
+                if setext:
+                    title = ' '.join(x.strip() for x in current)
+                    current.clear()
+                else:
+                    title = line[3:].strip()
+                flush()
+                subheadline = title
+            elif stripped == '' or _is_thematic_break(stripped):
+                # Blank lines and thematic breaks like --- or *** end a paragraph
+                flush()
+            else:
+                current.append(line)
+        flush()
+        yield document()
+
+
+    def _parse_markdown(self, input_string: str) -> list[InputText]:
+        '''
+        Parses input data from a markdown string. See _iter_parse_markdown().
+        '''
+        return list(self._iter_parse_markdown(io.StringIO(input_string)))
+
 
     def _parse_text(self, input_string: str) -> list[InputText]:
         '''
@@ -87,36 +209,141 @@ class InputParser:
         ]
 
 
-    def parse(self, file_path: str) -> list[InputText]:
+    def _iter_file(self, file_path: str) -> Iterator[InputText]:
         '''
-        Runs the input parser based on the input type.
-
-        Args:
-            - file_path: The path to the input file. Either a file or a directory.
+        Reads and parses a single file based on its extension. JSON files are read as bytes and validated directly.
         '''
-        if os.path.isfile(file_path):
+        extension = os.path.splitext(file_path)[1]
+        if extension == '.jsonl':
+            with open(file_path, 'rb') as file:
+                yield from self._iter_parse_jsonl(file, file_path)
+        elif extension == '.json':
+            with open(file_path, 'rb') as file:
+                yield from self._parse_json(file.read(), file_path)
+        elif extension == '.md':
             with open(file_path, 'r', encoding='utf-8') as file:
-                if file_path.endswith('.json'):
-                    return self._parse_json(file.read())
-                elif file_path.endswith('.md'):
-                    return self._parse_markdown(file.read())
-                elif file_path.endswith('.txt'):
-                    return self._parse_text(file.read())
-                else:
-                    raise ValueError('Unsupported file type')
+                yield from self._iter_parse_markdown(file)
+        elif extension == '.txt':
+            with open(file_path, 'r', encoding='utf-8') as file:
+                yield from self._parse_text(file.read())
         else:
-            input_texts = []
-            for entry in os.listdir(file_path):
-                full_path = os.path.join(file_path, entry)
-                if not os.path.isfile(full_path):
-                    continue
-                with open(full_path, 'r', encoding='utf-8') as file:
-                    if entry.endswith('.json'):
-                        input_texts.extend(self._parse_json(file.read()))
-                    elif entry.endswith('.md'):
-                        input_texts.extend(self._parse_markdown(file.read()))
-                    elif entry.endswith('.txt'):
-                        input_texts.extend(self._parse_text(file.read()))
-                    else:
-                        continue
+            raise ValueError('Unsupported file type')
+
+
+    def _fill_counts(self, input_texts: list[InputText]):
+        if self.tokenizer is not None:
+            with metrics.span('count_tokens'):
+                self.tokenizer.fill_counts(input_texts)
+
+
+    def _parse_file(self, file_path: str) -> list[InputText]:
+        '''
+        Parses a single file, using the cache if one is set.
+        '''
+        if self.cache is None:
+            with metrics.span('parse'):
+                input_texts = list(self._iter_file(file_path))
+            self._fill_counts(input_texts)
             return input_texts
+        stat = os.stat(file_path)
+        # Token counts depend on the encoding, so they are only reused with the same one
+        version = f'{PARSER_VERSION}:{self.tokenizer.key}' if self.tokenizer is not None else str(PARSER_VERSION)
+        input_texts = self.cache.get(file_path, stat, version)
+        metrics.inc('input_cache', result='miss' if input_texts is None else 'hit')
+        if input_texts is None:
+            with metrics.span('parse'):
+                input_texts = list(self._iter_file(file_path))
+            self._fill_counts(input_texts)
+            # Files with invalid records are not cached, so their errors are reported again in the next session
+            if not any(x.source == file_path for x in self.errors):
+                self.cache.set(file_path, stat, version, input_texts)
+        return input_texts
+
+
+    def _walk(self, dir_path: str, include: Optional[list[str]], exclude: Optional[list[str]]) -> Iterator[str]:
+        '''
+        Yields the paths of all supported files below a directory in a stable order: the files of every directory
+        sorted by name, followed by its sorted subdirectories.
+        Directories matching an exclude pattern are skipped entirely.
+        '''
+        for root, dirs, files in os.walk(dir_path):
+            rel_root = os.path.relpath(root, dir_path)
+            rel_root = '' if rel_root == '.' else rel_root.replace(os.sep, '/') + '/'
+            dirs[:] = sorted(x for x in dirs if not (exclude and _matches(rel_root + x, exclude)))
+            for name in sorted(files):
+                rel_path = rel_root + name
+                if os.path.splitext(name)[1] not in SUPPORTED_EXTENSIONS:
+                    continue
+                if include and not _matches(rel_path, include):
+                    continue
+                if exclude and _matches(rel_path, exclude):
+                    continue
+                yield os.path.join(root, name)
+
+
+    def iter_parse(
+        self,
+        file_path: str,
+        include: Optional[list[str]] = None,
+        exclude: Optional[list[str]] = None,
+        max_workers: int = 8
+    ) -> Iterator[InputText]:
+        '''
+        Parses a file or all supported files below a directory and yields the input texts one by one.
+        Files are read and parsed on a thread pool, but the input texts are always yielded in the stable order of the
+        file paths (see _walk()), as soon as all files before them are done.
+
+        Args:
+            - file_path: The path to the input file or directory.
+            - include: Glob patterns (e.g. '*.md' or '2024/*') a file has to match to be parsed. Patterns without a '/'
+              are matched against the file name, others against the path relative to the directory.
+            - exclude: Glob patterns of files and directories to skip.
+            - max_workers: The number of threads that read and parse files.
+        '''
+        if os.path.isfile(file_path):
+            if self.cache is not None:
+                yield from self._parse_file(file_path)
+                return
+            for input_text in self._iter_file(file_path):
+                self._fill_counts([input_text])
+                yield input_text
+            return
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        pending = deque()
+        try:
+            for path in self._walk(file_path, include, exclude):
+                pending.append(executor.submit(self._parse_file, path))
+                # Parse ahead only a few files per worker, so memory stays bounded when the consumer is slow
+                if len(pending) >= max_workers * 4:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def parse(
+        self,
+        file_path: str,
+        include: Optional[list[str]] = None,
+        exclude: Optional[list[str]] = None
+    ) -> list[InputText]:
+        '''
+        Runs the input parser based on the input type. Directories are searched recursively, see iter_parse().
+
+        Args:
+            - file_path: The path to the input file. Either a file or a directory.
+            - include: Glob patterns of files to parse in a directory.
+            - exclude: Glob patterns of files and directories to skip in a directory.
+        '''
+        return list(self.iter_parse(file_path, include, exclude))
+
+
+def _is_thematic_break(stripped: str) -> bool:
+    compact = stripped.replace(' ', '')
+    return len(compact) >= 3 and compact[0] in '*-_' and not compact.strip(compact[0])
+
+
+def _matches(rel_path: str, patterns: list[str]) -> bool:
+    name = rel_path.rsplit('/', 1)[-1]
+    return any(fnmatch(rel_path, x) if '/' in x else fnmatch(name, x) for x in patterns)
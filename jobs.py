@@ -0,0 +1,212 @@
+import asyncio, os, sqlite3, threading, time, uuid
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from pydantic import BaseModel
+from typing import Any, Awaitable, Callable, Dict, Optional, Type
+
+
+# The id of the job the current task is running, for handlers that need it
+current_job_id: ContextVar[Optional[str]] = ContextVar('current_job_id', default=None)
+
+
+class JobStore():
+    '''
+    Keeps the state of jobs in a local SQLite file, so submitted jobs survive a restart of the API.
+    A job is either queued, running, done or failed. Jobs submitted with profiling also have a profiling state:
+    requested, profiled or skipped (another profiling session was active when the job ran).
+    '''
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, request TEXT NOT NULL, '
+            'result TEXT, error TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL, profile TEXT)'
+        )
+        # Job files of older versions don't have the profiling state yet
+        if 'profile' not in [x['name'] for x in self._db.execute('PRAGMA table_info(jobs)')]:
+            self._db.execute('ALTER TABLE jobs ADD COLUMN profile TEXT')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)')
+        self._db.commit()
+
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            self._db.commit()
+            return cursor.fetchall()
+
+
+    def create(self, kind: str, request: str, profile: Optional[str] = None) -> str:
+        job_id = uuid.uuid4().hex
+        self._execute(
+            'INSERT INTO jobs (id, kind, status, request, created_at, profile) VALUES (?, ?, ?, ?, ?, ?)',
+            (job_id, kind, 'queued', request, time.time(), profile)
+        )
+        return job_id
+
+
+    def get(self, job_id: str) -> Optional[dict]:
+        rows = self._execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        return dict(rows[0]) if rows else None
+
+
+    def mark_running(self, job_id: str):
+        self._execute('UPDATE jobs SET status = ?, started_at = ? WHERE id = ?', ('running', time.time(), job_id))
+
+
+    def mark_done(self, job_id: str, result: str):
+        self._execute('UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?', ('done', result, time.time(), job_id))
+
+
+    def mark_failed(self, job_id: str, error: str):
+        self._execute('UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?', ('failed', error, time.time(), job_id))
+
+
+    def set_profile(self, job_id: str, profile: str):
+        self._execute('UPDATE jobs SET profile = ? WHERE id = ?', (profile, job_id))
+
+
+    def unfinished(self) -> list:
+        '''
+        Returns the ids of jobs that were queued or running when the process stopped, oldest first.
+        '''
+        rows = self._execute("SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at")
+        return [x['id'] for x in rows]
+
+
+    def close(self):
+        self._db.close()
+
+
+class JobQueue():
+    '''
+    In-process job queue with a bounded pool of worker tasks.
+    Job kinds are registered with a handler and the request model the handler expects. Handlers can limit how many
+    runs of one agent happen at the same time with limit(), independently of the number of workers.
+
+    Args:
+        - store: Where the job state is kept.
+        - num_workers: The number of jobs that are processed at the same time.
+        - agent_limits: Maximum number of concurrent runs per agent name, see limit().
+    '''
+    def __init__(
+        self,
+        store: JobStore,
+        num_workers: int = 4,
+        agent_limits: Optional[Dict[str, int]] = None
+    ):
+        self.store = store
+        self.num_workers = num_workers
+        self.agent_limits = agent_limits or {}
+        self._handlers: Dict[str, tuple] = {}
+        self._semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.agent_limits.items()}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers = []
+
+
+    def register(self, kind: str, request_model: Type[BaseModel], handler: Callable[[Any], Awaitable[BaseModel]]):
+        '''
+        Registers the handler for a job kind. The handler gets the validated request and returns a pydantic model.
+        '''
+        self._handlers[kind] = (request_model, handler)
+
+
+    def semaphore(self, agent_name: str) -> Optional[asyncio.Semaphore]:
+        '''
+        Returns the semaphore behind limit() for an agent, e.g. to limit every run of a pipeline that runs an agent
+        several times concurrently. None if the agent has no limit.
+        '''
+        return self._semaphores.get(agent_name)
+
+
+    @asynccontextmanager
+    async def limit(self, agent_name: str):
+        '''
+        Waits until the agent is below its concurrency limit. Agents without a limit are not restricted.
+        '''
+        semaphore = self.semaphore(agent_name)
+        if semaphore is None:
+            yield
+        else:
+            async with semaphore:
+                yield
+
+
+    async def start(self):
+        '''
+        Starts the workers and requeues the jobs that didn't finish before the last shutdown.
+        '''
+        self._queue = asyncio.Queue()
+        for job_id in self.store.unfinished():
+            self._queue.put_nowait(job_id)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.num_workers)]
+
+
+    async def stop(self):
+        '''
+        Stops the workers. Jobs that are still running are requeued on the next start.
+        '''
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+    def submit(self, kind: str, request: BaseModel, profile: bool = False) -> str:
+        '''
+        Stores a new job and puts it into the queue. Returns the job id.
+        With profile, the job is stored with the profiling state requested for its handler.
+        '''
+        if kind not in self._handlers:
+            raise ValueError(f'Unknown job kind: {kind}')
+        job_id = self.store.create(kind, request.model_dump_json(), 'requested' if profile else None)
+        self._queue.put_nowait(job_id)
+        return job_id
+
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            finally:
+                self._queue.task_done()
+
+
+    async def _run(self, job_id: str):
+        job = self.store.get(job_id)
+        if job is None or job['status'] in ('done', 'failed'):
+            return
+        self.store.mark_running(job_id)
+        token = current_job_id.set(job_id)
+        try:
+            request_model, handler = self._handlers[job['kind']]
+            result = await handler(request_model.model_validate_json(job['request']))
+            self.store.mark_done(job_id, result.model_dump_json())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.store.mark_failed(job_id, f'{type(e).__name__}: {e}')
+        finally:
+            # The worker runs the next job in the same context
+            current_job_id.reset(token)
+
+
+def job_status(job: dict) -> dict:
+    '''
+    The public view of a job without its request and result.
+    '''
+    return {
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+        'profile': job['profile']
+    }
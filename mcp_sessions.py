@@ -0,0 +1,264 @@
+import asyncio
+from contextlib import asynccontextmanager, AsyncExitStack
+from pydantic_ai.mcp import MCPServer, MCPServerStreamableHTTP, MCPServerStdio, MCPServerSSE
+from typing import AsyncIterator, Dict, List, Optional
+from schemas import MCPServerConfig
+
+
+def build_mcp_server(server_config: MCPServerConfig) -> MCPServer:
+    '''
+    Builds a single MCP server from a server configuration.
+    '''
+    if server_config.transport == 'http':
+        return MCPServerStreamableHTTP(server_config.connection)
+    elif server_config.transport == 'stdio':
+        return MCPServerStdio(server_config.connection[0], server_config.connection[1], server_config.env)
+    else:
+        return MCPServerSSE(url=server_config.connection)
+
+
+def server_config_key(server_config: MCPServerConfig) -> str:
+    '''
+    Returns the key identical server configurations share in the registry.
+    '''
+    return server_config.model_dump_json()
+
+
+class _SupervisedServer():
+    '''
+    Owns the lifetime of one running MCP server. The server is started by a supervisor task which
+    health-checks it periodically and restarts it if it stops responding. Entering and exiting the
+    server happens in that task only, which the anyio task groups used by the MCP client require.
+    '''
+    def __init__(
+        self,
+        server_config: MCPServerConfig,
+        health_check_interval: Optional[float],
+        health_check_timeout: float,
+        restart_delay: float
+    ):
+        self.server_config = server_config
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.restart_delay = restart_delay
+        self.restarts = 0
+        self.server: Optional[MCPServer] = None
+        self.error: Optional[BaseException] = None
+        self._leases = 0
+        self._ready = asyncio.Event()
+        self._wake = asyncio.Event()
+        self._released = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+
+    def start(self):
+        '''
+        Starts the supervisor task. This is a no-op if it is already running.
+        '''
+        if self._task is None:
+            self._task = asyncio.create_task(self._supervise())
+
+
+    async def close(self):
+        '''
+        Stops the server once the runs currently using it have finished.
+        '''
+        self._closing = True
+        self._wake.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[MCPServer]:
+        '''
+        Hands out the running server for the duration of one agent run. Waits while the server is (re)starting.
+        '''
+        await self._ready.wait()
+        server = self.server
+        if server is None:
+            raise RuntimeError(f'MCP server {self.server_config.connection} is not available: {self.error}')
+        self._leases += 1
+        try:
+            yield server
+        finally:
+            self._leases -= 1
+            async with self._released:
+                self._released.notify_all()
+
+
+    async def _is_healthy(self, server: MCPServer) -> bool:
+        '''
+        Checks if a server still answers a tools/list request within the health check timeout.
+        '''
+        try:
+            await asyncio.wait_for(server.list_tools(), timeout=self.health_check_timeout)
+            return True
+        except Exception:
+            return False
+
+
+    async def _wait_for_wake(self, timeout: Optional[float]) -> bool:
+        '''
+        Sleeps until the server is closed or the timeout expires. Returns True if woken up.
+        '''
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+    async def _supervise(self):
+        while not self._closing:
+            server = build_mcp_server(self.server_config)
+            try:
+                async with server:
+                    self.server = server
+                    self.error = None
+                    self._ready.set()
+                    while not self._closing:
+                        if await self._wait_for_wake(self.health_check_interval):
+                            continue
+                        if not await self._is_healthy(server):
+                            break
+                    # Block new leases and let the runs still using this server finish first
+                    self._ready.clear()
+                    async with self._released:
+                        await self._released.wait_for(lambda: self._leases == 0)
+                    self.server = None
+            except Exception as e:
+                self.error = e
+                self.server = None
+                # Wake up waiting runs so they fail instead of hanging on a server that won't start
+                self._ready.set()
+            if self._closing:
+                break
+            self.restarts += 1
+            await self._wait_for_wake(self.restart_delay)
+            self._ready.clear()
+        self.server = None
+        self._ready.set()
+
+
+class MCPServerRegistry():
+    '''
+    Process-wide registry of running MCP servers. Servers are keyed by their configuration, so all agents
+    asking for the same configuration share one reference-counted server. A server is shut down when the
+    last agent using it releases it.
+    '''
+    def __init__(
+        self,
+        health_check_interval: Optional[float] = 30.0,
+        health_check_timeout: float = 10.0,
+        restart_delay: float = 1.0
+    ):
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.restart_delay = restart_delay
+        self._servers: Dict[str, _SupervisedServer] = {}
+        self._refcounts: Dict[str, int] = {}
+
+
+    def __len__(self) -> int:
+        return len(self._servers)
+
+
+    def stats(self) -> Dict[str, dict]:
+        '''
+        Returns reference counts, restarts and last errors per registered server.
+        '''
+        return {
+            key: {
+                'refcount': self._refcounts[key],
+                'running': server.server is not None,
+                'restarts': server.restarts,
+                'error': str(server.error) if server.error else None
+            }
+            for key, server in self._servers.items()
+        }
+
+
+    def acquire(self, server_config: MCPServerConfig) -> _SupervisedServer:
+        '''
+        Returns the shared server for a configuration and starts it if it isn't running yet.
+        '''
+        key = server_config_key(server_config)
+        if key not in self._servers:
+            self._servers[key] = _SupervisedServer(
+                server_config,
+                health_check_interval=self.health_check_interval,
+                health_check_timeout=self.health_check_timeout,
+                restart_delay=self.restart_delay
+            )
+            self._refcounts[key] = 0
+        self._refcounts[key] += 1
+        self._servers[key].start()
+        return self._servers[key]
+
+
+    async def release(self, server_config: MCPServerConfig):
+        '''
+        Drops one reference to a server and shuts it down if it was the last one.
+        '''
+        key = server_config_key(server_config)
+        if key not in self._servers:
+            return
+        self._refcounts[key] -= 1
+        if self._refcounts[key] == 0:
+            server = self._servers.pop(key)
+            del self._refcounts[key]
+            await server.close()
+
+
+# Shared by all agents in this process unless an agent is given its own registry
+mcp_server_registry = MCPServerRegistry()
+
+
+class MCPSessionManager():
+    '''
+    Keeps the MCP servers of an agent running across runs instead of starting them for every run.
+    The servers themselves live in an MCPServerRegistry, so agents with the same server configurations
+    share them. Any number of concurrent runs can lease the running servers through session().
+    '''
+    def __init__(
+        self,
+        server_configs: List[MCPServerConfig],
+        registry: Optional[MCPServerRegistry] = None
+    ):
+        self.server_configs = server_configs
+        self.registry = registry if registry is not None else mcp_server_registry
+        self._servers: List[_SupervisedServer] = []
+        self._closed = False
+
+
+    def start(self):
+        '''
+        Acquires the servers from the registry. This is a no-op if the manager is already running.
+        '''
+        if self._closed:
+            raise RuntimeError('MCPSessionManager has been closed')
+        if not self._servers:
+            self._servers = [self.registry.acquire(x) for x in self.server_configs]
+
+
+    async def close(self):
+        '''
+        Releases the servers. They are shut down once no other agent uses them.
+        '''
+        self._closed = True
+        servers, self._servers = self._servers, []
+        for server in servers:
+            await self.registry.release(server.server_config)
+
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[List[MCPServer]]:
+        '''
+        Leases the running servers for the duration of one agent run. Starts the servers on first use
+        and waits for servers that are currently being restarted.
+        '''
+        self.start()
+        async with AsyncExitStack() as stack:
+            yield [await stack.enter_async_context(x.lease()) for x in self._servers]
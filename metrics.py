@@ -0,0 +1,247 @@
+import bisect, threading, time
+import profiling
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pydantic_ai import Agent
+from pydantic_ai.messages import ToolCallPart
+from pydantic_ai.usage import Usage
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+
+# Upper bounds of the latency buckets in seconds, from parsing a small file to a long model run
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# Names of the output tools PydanticAI adds for structured outputs ('final_result' or 'final_result_<type>')
+OUTPUT_TOOL_PREFIX = 'final_result'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra is not None else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+class Histogram():
+    '''
+    Counts observations in cumulative buckets like a Prometheus histogram, and keeps their sum and maximum.
+    '''
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+    def quantile(self, q: float) -> float:
+        '''
+        Estimates a quantile by interpolating linearly within its bucket, like histogram_quantile() in Prometheus.
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+
+class MetricsRegistry():
+    '''
+    Collects local metrics of this process: counters and latency histograms, both with labels.
+    They can be rendered in the Prometheus text format or as a summary table. Thread-safe, since input files are
+    parsed on a thread pool.
+    '''
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._lock = threading.Lock()
+
+
+    def inc(self, name: str, value: float = 1, **labels):
+        '''
+        Increases a counter, e.g. inc('tokens', 120, agent='WriterAgent', direction='input').
+        '''
+        key = _labels(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+
+    def observe(self, name: str, seconds: float, **labels):
+        '''
+        Adds a latency to a histogram.
+        '''
+        key = _labels(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(self.buckets)
+            series[key].observe(seconds)
+
+
+    @contextmanager
+    def span(self, stage: str, **labels) -> Iterator[None]:
+        '''
+        Measures the duration of a stage, e.g. with metrics.span('parse'): ... The duration is added to the
+        stage_seconds histogram, also if the stage fails. Works around awaits as well.
+        While a profiling session is running (see profiling.py), the stage is profiled as well.
+        '''
+        session = profiling.active_session
+        if session is not None:
+            session.enter(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+            if session is not None:
+                session.exit(stage)
+
+
+    def total(self, name: str, **labels) -> float:
+        '''
+        Returns the sum of a counter over all series with the given labels, e.g. total('tokens', direction='input').
+        '''
+        wanted = set(_labels(labels))
+        with self._lock:
+            return sum(value for key, value in self.counters.get(name, {}).items() if wanted <= set(key))
+
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+
+    def render_prometheus(self, prefix: str = 'writer_agent_') -> str:
+        '''
+        Renders all metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# TYPE {prefix}{name}_total counter')
+                for labels, value in sorted(series.items()):
+                    lines.append(f'{prefix}{name}_total{_format_labels(labels)} {value:g}')
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {prefix}{name} histogram')
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        le = bound if isinstance(bound, str) else f'{bound:g}'
+                        lines.append(f'{prefix}{name}_bucket{_format_labels(labels, ("le", le))} {cumulative}')
+                    lines.append(f'{prefix}{name}_sum{_format_labels(labels)} {histogram.sum:.6f}')
+                    lines.append(f'{prefix}{name}_count{_format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+    def summary(self) -> str:
+        '''
+        Renders the histograms and counters as a table for the console. p50 and p95 are estimated from the buckets.
+        '''
+        rows: List[str] = []
+        with self._lock:
+            histograms = [(name, labels, h) for name, series in sorted(self.histograms.items()) for labels, h in sorted(series.items())]
+            counters = [(name, labels, v) for name, series in sorted(self.counters.items()) for labels, v in sorted(series.items())]
+        if histograms:
+            rows.append(f'{"latency":<56} {"count":>7} {"total s":>9} {"mean ms":>9} {"p50 ms":>9} {"p95 ms":>9} {"max ms":>9}')
+            for name, labels, h in histograms:
+                if name == 'stage_seconds':
+                    # The stage first, then the other labels like the agent
+                    label = ' '.join([dict(labels)['stage']] + [value for key, value in labels if key != 'stage'])
+                else:
+                    label = f'{name} {_format_labels(labels)}'
+                rows.append(
+                    f'{label:<56} {h.count:>7} {h.sum:>9.2f} {h.sum / h.count * 1000:>9.1f} '
+                    f'{h.quantile(0.5) * 1000:>9.1f} {h.quantile(0.95) * 1000:>9.1f} {h.max * 1000:>9.1f}'
+                )
+        if counters:
+            rows.append(f'\n{"counter":<56} {"value":>12}' if rows else f'{"counter":<56} {"value":>12}')
+            for name, labels, value in counters:
+                rows.append(f'{name + " " + _format_labels(labels):<56} {value:>12g}')
+        return '\n'.join(rows)
+
+
+# The registry of this process. Agents, parser and retry policy report to it
+metrics = MetricsRegistry()
+
+
+_usage_scope: ContextVar[Optional[Usage]] = ContextVar('usage_scope', default=None)
+
+
+@contextmanager
+def usage_scope() -> Iterator[Usage]:
+    '''
+    Sums up the usage of all agent runs within the block, including runs in tasks started from it, e.g. to account
+    the tokens of one job among several concurrent ones. Runs answered from the response cache don't count.
+    '''
+    usage = Usage()
+    token = _usage_scope.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage_scope.reset(token)
+
+
+def cached_tokens(usage: Usage) -> int:
+    '''
+    Returns the input tokens the provider read from its prompt cache, as reported in the usage details
+    (cached_tokens by OpenAI, cache_read_input_tokens by Anthropic). They are part of the input tokens.
+    '''
+    details = usage.details or {}
+    return details.get('cached_tokens', 0) + details.get('cache_read_input_tokens', 0)
+
+
+def record_usage(agent: str, usage: Usage):
+    '''
+    Adds the token usage of a model run (of an AgentRunResult) to the token counters and the current usage_scope().
+    '''
+    scope = _usage_scope.get()
+    if scope is not None:
+        scope.incr(usage)
+    metrics.inc('model_requests', usage.requests or 0, agent=agent)
+    metrics.inc('tokens', usage.request_tokens or 0, agent=agent, direction='input')
+    metrics.inc('tokens', usage.response_tokens or 0, agent=agent, direction='output')
+    metrics.inc('cached_tokens', cached_tokens(usage), agent=agent)
+
+
+async def run_instrumented(agent: Agent, prompt: Union[str, List[str]], agent_name: str, toolsets=None):
+    '''
+    Runs a PydanticAI agent node by node, so the time spent waiting for the model, calling (MCP) tools and
+    validating the output are measured separately. Returns the AgentRunResult like Agent.run().
+    '''
+    async with agent.iter(prompt, toolsets=toolsets) as agent_run:
+        node = agent_run.next_node
+        while not Agent.is_end_node(node):
+            if Agent.is_model_request_node(node):
+                stage = 'model'
+            elif Agent.is_call_tools_node(node):
+                tool_calls = [x for x in node.model_response.parts if isinstance(x, ToolCallPart) and not x.tool_name.startswith(OUTPUT_TOOL_PREFIX)]
+                stage = 'tool_calls' if tool_calls else 'output_validation'
+                if tool_calls:
+                    metrics.inc('tool_calls', len(tool_calls), agent=agent_name)
+            else:
+                stage = 'prepare'
+            with metrics.span(stage, agent=agent_name):
+                node = await agent_run.next(node)
+    return agent_run.result
@@ -0,0 +1,81 @@
+import hashlib, json, os, sqlite3, threading, time
+from typing import List, Optional
+from schemas import Outline
+
+
+class OutlineStore():
+    '''
+    Keeps created outlines in a local SQLite file, so texts can be written from them again without creating the
+    outline again, e.g. to retry only the writing step or to write more variants later.
+    Outlines are addressed by a short id. By default the id is derived from the content, so saving the same
+    outline twice returns the same id.
+
+    Args:
+        - db_path: Path to the SQLite file.
+    '''
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS outlines ('
+            'id TEXT PRIMARY KEY, outline TEXT NOT NULL, user_prompt TEXT, sources TEXT, created_at REAL NOT NULL)'
+        )
+        self._db.commit()
+
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            self._db.commit()
+            return cursor.fetchall()
+
+
+    @staticmethod
+    def make_id(outline: Outline) -> str:
+        return hashlib.sha256(outline.model_dump_json().encode('utf-8')).hexdigest()[:12]
+
+
+    def save(self, outline: Outline, user_prompt: Optional[str] = None, sources: Optional[List[str]] = None, outline_id: Optional[str] = None) -> str:
+        '''
+        Stores an outline with the prompt and the sources of the input texts it was created from. Returns its id.
+
+        Args:
+            - outline: The outline.
+            - user_prompt: The prompt the outline was created with.
+            - sources: The sources of the input texts.
+            - outline_id: The id to store the outline under, e.g. the id of the job that created it.
+        '''
+        outline_id = outline_id or self.make_id(outline)
+        self._execute(
+            'INSERT OR REPLACE INTO outlines (id, outline, user_prompt, sources, created_at) VALUES (?, ?, ?, ?, ?)',
+            (outline_id, outline.model_dump_json(), user_prompt, json.dumps(sources) if sources is not None else None, time.time())
+        )
+        return outline_id
+
+
+    def get(self, outline_id: str) -> Optional[Outline]:
+        rows = self._execute('SELECT outline FROM outlines WHERE id = ?', (outline_id,))
+        return Outline.model_validate_json(rows[0]['outline']) if rows else None
+
+
+    def recent(self, limit: int = 10) -> List[dict]:
+        '''
+        Returns the id, prompt, number of paragraphs and creation time of the latest outlines, newest first.
+        '''
+        rows = self._execute('SELECT id, outline, user_prompt, created_at FROM outlines ORDER BY created_at DESC LIMIT ?', (limit,))
+        return [
+            {
+                'id': x['id'],
+                'user_prompt': x['user_prompt'],
+                'paragraphs': len(json.loads(x['outline'])['paragraphs']),
+                'created_at': x['created_at']
+            }
+            for x in rows
+        ]
+
+
+    def close(self):
+        self._db.close()
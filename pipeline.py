@@ -0,0 +1,324 @@
+import asyncio
+from typing import AsyncIterator, Dict, List, Optional
+from schemas import InputText, InputTextMetadata, Outline, OutputText, OutputVariants, WriterVariant
+from outline_agent import OutlineAgent
+from writer_agent import WriterAgent
+from tokenizer import count_tokens
+
+
+reduce_user_prompt = '''The input texts are partial outlines. Each of them was created from a different part of a larger set of input texts that was too large to be processed at once. Merge them into one outline that contains all of their information without repeating yourself. This was the original request for the outline:
+
+{user_prompt}'''
+
+
+class MapReducePipeline():
+    '''
+    Creates outlines and texts from input sets that are larger than the context window of the model.
+    The input texts are packed into chunks of at most max_chunk_tokens tokens and the OutlineAgent outlines every chunk
+    concurrently (map). The partial outlines are then merged into one outline by further OutlineAgent runs (reduce),
+    from which the WriterAgent writes the text.
+
+    Args:
+        - outline_agent: The agent that creates the partial outlines and merges them.
+        - writer_agent: The agent that writes the text from the merged outline. Must use an outline system prompt.
+        - max_chunk_tokens: The token budget for the input texts of a single run.
+        - max_concurrency: The maximum number of outline runs at the same time.
+        - semaphore: Limits the outline runs instead of max_concurrency, e.g. shared with other users of the agent.
+    '''
+    def __init__(
+        self,
+        outline_agent: OutlineAgent,
+        writer_agent: Optional[WriterAgent] = None,
+        max_chunk_tokens: int = 50000,
+        max_concurrency: int = 4,
+        semaphore: Optional[asyncio.Semaphore] = None
+    ):
+        self.outline_agent = outline_agent
+        self.writer_agent = writer_agent
+        self.max_chunk_tokens = max_chunk_tokens
+        self.max_concurrency = max_concurrency
+        self._semaphore = semaphore or asyncio.Semaphore(max_concurrency)
+
+
+    def count_tokens(self, input_text: InputText) -> int:
+        '''
+        Counts the tokens of an input text the way it is encoded in the outline agent's prompts.
+        '''
+        return count_tokens(self.outline_agent.prompt_serializer.encode_input_texts([input_text]), self.outline_agent.model_name)
+
+
+    def _split(self, input_text: InputText) -> List[InputText]:
+        '''
+        Splits an input text that is larger than the token budget into parts along its paragraphs.
+        A single paragraph larger than the budget is kept as one part.
+        '''
+        parts = []
+        current = []
+        current_tokens = 0
+        for paragraph in input_text.body:
+            part = input_text.model_copy(update={'body': [paragraph], 'teaser': None})
+            tokens = self.count_tokens(part)
+            if current and current_tokens + tokens > self.max_chunk_tokens:
+                parts.append(current)
+                current = []
+                current_tokens = 0
+            current.append(paragraph)
+            current_tokens += tokens
+        if current:
+            parts.append(current)
+        return [
+            input_text.model_copy(update={'body': body, 'teaser': input_text.teaser if i == 0 else None})
+            for i, body in enumerate(parts)
+        ]
+
+
+    def chunk(self, input_texts: List[InputText]) -> List[List[InputText]]:
+        '''
+        Packs input texts into chunks within the token budget, keeping their order.
+        '''
+        chunks = []
+        current = []
+        current_tokens = 0
+        for input_text in input_texts:
+            tokens = self.count_tokens(input_text)
+            parts = [(input_text, tokens)] if tokens <= self.max_chunk_tokens else [(x, self.count_tokens(x)) for x in self._split(input_text)]
+            for part, part_tokens in parts:
+                if current and current_tokens + part_tokens > self.max_chunk_tokens:
+                    chunks.append(current)
+                    current = []
+                    current_tokens = 0
+                current.append(part)
+                current_tokens += part_tokens
+        if current:
+            chunks.append(current)
+        return chunks
+
+
+    async def _outline_chunk(self, input_texts: List[InputText], user_prompt: str) -> Outline:
+        async with self._semaphore:
+            result = await self.outline_agent.run(self.outline_agent._construct_user_prompt(input_texts, user_prompt))
+        return result.output
+
+
+    async def create_outline(self, input_texts: List[InputText], user_prompt: str) -> Outline:
+        '''
+        Creates one outline from the input texts. Input sets within the budget are outlined in a single run.
+        '''
+        chunks = self.chunk(input_texts)
+        if len(chunks) <= 1:
+            return await self._outline_chunk(input_texts, user_prompt)
+        outlines = await asyncio.gather(*[self._outline_chunk(x, user_prompt) for x in chunks])
+        merge_prompt = reduce_user_prompt.format(user_prompt=user_prompt)
+        while True:
+            partials = [
+                InputText(metadata=InputTextMetadata(source=f'partial outline {i}'), body=x.paragraphs)
+                for i, x in enumerate(outlines, 1)
+            ]
+            chunks = self.chunk(partials)
+            # Merge everything at once if the partial outlines fit into the budget or can't be packed any tighter
+            if len(chunks) <= 1 or len(chunks) >= len(partials):
+                return await self._outline_chunk(partials, merge_prompt)
+            outlines = await asyncio.gather(*[self._outline_chunk(x, merge_prompt) for x in chunks])
+
+
+    async def write(self, input_texts: List[InputText], outline_prompt: str, content_prompt: str) -> OutputText:
+        '''
+        Creates one outline from the input texts and writes the text from it.
+        '''
+        if self.writer_agent is None:
+            raise ValueError('MapReducePipeline needs a writer_agent to write texts')
+        outline = await self.create_outline(input_texts, outline_prompt)
+        result = await self.writer_agent.run(self.writer_agent._construct_user_prompt_from_outline(outline, content_prompt))
+        return result.output
+
+
+section_user_prompt = '''You are writing part {index} of {count} of a longer text. The other parts are written at the same time from the same outline, so only write about the outline section you were given and don't repeat the content of the other parts. {position}
+
+The whole text is structured like this:
+{overview}
+
+These are the instructions for the whole text. If they specify a length, it applies to the whole text, so your part should be roughly {share} of it:
+
+{user_prompt}'''
+
+section_positions = {
+    'first': 'Also write the headline and the teaser of the whole text. Start the text but don\'t write a conclusion.',
+    'middle': 'Leave headline and teaser empty and don\'t write an introduction or a conclusion.',
+    'last': 'Leave headline and teaser empty and don\'t write an introduction. End the whole text with your part.',
+    'only': 'Also write the headline and the teaser of the text.'
+}
+
+
+class ParallelSectionWriter():
+    '''
+    Writes a text from an outline by writing its sections concurrently instead of in one long generation.
+    Every section gets one or more paragraphs of the outline, the instructions for the whole text and an overview
+    of all sections as shared context. The sections are stitched together into one OutputText in outline order.
+
+    Args:
+        - writer_agent: The agent that writes the sections. Must use an outline system prompt.
+        - max_concurrency: The maximum number of sections written at the same time.
+        - paragraphs_per_section: How many outline paragraphs are written together as one section.
+        - semaphore: Limits the section runs instead of max_concurrency, e.g. shared with other users of the agent.
+    '''
+    def __init__(
+        self,
+        writer_agent: WriterAgent,
+        max_concurrency: int = 4,
+        paragraphs_per_section: int = 1,
+        semaphore: Optional[asyncio.Semaphore] = None
+    ):
+        self.writer_agent = writer_agent
+        self.max_concurrency = max_concurrency
+        self.paragraphs_per_section = paragraphs_per_section
+        self._semaphore = semaphore or asyncio.Semaphore(max_concurrency)
+
+
+    def sections(self, outline: Outline) -> List[Outline]:
+        '''
+        Groups the paragraphs of an outline into sections.
+        '''
+        size = max(self.paragraphs_per_section, 1)
+        return [Outline(paragraphs=outline.paragraphs[i:i + size]) for i in range(0, len(outline.paragraphs), size)]
+
+
+    def _section_prompt(self, sections: List[Outline], index: int, user_prompt: str) -> str:
+        '''
+        Builds the instructions for one section with the overview of the whole text as shared context.
+        '''
+        overview = []
+        for i, section in enumerate(sections):
+            titles = ' / '.join(x.subheadline or x.text[:80].replace('\n', ' ') for x in section.paragraphs)
+            overview.append(f'{i + 1}. {titles}' + (' <- your part' if i == index else ''))
+        if len(sections) == 1:
+            position = 'only'
+        elif index == 0:
+            position = 'first'
+        elif index == len(sections) - 1:
+            position = 'last'
+        else:
+            position = 'middle'
+        return section_user_prompt.format(
+            index=index + 1,
+            count=len(sections),
+            position=section_positions[position],
+            overview='\n'.join(overview),
+            share=f'1/{len(sections)}',
+            user_prompt=user_prompt
+        )
+
+
+    async def _write_section(self, sections: List[Outline], index: int, user_prompt: str) -> OutputText:
+        full_user_prompt = self.writer_agent._construct_user_prompt_from_outline(
+            sections[index],
+            self._section_prompt(sections, index, user_prompt)
+        )
+        async with self._semaphore:
+            result = await self.writer_agent.run(full_user_prompt)
+        return result.output
+
+
+    async def write_stream(self, outline: Outline, user_prompt: str) -> AsyncIterator[OutputText]:
+        '''
+        Writes all sections concurrently and yields the text written so far each time the next section in order
+        is done. The last item is the complete text.
+        '''
+        sections = self.sections(outline)
+        tasks = [asyncio.ensure_future(self._write_section(sections, i, user_prompt)) for i in range(len(sections))]
+        output = OutputText(body=[])
+        try:
+            for i, task in enumerate(tasks):
+                section = await task
+                output = OutputText(
+                    headline=section.headline if i == 0 else output.headline,
+                    teaser=section.teaser if i == 0 else output.teaser,
+                    body=output.body + section.body
+                )
+                yield output
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+    async def write(self, outline: Outline, user_prompt: str) -> OutputText:
+        '''
+        Writes all sections concurrently and returns the stitched text.
+        '''
+        output = OutputText(body=[])
+        async for output in self.write_stream(outline, user_prompt):
+            pass
+        return output
+
+
+class VariantWriter():
+    '''
+    Writes several variants of a text from the same outline concurrently, e.g. a blog post, a newsletter and a
+    LinkedIn post. Every variant has its own user prompt and can add instructions to the system prompt. Variants
+    with additional instructions are written by their own WriterAgent with the configuration of writer_agent
+    (MCP servers, model, cache, prompt encoding and retry policy), created once per instructions.
+
+    Args:
+        - writer_agent: The agent that writes the variants without additional instructions. Must use an outline system prompt.
+        - max_concurrency: The maximum number of variants written at the same time.
+        - semaphore: Limits the variant runs instead of max_concurrency, e.g. shared with other users of the agent.
+    '''
+    def __init__(self, writer_agent: WriterAgent, max_concurrency: int = 4, semaphore: Optional[asyncio.Semaphore] = None):
+        self.writer_agent = writer_agent
+        self.max_concurrency = max_concurrency
+        self._semaphore = semaphore or asyncio.Semaphore(max_concurrency)
+        self._agents: Dict[str, WriterAgent] = {}
+
+
+    def agent(self, variant: WriterVariant) -> WriterAgent:
+        '''
+        Returns the agent that writes a variant.
+        '''
+        if not variant.system_prompt:
+            return self.writer_agent
+        if variant.system_prompt not in self._agents:
+            self._agents[variant.system_prompt] = WriterAgent(
+                server_configs=self.writer_agent.server_configs,
+                model_name=self.writer_agent.model_name,
+                system_prompt=f'{self.writer_agent.system_prompt}\n\n{variant.system_prompt}',
+                output_type=self.writer_agent.output_type,
+                cache=self.writer_agent.cache,
+                prompt_encoding=self.writer_agent.prompt_serializer.encoding,
+                prompt_layout=self.writer_agent.prompt_serializer.layout,
+                retry_policy=self.writer_agent.retry_policy
+            )
+        return self._agents[variant.system_prompt]
+
+
+    async def _write_variant(self, outline: Outline, variant: WriterVariant) -> OutputText:
+        agent = self.agent(variant)
+        async with self._semaphore:
+            result = await agent.run(agent._construct_user_prompt_from_outline(outline, variant.user_prompt))
+        return result.output
+
+
+    async def write(self, outline: Outline, variants: List[WriterVariant]) -> OutputVariants:
+        '''
+        Writes all variants concurrently and returns them by name. A failed variant doesn't stop the others,
+        its error is returned instead.
+        '''
+        results = await asyncio.gather(*[self._write_variant(outline, x) for x in variants], return_exceptions=True)
+        outputs = {}
+        errors = {}
+        for variant, result in zip(variants, results):
+            if isinstance(result, Exception):
+                errors[variant.name] = f'{type(result).__name__}: {result}'
+            elif isinstance(result, BaseException):
+                # Cancellation
+                raise result
+            else:
+                outputs[variant.name] = result
+        return OutputVariants(outputs=outputs, errors=errors)
+
+
+    async def close(self):
+        '''
+        Releases the MCP servers of the agents created for variants (async). writer_agent is not closed.
+        '''
+        for agent in self._agents.values():
+            await agent.close()
+        self._agents = {}
@@ -0,0 +1,181 @@
+import cProfile, io, os, pstats, sys, threading, time, tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+
+class ProfileSession():
+    '''
+    Profiles the stages of a run, i.e. the metrics spans (see metrics.py) like parse, prompt, mcp_session, model or
+    output_validation. Every stage gets its own cProfile profile and tracemalloc statistics, nested stages are not
+    counted in their parent. A sampling thread records the stacks of all threads for a flamegraph.
+    Only stages on the thread that started the session are profiled with cProfile, stages on worker threads
+    (e.g. parsing on the thread pool of the InputParser) only show up in the collapsed stacks. Concurrent runs in
+    the same event loop are attributed to the stage that was entered last. Taking the tracemalloc snapshots at the
+    start and end of every stage is slow, so wall times are much longer while profiling.
+    Use profile() to start a session, there is at most one at a time.
+
+    Args:
+        - output_dir: The directory the reports are written to.
+        - sample_interval: Seconds between two stack samples for the collapsed stacks.
+        - top: The number of functions and allocation sites in the reports.
+    '''
+    def __init__(self, output_dir: str, sample_interval: float = 0.005, top: int = 40):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.top = top
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self.allocations: Dict[str, Counter] = {}
+        self.allocated: Counter = Counter()
+        self.seconds: Counter = Counter()
+        self.stacks: Counter = Counter()
+        self._stack: List[tuple] = []
+        self._thread_id = threading.get_ident()
+        self._started_tracemalloc = False
+        self._stopped = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(1)
+            self._started_tracemalloc = True
+        self._sampler = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+        self._sampler.start()
+        # Everything outside of the other stages
+        self.enter('session')
+
+
+    def enter(self, stage: str):
+        if threading.get_ident() != self._thread_id:
+            return
+        if self._stack:
+            self.profiles[self._stack[-1][0]].disable()
+        snapshot = self._snapshot()
+        self._stack.append((stage, time.perf_counter(), snapshot))
+        self.profiles.setdefault(stage, cProfile.Profile()).enable()
+
+
+    def exit(self, stage: str):
+        if threading.get_ident() != self._thread_id or not self._stack:
+            return
+        self.profiles[self._stack[-1][0]].disable()
+        # With concurrent runs, stages don't always end in the order they started
+        indexes = [i for i, x in enumerate(self._stack) if x[0] == stage]
+        stage, started_at, snapshot = self._stack.pop(indexes[-1] if indexes else -1)
+        self.seconds[stage] += time.perf_counter() - started_at
+        allocations = self.allocations.setdefault(stage, Counter())
+        for diff in self._snapshot().compare_to(snapshot, 'lineno'):
+            if diff.size_diff:
+                frame = diff.traceback[0]
+                allocations[f'{frame.filename}:{frame.lineno}'] += diff.size_diff
+                self.allocated[stage] += diff.size_diff
+        if self._stack:
+            self.profiles[self._stack[-1][0]].enable()
+
+
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        # Without the allocations of the profiler itself
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, tracemalloc.__file__)
+        ))
+
+
+    def _current_stage(self) -> str:
+        stack = self._stack
+        return stack[-1][0] if stack else 'session'
+
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stopped.wait(self.sample_interval):
+            stage = self._current_stage()
+            threads = {x.ident: x.name for x in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    if code not in names:
+                        names[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+                    frames.append(names[code])
+                    frame = frame.f_back
+                frames.append(threads.get(thread_id, str(thread_id)))
+                frames.append(stage)
+                self.stacks[';'.join(reversed(frames))] += 1
+
+
+    def stop(self) -> List[str]:
+        '''
+        Stops profiling and writes the reports. Returns the paths of the written files:
+        one CPU report and one raw pstats file per stage, the allocation report and the collapsed stacks.
+        '''
+        if threading.get_ident() == self._thread_id:
+            while self._stack:
+                self.exit(self._stack[-1][0])
+        for profile in self.profiles.values():
+            profile.disable()
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        _, peak = tracemalloc.get_traced_memory()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+        os.makedirs(self.output_dir, exist_ok=True)
+        paths = []
+        for stage, profile in self.profiles.items():
+            report = io.StringIO()
+            stats = pstats.Stats(profile, stream=report)
+            report.write(f'Stage {stage}: {self.seconds[stage]:.3f}s wall time, CPU of nested stages excluded\n')
+            stats.sort_stats('cumulative').print_stats(self.top)
+            paths.append(self._write(f'{stage}.cpu.txt', report.getvalue()))
+            stats.dump_stats(os.path.join(self.output_dir, f'{stage}.prof'))
+            paths.append(os.path.join(self.output_dir, f'{stage}.prof'))
+        lines = [f'Peak traced memory: {peak / 1024 / 1024:.1f} MB', '']
+        for stage, allocations in self.allocations.items():
+            lines.append(f'Stage {stage}: {self.allocated[stage] / 1024:+.1f} KB net, nested stages included')
+            for site, size in allocations.most_common(self.top):
+                lines.append(f'  {size / 1024:+10.1f} KB  {site}')
+            lines.append('')
+        paths.append(self._write('allocations.txt', '\n'.join(lines)))
+        # The format of flamegraph.pl, speedscope and similar tools: one stack per line with its number of samples
+        paths.append(self._write('stacks.collapsed', ''.join(f'{stack} {count}\n' for stack, count in self.stacks.items())))
+        return paths
+
+
+    def _write(self, file_name: str, text: str) -> str:
+        path = os.path.join(self.output_dir, file_name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+
+# The running session. Checked by every metrics span, so profiling costs nothing while it is None
+active_session: Optional[ProfileSession] = None
+_session_lock = threading.Lock()
+
+
+@contextmanager
+def profile(output_dir: str, **kwargs) -> Iterator[Optional[ProfileSession]]:
+    '''
+    Profiles everything within the block and writes the reports to output_dir when it ends.
+    Yields None without profiling if another session is already running.
+    '''
+    global active_session
+    with _session_lock:
+        if active_session is not None:
+            session = None
+        else:
+            session = active_session = ProfileSession(output_dir, **kwargs)
+    if session is None:
+        yield None
+        return
+    session.start()
+    try:
+        yield session
+    finally:
+        active_session = None
+        session.stop()
@@ -0,0 +1,154 @@
+from pydantic import TypeAdapter
+from typing import List, Tuple, Union
+from schemas import InputText, Outline, OutputText, Paragraph, FullUserPromptInputTexts, FullUserPromptOutline, PromptEncoding, PromptLayout
+
+
+input_texts_adapter = TypeAdapter(List[InputText])
+str_adapter = TypeAdapter(str)
+
+
+def paragraphs_to_markdown(paragraphs: List[Paragraph]) -> List[str]:
+    '''
+    Renders paragraphs as markdown blocks with an optional ## subheadline each.
+    '''
+    blocks = []
+    for paragraph in paragraphs:
+        if paragraph.subheadline:
+            blocks.append(f'## {paragraph.subheadline}')
+        blocks.append(paragraph.text)
+    return blocks
+
+
+def output_to_markdown(output: Union[OutputText, Outline]) -> str:
+    '''
+    Renders an output text or an outline as a markdown file, one line per headline, teaser and paragraph.
+    '''
+    lines = []
+    if isinstance(output, OutputText):
+        if output.headline:
+            lines.append(f'# {output.headline}\n')
+        if output.teaser:
+            lines.append(f'*{output.teaser}*\n')
+    for paragraph in output.body if isinstance(output, OutputText) else output.paragraphs:
+        if paragraph.subheadline:
+            lines.append(f'## {paragraph.subheadline}\n')
+        lines.append(f'{paragraph.text}\n')
+    return ''.join(lines)
+
+
+def input_text_to_markdown(index: int, input_text: InputText) -> str:
+    '''
+    Renders one input text in the markdown-like layout described in the system prompts.
+    '''
+    blocks = [f'=== INPUT TEXT {index} ===']
+    metadata = input_text.metadata.model_dump(mode='json', exclude_none=True)
+    if metadata:
+        blocks[0] += '\n' + '; '.join(f'{key}: {value}' for key, value in metadata.items())
+    if input_text.headline:
+        blocks.append(f'# {input_text.headline}')
+    if input_text.teaser:
+        blocks.append(f'*{input_text.teaser}*')
+    blocks.extend(paragraphs_to_markdown(input_text.body))
+    return '\n\n'.join(blocks)
+
+
+class UserPromptSerializer():
+    '''
+    Serializes full user prompts into the string that is sent to the LLM, using one of three encodings:
+        - json: Indented JSON, the same as model_dump_json(indent=2).
+        - compact: JSON without whitespace and without empty or default fields.
+        - markdown: A markdown-like plain text layout without any JSON syntax.
+    The input texts block is serialized once and reused as long as the same list of input texts is passed in,
+    so loops that only change the user prompt don't serialize the whole corpus again.
+    Input texts must therefore not be modified in place after they have been passed in.
+    With the prefix layout, the input texts or the outline and the user prompt are sent as two parts of the user
+    message. The first part stays byte-identical as long as the inputs don't change, so together with the system
+    prompt it forms a prefix that providers can cache between requests (e.g. the automatic prompt caching of OpenAI).
+    '''
+    def __init__(self, encoding: PromptEncoding = 'json', layout: PromptLayout = 'combined'):
+        self.encoding = encoding
+        self.layout = layout
+        self._input_texts = None
+        self._input_texts_block = None
+
+
+    def encode_input_texts(self, input_texts: List[InputText]) -> str:
+        '''
+        Encodes a list of input texts without caching, e.g. to count the tokens of single texts.
+        '''
+        if self.encoding == 'json':
+            # JSON strings can't contain raw newlines, so indenting every line is safe
+            return input_texts_adapter.dump_json(input_texts, indent=2).decode('utf-8').replace('\n', '\n  ')
+        elif self.encoding == 'compact':
+            return input_texts_adapter.dump_json(input_texts, exclude_none=True, exclude_defaults=True).decode('utf-8')
+        return '\n\n'.join(input_text_to_markdown(i, x) for i, x in enumerate(input_texts, 1))
+
+
+    def _serialize_input_texts(self, input_texts: List[InputText]) -> str:
+        '''
+        Returns the encoded input texts, reusing the last result if the same list is passed in again.
+        '''
+        # Keep a reference to the list, so its id can't be reused by another list while it is cached
+        if input_texts is not self._input_texts:
+            self._input_texts_block = self.encode_input_texts(input_texts)
+            self._input_texts = input_texts
+        return self._input_texts_block
+
+
+    def _serialize_outline(self, outline: Outline) -> str:
+        if self.encoding == 'json':
+            return outline.model_dump_json(indent=2).replace('\n', '\n  ')
+        if self.encoding == 'compact':
+            return outline.model_dump_json(exclude_none=True, exclude_defaults=True)
+        return '=== OUTLINE ===\n\n' + '\n\n'.join(paragraphs_to_markdown(outline.paragraphs))
+
+
+    def _serialize_block(self, full_user_prompt: Union[FullUserPromptInputTexts, FullUserPromptOutline]) -> Tuple[str, str]:
+        '''
+        Returns the key and the encoded block of the input texts or the outline.
+        '''
+        if isinstance(full_user_prompt, FullUserPromptInputTexts):
+            return 'input_texts', self._serialize_input_texts(full_user_prompt.input_texts)
+        return 'outline', self._serialize_outline(full_user_prompt.outline)
+
+
+    def serialize_parts(self, full_user_prompt: Union[FullUserPromptInputTexts, FullUserPromptOutline]) -> List[str]:
+        '''
+        Returns the two parts of the prefix layout: the input texts or the outline, then the user prompt.
+        '''
+        key, block = self._serialize_block(full_user_prompt)
+        if self.encoding == 'markdown':
+            return [block, '=== USER PROMPT ===\n\n' + full_user_prompt.user_prompt]
+        user_prompt = str_adapter.dump_json(full_user_prompt.user_prompt).decode('utf-8')
+        if self.encoding == 'compact':
+            return ['{"' + key + '":' + block + '}', '{"user_prompt":' + user_prompt + '}']
+        return ['{\n  "' + key + '": ' + block + '\n}', '{\n  "user_prompt": ' + user_prompt + '\n}']
+
+
+    def to_model_prompt(self, full_user_prompt: Union[FullUserPromptInputTexts, FullUserPromptOutline, str]) -> Union[str, List[str]]:
+        '''
+        Returns what is passed to the agent run: the prompt string, or its parts with the prefix layout.
+        '''
+        if self.layout == 'prefix' and not isinstance(full_user_prompt, str):
+            return self.serialize_parts(full_user_prompt)
+        return self.serialize(full_user_prompt)
+
+
+    def serialize(self, full_user_prompt: Union[FullUserPromptInputTexts, FullUserPromptOutline, str]) -> str:
+        '''
+        Returns the prompt string for the LLM, or the prompt itself if it already is a string.
+        With the prefix layout, the parts are joined by a blank line, e.g. to count the tokens of the whole prompt.
+        '''
+        if isinstance(full_user_prompt, str):
+            return full_user_prompt
+        if self.layout == 'prefix':
+            return '\n\n'.join(self.serialize_parts(full_user_prompt))
+        if self.encoding == 'json' and isinstance(full_user_prompt, FullUserPromptOutline):
+            return full_user_prompt.model_dump_json(indent=2)
+        key, block = self._serialize_block(full_user_prompt)
+        if self.encoding == 'markdown':
+            return block + '\n\n=== USER PROMPT ===\n\n' + full_user_prompt.user_prompt
+        user_prompt = str_adapter.dump_json(full_user_prompt.user_prompt).decode('utf-8')
+        if self.encoding == 'compact':
+            return '{"' + key + '":' + block + ',"user_prompt":' + user_prompt + '}'
+        return '{\n  "' + key + '": ' + block + ',\n  "user_prompt": ' + user_prompt + '\n}'
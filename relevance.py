@@ -0,0 +1,137 @@
+import re
+import numpy as np
+from dataclasses import dataclass
+from scipy import sparse
+from typing import List, Optional, Tuple
+from schemas import InputText, Paragraph
+from tokenizer import TokenizerService, estimate_tokens
+from dedup import remove_counts
+
+
+_word_re = re.compile(r'\w+')
+
+
+@dataclass
+class TrimReport():
+    paragraphs: int
+    kept_paragraphs: int
+    tokens: int
+    kept_tokens: int
+
+
+    def __str__(self):
+        return f'Kept the {self.kept_paragraphs} of {self.paragraphs} paragraphs most relevant to the prompt ({self.kept_tokens} of {self.tokens} tokens)'
+
+
+class RelevanceIndex():
+    '''
+    BM25 index over the paragraphs of a set of input texts. Scores the paragraphs against a prompt and trims the
+    input texts to the most relevant paragraphs within a token budget.
+    The BM25 weight of every term in every paragraph is computed once when the index is built and kept in a sparse
+    matrix, so scoring a prompt is a single sparse matrix-vector product. Build the index once per corpus and reuse it
+    for every prompt.
+
+    Args:
+        - input_texts: The corpus.
+        - tokenizer: Counts the tokens of paragraphs without num_tokens. If None, tokens are estimated from the length.
+        - k1: BM25 term frequency saturation.
+        - b: BM25 document length normalization.
+    '''
+    def __init__(
+        self,
+        input_texts: List[InputText],
+        tokenizer: Optional[TokenizerService] = None,
+        k1: float = 1.5,
+        b: float = 0.75
+    ):
+        self.input_texts = input_texts
+        self.tokenizer = tokenizer
+        self.paragraphs: List[Tuple[int, Paragraph]] = [(i, p) for i, x in enumerate(input_texts) for p in x.body]
+        self.vocabulary = {}
+        words = []
+        counts = []
+        for _, paragraph in self.paragraphs:
+            text = f'{paragraph.subheadline} {paragraph.text}' if paragraph.subheadline else paragraph.text
+            paragraph_words = _word_re.findall(text.lower())
+            words.extend(paragraph_words)
+            counts.append(len(paragraph_words))
+        cols = [self.vocabulary.setdefault(x, len(self.vocabulary)) for x in words]
+        rows = np.repeat(np.arange(len(self.paragraphs)), counts)
+        shape = (len(self.paragraphs), len(self.vocabulary))
+        # Duplicate (row, col) pairs are summed up into term frequencies
+        tf = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape)
+        tf.sum_duplicates()
+        lengths = np.asarray(tf.sum(axis=1)).ravel()
+        avg_length = lengths.mean() if len(lengths) and lengths.mean() > 0 else 1.0
+        df = np.bincount(tf.indices, minlength=shape[1])
+        idf = np.log(1 + (shape[0] - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = k1 * (1 - b + b * lengths / avg_length)
+        row_norm = np.repeat(norm, np.diff(tf.indptr)).astype(np.float32)
+        tf.data = tf.data * (k1 + 1) / (tf.data + row_norm) * idf[tf.indices]
+        self.weights = tf.tocsc()
+        self.tokens = np.array([self._count_tokens(p) for _, p in self.paragraphs], dtype=np.int64)
+
+
+    def _count_tokens(self, paragraph: Paragraph) -> int:
+        if paragraph.num_tokens is not None:
+            return paragraph.num_tokens
+        text = f'{paragraph.subheadline}\n{paragraph.text}' if paragraph.subheadline else paragraph.text
+        if self.tokenizer is not None:
+            return self.tokenizer.count(text)
+        return estimate_tokens(text)
+
+
+    def scores(self, prompt: str) -> np.ndarray:
+        '''
+        Returns the BM25 score of every paragraph for the prompt, in corpus order.
+        '''
+        query = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for word in _word_re.findall(prompt.lower()):
+            col = self.vocabulary.get(word)
+            if col is not None:
+                query[col] += 1
+        return self.weights @ query
+
+
+    def trim(self, prompt: str, max_tokens: int) -> Tuple[List[InputText], TrimReport]:
+        '''
+        Keeps the paragraphs with the highest scores for the prompt until max_tokens is reached. Paragraphs keep their
+        order and their input text. Input texts without any kept paragraph are dropped.
+        Returns the input texts unchanged if they fit into the budget.
+        The budget only covers the subheadlines and texts of the paragraphs. Headlines, teasers, metadata and the
+        syntax of the prompt encoding come on top of it.
+        '''
+        total = int(self.tokens.sum())
+        if total <= max_tokens:
+            return self.input_texts, TrimReport(len(self.paragraphs), len(self.paragraphs), total, total)
+        # Highest scores first, the original order among equal scores
+        order = np.argsort(-self.scores(prompt), kind='stable')
+        within_budget = np.cumsum(self.tokens[order]) <= max_tokens
+        keep = np.zeros(len(self.paragraphs), dtype=bool)
+        keep[order[within_budget]] = True
+        # The cumulative sum stops at the first paragraph that doesn't fit, smaller ones after it may still fit
+        remaining = max_tokens - int(self.tokens[keep].sum())
+        for index in order[~within_budget]:
+            if remaining <= 0:
+                break
+            if self.tokens[index] <= remaining:
+                keep[index] = True
+                remaining -= int(self.tokens[index])
+        bodies = [[] for _ in self.input_texts]
+        removed_tokens = [0 for _ in self.input_texts]
+        removed_words = [0 for _ in self.input_texts]
+        for (i, paragraph), kept in zip(self.paragraphs, keep):
+            if kept:
+                bodies[i].append(paragraph)
+            else:
+                # Only counted tokens are part of the num_tokens of the input text, not the estimates
+                removed_tokens[i] += paragraph.num_tokens or 0
+                removed_words[i] += paragraph.num_words if paragraph.num_words is not None else len(paragraph.text.split())
+        output = []
+        for input_text, body, tokens, words in zip(self.input_texts, bodies, removed_tokens, removed_words):
+            if len(body) == len(input_text.body):
+                output.append(input_text)
+            elif body:
+                metadata = remove_counts(input_text.metadata, tokens, words)
+                output.append(input_text.model_copy(update={'body': body, 'metadata': metadata}))
+        return output, TrimReport(len(self.paragraphs), int(keep.sum()), total, int(self.tokens[keep].sum()))
@@ -0,0 +1,184 @@
+import hashlib, json, os, sqlite3, threading, time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pydantic import TypeAdapter
+from pydantic_ai.usage import Usage
+from typing import Any, List, Optional, Tuple, Union
+
+
+@dataclass
+class CachedRunResult():
+    '''
+    Returned by the agents instead of an AgentRunResult when a response was served from the cache.
+    Exposes the same output attribute and usage() method the callers use.
+    '''
+    output: Any
+    cached_usage: Usage = field(default_factory=Usage)
+    cached: bool = True
+
+    def usage(self) -> Usage:
+        '''
+        A cache hit costs nothing, so the usage of a cached run is always empty.
+        '''
+        return Usage()
+
+
+class ResponseCache():
+    '''
+    Content-addressed cache for agent responses with an in-memory LRU tier and a size-bounded SQLite tier.
+    Entries are keyed on the model name, the system prompt, the output schema and the serialized user prompt,
+    and expire after ttl seconds.
+
+    Args:
+        - db_path: Path to the SQLite file. If None, only the in-memory tier is used.
+        - max_memory_entries: Number of entries kept in the in-memory tier.
+        - max_disk_bytes: Maximum size of all cached responses in the SQLite tier. Least recently used entries are evicted first.
+        - ttl: Time to live of an entry in seconds. None means entries don't expire.
+    '''
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        max_memory_entries: int = 128,
+        max_disk_bytes: int = 100 * 1024 * 1024,
+        ttl: Optional[float] = 7 * 24 * 60 * 60
+    ):
+        self.db_path = db_path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_request_tokens = 0
+        self.saved_response_tokens = 0
+        self._memory: OrderedDict[str, Tuple[bytes, float, Usage]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, '
+                'created_at REAL NOT NULL, accessed_at REAL NOT NULL, '
+                'request_tokens INTEGER, response_tokens INTEGER)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+            self._db.commit()
+
+
+    @staticmethod
+    def make_key(model_name: str, system_prompt: str, output_type: Any, prompt: Union[str, List[str]]) -> str:
+        '''
+        Builds the cache key for one agent request. The prompt can also be given as parts (see PromptLayout).
+        '''
+        digest = hashlib.sha256()
+        for part in (
+            model_name,
+            hashlib.sha256(system_prompt.encode('utf-8')).hexdigest(),
+            json.dumps(TypeAdapter(output_type).json_schema(), sort_keys=True),
+            *([prompt] if isinstance(prompt, str) else prompt)
+        ):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+
+    def get(self, key: str, output_type: Any) -> Optional[CachedRunResult]:
+        '''
+        Returns the cached response for a key validated into the output type, or None on a miss.
+        '''
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and self._is_expired(entry[1]):
+                del self._memory[key]
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+            elif self._db is not None:
+                row = self._db.execute(
+                    'SELECT value, created_at, request_tokens, response_tokens FROM responses WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None and self._is_expired(row[1]):
+                    self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    self._db.commit()
+                    row = None
+                if row is not None:
+                    self._db.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+                    self._db.commit()
+                    entry = (row[0], row[1], Usage(request_tokens=row[2], response_tokens=row[3]))
+                    self._remember(key, entry)
+                    self.disk_hits += 1
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.saved_request_tokens += entry[2].request_tokens or 0
+            self.saved_response_tokens += entry[2].response_tokens or 0
+        return CachedRunResult(output=TypeAdapter(output_type).validate_json(entry[0]), cached_usage=entry[2])
+
+
+    def set(self, key: str, output: Any, output_type: Any, usage: Optional[Usage] = None):
+        '''
+        Stores a response in both tiers and evicts entries from the SQLite tier if it is over its size limit.
+        '''
+        value = TypeAdapter(output_type).dump_json(output)
+        usage = usage if usage is not None else Usage()
+        now = time.time()
+        with self._lock:
+            self._remember(key, (value, now, usage))
+            if self._db is None:
+                return
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, value, len(value), now, now, usage.request_tokens, usage.response_tokens)
+            )
+            if self.ttl is not None:
+                self._db.execute('DELETE FROM responses WHERE created_at < ?', (now - self.ttl,))
+            total_size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            if total_size > self.max_disk_bytes:
+                for old_key, size in self._db.execute('SELECT key, size FROM responses ORDER BY accessed_at').fetchall():
+                    if total_size <= self.max_disk_bytes:
+                        break
+                    self._db.execute('DELETE FROM responses WHERE key = ?', (old_key,))
+                    total_size -= size
+                    self.evictions += 1
+            self._db.commit()
+
+
+    def _remember(self, key: str, entry: Tuple[bytes, float, Usage]):
+        '''
+        Puts an entry into the in-memory LRU tier. Must be called with the lock held.
+        '''
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+
+    def stats(self) -> dict:
+        '''
+        Returns hit/miss counters and the tokens saved by cache hits.
+        '''
+        return {
+            'hits': self.hits,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'saved_request_tokens': self.saved_request_tokens,
+            'saved_response_tokens': self.saved_response_tokens
+        }
+
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,157 @@
+import asyncio, random, time
+from contextlib import contextmanager
+from contextvars import ContextVar
+import httpx
+from pydantic import ValidationError
+from pydantic_ai.exceptions import ModelHTTPError, UnexpectedModelBehavior
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional
+from metrics import metrics
+
+
+def classify_error(e: BaseException) -> Optional[str]:
+    '''
+    Sorts an exception of an agent run into the kinds of errors the RetryPolicy handles differently:
+    rate_limit, server, timeout, connection or validation. Returns None for errors that are not worth retrying.
+    '''
+    status_code = getattr(e, 'status_code', None)
+    if status_code == 429:
+        return 'rate_limit'
+    if isinstance(e, ModelHTTPError) and status_code >= 500 or status_code in (500, 502, 503, 504):
+        return 'server'
+    # The provider SDKs (openai, anthropic) name their timeout and connection errors the same way
+    if isinstance(e, (asyncio.TimeoutError, httpx.TimeoutException)) or type(e).__name__ == 'APITimeoutError':
+        return 'timeout'
+    if isinstance(e, httpx.TransportError) or type(e).__name__ == 'APIConnectionError':
+        return 'connection'
+    # The model kept returning output that didn't match the output type
+    if isinstance(e, (UnexpectedModelBehavior, ValidationError)):
+        return 'validation'
+    return None
+
+
+class RetryBudget():
+    '''
+    Caps the number of retries of one job across all the agent runs it makes, and records the retries the job needed.
+    Set it for a block of code with retry_budget().
+    '''
+    def __init__(self, max_retries: int):
+        self.max_retries = max_retries
+        self.retries = 0
+        self.retry_seconds = 0.0
+
+
+    @property
+    def exhausted(self) -> bool:
+        return self.retries >= self.max_retries
+
+
+_current_budget: ContextVar[Optional[RetryBudget]] = ContextVar('retry_budget', default=None)
+
+
+@contextmanager
+def retry_budget(max_retries: int) -> Iterator[RetryBudget]:
+    '''
+    Applies a retry budget to all RetryPolicy runs in the block, including those in tasks started from it.
+    '''
+    budget = RetryBudget(max_retries)
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+
+class RetryPolicy():
+    '''
+    Retries agent runs that failed for a transient reason, with exponential backoff and jitter.
+    Every kind of error (see classify_error) has its own number of retries. Rate limits wait longer than server
+    and connection errors, and validation errors are retried right away since the next answer of the model
+    is likely to be different anyway. Retry counts and the time spent waiting are recorded for stats().
+
+    Args:
+        - max_retries: Retries after server and connection errors.
+        - rate_limit_retries: Retries after 429 responses. Set to 0 if a RateLimitedScheduler already handles them.
+        - timeout_retries: Retries after timeouts.
+        - validation_retries: Retries when the output didn't match the output type.
+        - timeout: Time limit of a single attempt in seconds. None means no limit.
+        - backoff_base: The wait before the first retry in seconds. Doubles with every retry.
+        - rate_limit_backoff_base: The same for rate limits.
+        - backoff_max: The longest wait in seconds.
+    '''
+    def __init__(
+        self,
+        max_retries: int = 3,
+        rate_limit_retries: int = 5,
+        timeout_retries: int = 1,
+        validation_retries: int = 1,
+        timeout: Optional[float] = None,
+        backoff_base: float = 1.0,
+        rate_limit_backoff_base: float = 5.0,
+        backoff_max: float = 60.0
+    ):
+        self.retries_by_kind = {
+            'server': max_retries,
+            'connection': max_retries,
+            'rate_limit': rate_limit_retries,
+            'timeout': timeout_retries,
+            'validation': validation_retries
+        }
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.rate_limit_backoff_base = rate_limit_backoff_base
+        self.backoff_max = backoff_max
+        self.calls = 0
+        self.failures = 0
+        self.retries: Dict[str, int] = {kind: 0 for kind in self.retries_by_kind}
+        self.retry_seconds = 0.0
+
+
+    def backoff(self, kind: str, retry: int) -> float:
+        '''
+        The wait in seconds before the given retry (starting at 1) after an error of the given kind.
+        '''
+        if kind == 'validation':
+            return 0.0
+        base = self.rate_limit_backoff_base if kind == 'rate_limit' else self.backoff_base
+        # Full jitter between half and all of the exponential delay
+        return min(self.backoff_max, base * 2 ** (retry - 1)) * random.uniform(0.5, 1.0)
+
+
+    async def run(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        '''
+        Runs the call and retries it according to the policy. The call must be a function returning a new awaitable.
+        Raises the last error once the retries of its kind or the current retry budget are used up.
+        '''
+        self.calls += 1
+        budget = _current_budget.get()
+        retries = {kind: 0 for kind in self.retries_by_kind}
+        while True:
+            try:
+                if self.timeout is None:
+                    return await call()
+                return await asyncio.wait_for(call(), self.timeout)
+            except Exception as e:
+                kind = classify_error(e)
+                if kind is None or retries[kind] >= self.retries_by_kind[kind] or budget is not None and budget.exhausted:
+                    self.failures += 1
+                    raise
+                retries[kind] += 1
+                self.retries[kind] += 1
+                metrics.inc('retries', kind=kind)
+                started_at = time.monotonic()
+                await asyncio.sleep(self.backoff(kind, retries[kind]))
+                waited = time.monotonic() - started_at
+                self.retry_seconds += waited
+                if budget is not None:
+                    budget.retries += 1
+                    budget.retry_seconds += waited
+
+
+    def stats(self) -> dict:
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'retries': sum(self.retries.values()),
+            'retries_by_kind': {kind: n for kind, n in self.retries.items() if n},
+            'retry_seconds': round(self.retry_seconds, 2)
+        }
@@ -0,0 +1,186 @@
+import asyncio, random, time
+from pydantic_ai.exceptions import ModelHTTPError
+from pydantic_ai.usage import Usage
+from typing import Any, Awaitable, Callable, Iterable, List, Optional
+
+
+def is_rate_limit_error(e: BaseException) -> bool:
+    '''
+    True if an exception is a 429 response from the model provider.
+    '''
+    return isinstance(e, ModelHTTPError) and e.status_code == 429 or getattr(e, 'status_code', None) == 429
+
+
+def run_usage(result: Any) -> Optional[Usage]:
+    '''
+    Returns the usage of an agent run result, or None if the result has no usage or came from the cache.
+    '''
+    usage = getattr(result, 'usage', None)
+    if usage is None or getattr(result, 'cached', False):
+        return None
+    return usage()
+
+
+def run_tokens(result: Any) -> Optional[int]:
+    '''
+    Returns the total tokens of an agent run result, or None if the result has no usage or came from the cache.
+    '''
+    usage = run_usage(result)
+    if usage is None:
+        return None
+    if usage.total_tokens is not None:
+        return usage.total_tokens
+    return (usage.request_tokens or 0) + (usage.response_tokens or 0)
+
+
+class TokenBucket():
+    '''
+    Token bucket that refills continuously up to its capacity. The level can go negative when more was used
+    than was acquired, in which case later acquires wait until the debt has been refilled.
+    '''
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.level = capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated_at) * self.refill_per_second)
+        self._updated_at = now
+
+
+    async def acquire(self, amount: float):
+        '''
+        Waits until the amount is available and takes it from the bucket.
+        Amounts larger than the capacity wait for a full bucket.
+        '''
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                await asyncio.sleep((amount - self.level) / self.refill_per_second)
+
+
+    def adjust(self, amount: float):
+        '''
+        Takes an additional amount from the bucket (or gives it back if negative) without waiting.
+        '''
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+
+class RateLimitedScheduler():
+    '''
+    Runs agent calls concurrently while staying within the rate limits of the model provider.
+    Every call takes one request and an estimated number of tokens from two token buckets configured in requests
+    and tokens per minute. Once the call is done, both are corrected with the real usage of the AgentRunResult,
+    e.g. runs with tool calls make several model requests.
+    Calls that fail with a 429 pause the whole scheduler with exponential backoff and are retried.
+
+    Args:
+        - requests_per_minute: The request limit of the provider.
+        - tokens_per_minute: The token limit of the provider.
+        - max_concurrency: The maximum number of calls running at the same time.
+        - estimated_tokens: Tokens reserved per call before its real usage is known. Updated with a moving average of the real usage.
+        - max_rate_limit_retries: How often a call is retried after a 429 before the error is raised.
+        - backoff_base: The pause after the first 429 in seconds. Doubles with every consecutive 429.
+        - backoff_max: The longest pause in seconds.
+    '''
+    def __init__(
+        self,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        max_concurrency: int = 8,
+        estimated_tokens: int = 4000,
+        max_rate_limit_retries: int = 6,
+        backoff_base: float = 2.0,
+        backoff_max: float = 120.0
+    ):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+        self.max_concurrency = max_concurrency
+        self.estimated_tokens = estimated_tokens
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limit_errors = 0
+        self.used_tokens = 0
+        self.completed = 0
+        self._consecutive_rate_limits = 0
+        self._paused_until = 0.0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+
+    async def _wait_for_pause(self):
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+
+    def _back_off(self):
+        '''
+        Pauses all calls after a 429. The pause grows with every consecutive 429 and has some jitter,
+        so the waiting calls don't all hit the provider at the same moment again.
+        '''
+        self.rate_limit_errors += 1
+        self._consecutive_rate_limits += 1
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (self._consecutive_rate_limits - 1))
+        delay *= random.uniform(0.8, 1.2)
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+
+    async def run(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        '''
+        Runs one agent call within the rate limits and returns its result.
+        The call must be a function returning a new awaitable, so it can be retried.
+        '''
+        async with self._semaphore:
+            attempt = 0
+            while True:
+                await self._wait_for_pause()
+                await self.requests.acquire(1)
+                estimate = self.estimated_tokens
+                await self.tokens.acquire(estimate)
+                try:
+                    result = await call()
+                except Exception as e:
+                    if not is_rate_limit_error(e) or attempt >= self.max_rate_limit_retries:
+                        raise
+                    attempt += 1
+                    self._back_off()
+                    continue
+                self._consecutive_rate_limits = 0
+                self.completed += 1
+                usage = run_usage(result)
+                tokens = run_tokens(result)
+                if usage is None:
+                    # Cache hits and results without usage don't count against the limits
+                    self.requests.adjust(-1)
+                    self.tokens.adjust(-estimate)
+                else:
+                    self.requests.adjust(usage.requests - 1)
+                    self.used_tokens += tokens
+                    self.tokens.adjust(tokens - estimate)
+                    self.estimated_tokens = int(0.8 * self.estimated_tokens + 0.2 * tokens)
+                return result
+
+
+    async def map(self, calls: Iterable[Callable[[], Awaitable[Any]]]) -> List[Any]:
+        '''
+        Runs many calls concurrently and returns their results in order. Failed calls return their exception.
+        '''
+        return await asyncio.gather(*[self.run(x) for x in calls], return_exceptions=True)
+
+
+    def stats(self) -> dict:
+        return {
+            'completed': self.completed,
+            'used_tokens': self.used_tokens,
+            'rate_limit_errors': self.rate_limit_errors,
+            'estimated_tokens': self.estimated_tokens
+        }
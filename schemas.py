@@ -1,5 +1,6 @@
-from pydantic import BaseModel, model_validator
-from typing import Optional, List, Tuple, Literal, Union
+from pydantic import BaseModel, Field, model_validator
+from pydantic.json_schema import SkipJsonSchema
+from typing import Optional, Dict, List, Tuple, Literal, Union
 import datetime
 
 
@@ -28,15 +29,32 @@ class MCPServerConfig(BaseModel):
         return self
 
 
+# How full user prompts are encoded for the LLM: indented JSON, compact JSON without empty fields or a markdown-like layout
+PromptEncoding = Literal['json', 'compact', 'markdown']
+# How they are laid out in the user message: in one block, or with the input texts or outline first and the user prompt
+# in a separate part after them, so the prefix stays the same between requests and can be cached by the provider
+PromptLayout = Literal['combined', 'prefix']
+
+
+# Token counts filled in by the TokenizerService. They are only used internally, so they are never serialized,
+# don't show up in prompts or output schemas and are hidden from the repr
+InternalCount = SkipJsonSchema[Optional[int]]
+
+
 class InputTextMetadata(BaseModel):
     created_at: Optional[datetime.datetime] = None
     num_words: Optional[int] = None
     source: Optional[str] = None
+    num_tokens: InternalCount = Field(default=None, exclude=True, repr=False)
+    # The counted words of the input text. num_words is part of the input and stays as given
+    word_count: InternalCount = Field(default=None, exclude=True, repr=False)
 
 
 class Paragraph(BaseModel):
     subheadline: Optional[str] = None
     text: str
+    num_words: InternalCount = Field(default=None, exclude=True, repr=False)
+    num_tokens: InternalCount = Field(default=None, exclude=True, repr=False)
 
 
 class Outline(BaseModel):
@@ -66,24 +84,93 @@ class FullUserPromptOutline(BaseModel):
     user_prompt: str
 
 
+class WriterVariant(BaseModel):
+    name: str  # Names the variant in the result and in the output file
+    user_prompt: str
+    system_prompt: Optional[str] = None  # Added to the outline writer system prompt, e.g. the style guide of a format
+
+
+class OutputVariants(BaseModel):
+    outputs: Dict[str, OutputText]  # By variant name, in the order of the variants
+    errors: Dict[str, str] = {}  # Variants that failed
+
+
+def check_variants(variants: List[WriterVariant]):
+    if not variants:
+        raise ValueError('At least one variant is needed')
+    names = [x.name for x in variants]
+    if len(set(names)) != len(names):
+        raise ValueError('Variant names have to be unique')
+
+
 # API request schemas | Important: they will most likely be extended in the future so no duplicates of FullUserPrompt types
 
 class FromFileRequest(BaseModel):
     input_texts: List[InputText]
     user_prompt: str
+    dedup_threshold: Optional[float] = None  # Remove near-duplicate paragraphs from this similarity (0-1) on
+    max_input_tokens: Optional[int] = None  # Trim the paragraphs to the ones most relevant to the prompt within this budget
 
 
 class FromFileWithOutlineRequest(BaseModel):
     input_texts: List[InputText]
     outline_prompt: str
     content_prompt: str
+    dedup_threshold: Optional[float] = None  # Remove near-duplicate paragraphs from this similarity (0-1) on
+    max_input_tokens: Optional[int] = None  # Trim the paragraphs to the ones most relevant to the prompt within this budget
+    max_chunk_tokens: Optional[int] = None  # Outline larger input sets in chunks and merge the outlines (map-reduce)
+    parallel_sections: bool = False  # Write the sections of the outline concurrently
+    paragraphs_per_section: int = 1
 
 
 class CreateOutlineOnlyRequest(BaseModel):
     input_texts: List[InputText]
     user_prompt: str
+    dedup_threshold: Optional[float] = None  # Remove near-duplicate paragraphs from this similarity (0-1) on
+    max_input_tokens: Optional[int] = None  # Trim the paragraphs to the ones most relevant to the prompt within this budget
+    max_chunk_tokens: Optional[int] = None  # Outline larger input sets in chunks and merge the outlines (map-reduce)
+
+
+class FromOutlineRequest(BaseModel):
+    outline: Optional[Outline] = None  # The outline itself, or
+    outline_id: Optional[str] = None  # the id of a stored outline, see GET /outlines/{outline_id}
+    variants: List[WriterVariant]  # Written concurrently from the same outline
+
+    @model_validator(mode='after')
+    def check_request(self):
+        if (self.outline is None) == (self.outline_id is None):
+            raise ValueError('A request needs either outline or outline_id')
+        check_variants(self.variants)
+        return self
 
 
 class FromWebRequest(BaseModel):
     search_terms: str
-    user_prompt: str
\ No newline at end of file
+    user_prompt: str
+
+
+# Jobs of cli.py batch | One job per line of the JSONL job file
+
+class BatchJob(BaseModel):
+    id: Optional[str] = None  # Defaults to the line number of the job in the job file
+    action: Literal['from-file', 'with-outline', 'outline-only']
+    input_path: Optional[str] = None  # A file or directory, or
+    input_texts: Optional[List[InputText]] = None  # the input texts themselves
+    include: Optional[List[str]] = None  # Glob patterns of files to read from a directory
+    exclude: Optional[List[str]] = None
+    prompt: str  # The user prompt, the outline prompt for with-outline
+    content_prompt: Optional[str] = None  # The writer prompt for with-outline
+    output_path: Optional[str] = None  # Write the output to a .md or .json file instead of the result record
+    dedup_threshold: Optional[float] = None
+    max_input_tokens: Optional[int] = None
+    max_chunk_tokens: Optional[int] = None
+    parallel_sections: bool = False
+    paragraphs_per_section: int = 1
+
+    @model_validator(mode='after')
+    def check_job(self):
+        if (self.input_path is None) == (self.input_texts is None):
+            raise ValueError('A job needs either input_path or input_texts')
+        if self.action == 'with-outline' and self.content_prompt is None:
+            raise ValueError('with-outline jobs need a content_prompt')
+        return self
@@ -0,0 +1,141 @@
+import os, sys, time, tempfile, tracemalloc
+from pathlib import Path
+
+# Add content-agent/ to sys.path
+project_root = str(Path(__file__).resolve().parent.parent.parent)
+sys.path.append(project_root)
+
+from input_parser import InputParser
+from schemas import InputText, InputTextMetadata, Paragraph
+
+# Sizes of the generated markdown files in MB
+SIZES_MB = [5, 20, 50]
+DOCUMENTS_PER_MB = 20
+
+section = '''## A subheadline
+
+Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.
+Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat.
+
+```python
+# A comment, not a headline
+print('hello')
+```
+
+'''
+
+
+def baseline_parse_markdown(input_string: str) -> list[InputText]:
+    '''
+    The markdown parser before the line by line rewrite, as the baseline. It returns a single input text for the whole
+    file and doesn't know fences or setext headlines, so it does less work than the current parser.
+    '''
+    headline = None
+    paragraphs = []
+    current_subheadline = None
+    current_text = []
+    for line in input_string.splitlines():
+        if line.startswith('# '):
+            headline = line[2:].strip()
+        elif line.startswith('## '):
+            if current_text:
+                paragraphs.append(
+                    Paragraph(
+                        subheadline=current_subheadline,
+                        text='\n'.join(current_text).strip()
+                    )
+                )
+                current_text = []
+            current_subheadline = line[3:].strip()
+        elif line.strip() == '':
+            if current_text:
+                paragraphs.append(
+                    Paragraph(
+                        subheadline=current_subheadline,
+                        text='\n'.join(current_text).strip()
+                    )
+                )
+                current_text = []
+                current_subheadline = None
+        else:
+            current_text.append(line)
+    # Add any remaining text as a paragraph
+    if current_text:
+        paragraphs.append(
+            Paragraph(
+                subheadline=current_subheadline,
+                text='\n'.join(current_text).strip()
+            )
+        )
+    return [
+        InputText(
+            metadata=InputTextMetadata(),
+            headline=headline,
+            body=paragraphs
+        )
+    ]
+
+
+def write_markdown(path: str, size_mb: int):
+    '''
+    Writes a markdown file of roughly size_mb MB with several # documents.
+    '''
+    document_size = 1024 * 1024 // DOCUMENTS_PER_MB
+    sections_per_document = document_size // len(section)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(size_mb * DOCUMENTS_PER_MB):
+            f.write(f'# Document {i}\n\n')
+            f.write(section * sections_per_document)
+
+
+def measure(name: str, parse, baseline_seconds: float = None) -> float:
+    '''
+    Runs the parse function twice: once for the time and once with tracemalloc, which slows it down, for the peak memory.
+    Returns the time, the speedup is printed relative to baseline_seconds.
+    '''
+    start = time.perf_counter()
+    count = parse()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    parse()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    speedup = f'  {baseline_seconds / seconds:4.2f}x' if baseline_seconds else ''
+    print(f'  {name:<24} {seconds:6.2f}s  peak {peak / 1024 / 1024:7.1f} MB  {count} input texts{speedup}')
+    return seconds
+
+
+def main():
+    parser = InputParser()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size_mb in SIZES_MB:
+            path = os.path.join(tmp_dir, f'{size_mb}mb.md')
+            write_markdown(path, size_mb)
+            print(f'{size_mb} MB markdown:')
+
+            def baseline():
+                with open(path, 'r', encoding='utf-8') as f:
+                    return len(baseline_parse_markdown(f.read()))
+
+            def from_string():
+                # The whole file as one string, like the parser before it read line by line
+                with open(path, 'r', encoding='utf-8') as f:
+                    return len(parser._parse_markdown(f.read()))
+
+            def from_file():
+                with open(path, 'r', encoding='utf-8') as f:
+                    return len(list(parser._iter_parse_markdown(f)))
+
+            def from_file_streaming():
+                # Every input text is processed and dropped before the next one is parsed
+                with open(path, 'r', encoding='utf-8') as f:
+                    return sum(1 for _ in parser._iter_parse_markdown(f))
+
+            baseline_seconds = measure('baseline (before)', baseline)
+            measure('whole string', from_string, baseline_seconds)
+            measure('line by line', from_file, baseline_seconds)
+            measure('line by line, streamed', from_file_streaming, baseline_seconds)
+
+
+if __name__ == '__main__':
+    main()
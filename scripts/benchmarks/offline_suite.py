@@ -0,0 +1,297 @@
+'''
+Offline benchmarks of the parser, the prompt construction and the agents. The agents run against a deterministic
+stub model with a fixed latency and output size instead of a real provider, so results only depend on this code
+and can be compared between commits:
+
+    python scripts/benchmarks/offline_suite.py --save-baseline
+    # ... change something ...
+    python scripts/benchmarks/offline_suite.py
+'''
+import argparse, asyncio, json, os, sys, time, tempfile, tracemalloc
+import numpy as np
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional
+
+# Add content-agent/ to sys.path
+project_root = str(Path(__file__).resolve().parent.parent.parent)
+sys.path.append(project_root)
+
+from pydantic_ai.messages import ModelMessage, ModelResponse, ToolCallPart
+from pydantic_ai.models.function import AgentInfo, DeltaToolCall, FunctionModel
+from schemas import InputText, InputTextMetadata, Paragraph, FullUserPromptInputTexts
+from writer_agent import WriterAgent
+from outline_agent import OutlineAgent
+from input_parser import InputParser
+from prompt_serializer import UserPromptSerializer
+from system_prompts import build_from_file_system_prompt, build_outline_system_prompt
+from batch_runs import atomic_write
+from tokenizer import TokenizerService
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+USER_PROMPT = 'Write a newsletter article about the most important points of the input texts.'
+WORDS = (
+    'the city council approved a new budget for public transport schools and housing after a long debate '
+    'about taxes infrastructure climate goals digital services and the future of the local economy'
+).split()
+
+
+@dataclass
+class ScenarioResult():
+    name: str
+    iterations: int
+    seconds: float
+    throughput: float  # Iterations per second
+    p50_ms: float
+    p95_ms: float
+    peak_memory_mb: float
+    prompt_bytes: Optional[int] = None
+    prompt_tokens: Optional[int] = None  # Counted with the encoding of --token-model, or estimated if it can't be loaded
+
+
+def make_text(seed: int, num_words: int) -> str:
+    return ' '.join(WORDS[(seed * 7 + i * 3) % len(WORDS)] for i in range(num_words)).capitalize() + '.'
+
+
+def make_corpus(num_texts: int, paragraphs: int, words: int) -> List[InputText]:
+    '''
+    Builds the same corpus for the same arguments, so prompt sizes are comparable between runs.
+    '''
+    return [
+        InputText(
+            metadata=InputTextMetadata(source=f'text-{i}.json'),
+            headline=make_text(i, 8),
+            teaser=make_text(i + 1, 20),
+            body=[Paragraph(subheadline=make_text(i + j, 4) if j % 3 == 0 else None, text=make_text(i + j, words)) for j in range(paragraphs)]
+        )
+        for i in range(num_texts)
+    ]
+
+
+def write_corpus(dir_path: str, input_texts: List[InputText]):
+    '''
+    Writes every input text twice, as a JSON file and as a markdown file.
+    '''
+    for i, input_text in enumerate(input_texts):
+        with open(os.path.join(dir_path, f'text-{i}.json'), 'w', encoding='utf-8') as f:
+            f.write(input_text.model_dump_json())
+        lines = [f'# {input_text.headline}', '']
+        for paragraph in input_text.body:
+            if paragraph.subheadline:
+                lines += [f'## {paragraph.subheadline}', '']
+            lines += [paragraph.text, '']
+        with open(os.path.join(dir_path, f'text-{i}.md'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines))
+
+
+def stub_model(latency: float, paragraphs: int, words: int, chunks: int) -> FunctionModel:
+    '''
+    A model that waits latency seconds and answers every request with the same output of paragraphs * words words.
+    Streamed answers are split into chunks that are spread over the latency.
+    '''
+    output = {
+        'headline': make_text(0, 8),
+        'body': [{'subheadline': make_text(i, 4), 'text': make_text(i, words)} for i in range(paragraphs)]
+    }
+    # Outlines only have paragraphs, the headline is ignored for them
+    outline = {'paragraphs': output['body']}
+
+    def output_args(info: AgentInfo) -> str:
+        tool = info.output_tools[0]
+        return json.dumps(outline if 'paragraphs' in tool.parameters_json_schema.get('properties', {}) else output)
+
+    async def function(messages: List[ModelMessage], info: AgentInfo) -> ModelResponse:
+        await asyncio.sleep(latency)
+        return ModelResponse(parts=[ToolCallPart(info.output_tools[0].name, output_args(info))])
+
+    async def stream_function(messages: List[ModelMessage], info: AgentInfo):
+        args = output_args(info)
+        size = len(args) // chunks + 1
+        for i in range(0, len(args), size):
+            await asyncio.sleep(latency / chunks)
+            yield {0: DeltaToolCall(name=info.output_tools[0].name if i == 0 else None, json_args=args[i:i + size])}
+
+    return FunctionModel(function, stream_function=stream_function, model_name='stub')
+
+
+async def measure(
+    name: str,
+    run_once: Callable[[], Awaitable[Optional[str]]],
+    iterations: int,
+    concurrency: int = 1,
+    tokenizer: Optional[TokenizerService] = None
+) -> ScenarioResult:
+    '''
+    Runs a scenario iterations times with up to concurrency runs at once, and once more with tracemalloc, which
+    slows it down, for the peak memory. run_once returns the prompt, if it has one. Its size in bytes and tokens is
+    measured once after the runs, so counting doesn't add to the latencies.
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    prompt = None
+
+    async def timed():
+        nonlocal prompt
+        async with semaphore:
+            start = time.perf_counter()
+            prompt = await run_once()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed() for _ in range(iterations)))
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    await asyncio.gather(*(timed() for _ in range(iterations)))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Only the untraced runs count for the latencies
+    latencies = np.array(latencies[:iterations]) * 1000
+    return ScenarioResult(
+        name=name,
+        iterations=iterations,
+        seconds=round(seconds, 4),
+        throughput=round(iterations / seconds, 2),
+        p50_ms=round(float(np.percentile(latencies, 50)), 3),
+        p95_ms=round(float(np.percentile(latencies, 95)), 3),
+        peak_memory_mb=round(peak / 1024 / 1024, 2),
+        prompt_bytes=len(prompt.encode('utf-8')) if prompt is not None else None,
+        prompt_tokens=tokenizer.count(prompt) if prompt is not None and tokenizer is not None else None
+    )
+
+
+async def run_suite(args, tokenizer: TokenizerService) -> List[ScenarioResult]:
+    input_texts = make_corpus(args.input_texts, args.input_paragraphs, args.input_words)
+    model = stub_model(args.latency_ms / 1000, args.output_paragraphs, args.output_words, args.stream_chunks)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_corpus(tmp_dir, input_texts)
+
+        async def parse():
+            InputParser().parse(tmp_dir)
+
+        results.append(await measure('parse', parse, args.parse_iterations))
+
+    for encoding in ('json', 'compact', 'markdown'):
+
+        async def serialize():
+            # A new serializer per iteration, otherwise its input texts block is reused and only the first iteration
+            # measures the encoding
+            serializer = UserPromptSerializer(encoding)
+            full_user_prompt = FullUserPromptInputTexts.model_construct(user_prompt=USER_PROMPT, input_texts=input_texts)
+            return serializer.serialize(full_user_prompt)
+
+        results.append(await measure(f'prompt-{encoding}', serialize, args.prompt_iterations, tokenizer=tokenizer))
+
+    writer_agent = WriterAgent(None, 'test', build_from_file_system_prompt(args.prompt_encoding), prompt_encoding=args.prompt_encoding)
+    outline_agent = OutlineAgent(None, 'test', build_outline_system_prompt(args.prompt_encoding), prompt_encoding=args.prompt_encoding)
+
+    async def writer():
+        full_user_prompt = writer_agent._construct_user_prompt_from_input_texts(input_texts, USER_PROMPT)
+        await writer_agent.run(full_user_prompt)
+        return writer_agent.prompt_serializer.serialize(full_user_prompt)
+
+    async def writer_stream():
+        full_user_prompt = writer_agent._construct_user_prompt_from_input_texts(input_texts, USER_PROMPT)
+        async for _ in writer_agent.run_stream(full_user_prompt):
+            pass
+        return writer_agent.prompt_serializer.serialize(full_user_prompt)
+
+    async def outline():
+        full_user_prompt = outline_agent._construct_user_prompt(input_texts, USER_PROMPT)
+        await outline_agent.run(full_user_prompt)
+        return outline_agent.prompt_serializer.serialize(full_user_prompt)
+
+    with writer_agent.agent.override(model=model), outline_agent.agent.override(model=model):
+        results.append(await measure('writer-agent', writer, args.iterations, args.concurrency, tokenizer))
+        results.append(await measure('writer-agent-stream', writer_stream, args.iterations, args.concurrency, tokenizer))
+        results.append(await measure('outline-agent', outline, args.iterations, args.concurrency, tokenizer))
+    return results
+
+
+def compare(results: List[ScenarioResult], baseline: dict, tolerance: float) -> List[str]:
+    '''
+    Prints every result next to its baseline. Returns the regressions, changes of more than tolerance
+    (e.g. 0.1 = 10%) in the wrong direction.
+    '''
+    # Higher is better for the throughput, lower for everything else
+    metrics = [('throughput', 1), ('p50_ms', -1), ('p95_ms', -1), ('peak_memory_mb', -1), ('prompt_bytes', -1), ('prompt_tokens', -1)]
+    regressions = []
+    baseline_results = {x['name']: x for x in baseline['results']}
+    print(f'\n{"scenario":<22} {"metric":<16} {"baseline":>12} {"current":>12} {"change":>8}')
+    for result in results:
+        base = baseline_results.get(result.name)
+        if base is None:
+            print(f'{result.name:<22} (not in baseline)')
+            continue
+        for metric, direction in metrics:
+            old, new = base.get(metric), getattr(result, metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            flag = ''
+            if change * direction < -tolerance:
+                flag = '  REGRESSION'
+                regressions.append(f'{result.name} {metric}: {old} -> {new} ({change:+.1%})')
+            print(f'{result.name:<22} {metric:<16} {old:>12} {new:>12} {change:>+8.1%}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks against a deterministic stub model')
+    parser.add_argument('--iterations', type=int, default=50, help='Agent runs per scenario. Default is 50')
+    parser.add_argument('--parse-iterations', type=int, default=20, help='Runs of the parser scenario. Default is 20')
+    parser.add_argument('--prompt-iterations', type=int, default=500, help='Runs of the prompt serialization scenarios. Default is 500')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent agent runs. Default is 8')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Latency of the stub model per request. Default is 20')
+    parser.add_argument('--stream-chunks', type=int, default=20, help='Number of chunks of a streamed answer. Default is 20')
+    parser.add_argument('--output-paragraphs', type=int, default=6, help='Paragraphs in every answer of the stub model. Default is 6')
+    parser.add_argument('--output-words', type=int, default=80, help='Words per paragraph of the stub model. Default is 80')
+    parser.add_argument('--input-texts', type=int, default=20, help='Input texts in the corpus. Default is 20')
+    parser.add_argument('--input-paragraphs', type=int, default=10, help='Paragraphs per input text. Default is 10')
+    parser.add_argument('--input-words', type=int, default=100, help='Words per input paragraph. Default is 100')
+    parser.add_argument('--token-model', default='openai:gpt-4o-mini', help='Model whose encoding counts the prompt tokens. Default is openai:gpt-4o-mini')
+    parser.add_argument('--prompt-encoding', choices=['json', 'compact', 'markdown'], default='json', help='Prompt encoding of the agents. Default is json')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline to compare against. Default is scripts/benchmarks/baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative change from which a metric counts as a regression. Default is 0.1')
+    parser.add_argument('--output', default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    tokenizer = TokenizerService(args.token_model)
+    results = asyncio.run(run_suite(args, tokenizer))
+    print(f'{"scenario":<22} {"runs":>5} {"runs/s":>9} {"p50 ms":>9} {"p95 ms":>9} {"peak MB":>8} {"prompt bytes":>13} {"prompt tokens":>14}')
+    for result in results:
+        print(
+            f'{result.name:<22} {result.iterations:>5} {result.throughput:>9} {result.p50_ms:>9} {result.p95_ms:>9} '
+            f'{result.peak_memory_mb:>8} {result.prompt_bytes if result.prompt_bytes is not None else "-":>13} '
+            f'{result.prompt_tokens if result.prompt_tokens is not None else "-":>14}'
+        )
+    print(f'Prompt tokens counted with {tokenizer.key}')
+    # The settings are stored with the results, results of different settings can't be compared.
+    # Estimated token counts can't be compared with counted ones either, so the counter is part of the settings
+    settings = {k: v for k, v in vars(args).items() if k not in ('baseline', 'save_baseline', 'tolerance', 'output')}
+    report = {'settings': {**settings, 'token_counter': tokenizer.key}, 'results': [asdict(x) for x in results]}
+    if args.output:
+        atomic_write(args.output, json.dumps(report, indent=2))
+    if args.save_baseline:
+        atomic_write(args.baseline, json.dumps(report, indent=2))
+        print(f'\nSaved baseline to {args.baseline}')
+        return
+    if not os.path.exists(args.baseline):
+        print(f'\nNo baseline at {args.baseline}, store one with --save-baseline')
+        return
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline['settings'] != report['settings']:
+        print('\nWarning: the baseline was recorded with different settings')
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f'\n{len(regressions)} regressions:')
+        for regression in regressions:
+            print(f'  {regression}')
+        sys.exit(1)
+    print('\nNo regressions')
+
+
+if __name__ == '__main__':
+    main()
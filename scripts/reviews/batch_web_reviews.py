@@ -1,4 +1,4 @@
-import os, sys, json, time, logfire
+import os, sys, json, logfire
 from pathlib import Path
 from typing import List
 
@@ -9,6 +9,9 @@ sys.path.append(project_root)
 import asyncio
 from dotenv import load_dotenv
 from writer_agent import WriterAgent
+from scheduler import RateLimitedScheduler
+from batch_runs import RunManifest, JsonlSink, atomic_write
+from retry import RetryPolicy, retry_budget
 from schemas import MCPServerConfig, InputText, OutputText
 
 load_dotenv()
@@ -27,6 +30,18 @@ output_text_schema = json.dumps({
 SCRIPT_DIR = Path(__file__).resolve().parent
 INPUT_FILE = SCRIPT_DIR / 'product_titles.txt'  # One product title per line
 OUTPUTS_DIR = SCRIPT_DIR / 'outputs'  # Output directory for review files
+MANIFEST_FILE = OUTPUTS_DIR / 'manifest.json'  # Status of every product. Done products are skipped when the script is rerun
+OUTPUT_JSONL = None  # Set to e.g. OUTPUTS_DIR / 'reviews.jsonl' to append all reviews to one JSONL file instead of one file per review
+
+# Rate limits of the model provider. Products are processed concurrently within these limits
+REQUESTS_PER_MINUTE = 60
+TOKENS_PER_MINUTE = 200000
+MAX_CONCURRENCY = 8
+ESTIMATED_TOKENS_PER_PRODUCT = 20000  # Reserved per product until the real usage of the first runs is known
+
+# Retries of failed runs within the scheduler. Rate limits are passed on to the scheduler, which pauses all products
+RETRY_POLICY = RetryPolicy(max_retries=3, rate_limit_retries=0, validation_retries=2, timeout=300)
+RETRY_BUDGET_PER_PRODUCT = 4
 
 # Custom system prompt for review extraction
 system_prompt = f'''
@@ -56,20 +71,30 @@ MCP_CONFIGS = [
     )
 ]
 
-async def process_product(product_title, agent):
+async def process_product(product_title, agent, scheduler, manifest, sink=None):
     prompt = f'Suche online nach Reviews oder Erfahrungsberichten zu folgendem Produkt: {product_title}. Wähle genau 3 Reviews aus und stelle sicher, dass es sich um unabhängige Reviews handelt und nicht um Produktbeschreibungen von Händlern oder vom Hersteller. Formatiere die Reviews im angegebenen Format.'
+    manifest.mark_running(product_title)
     try:
-        result = await agent.run(prompt)
+        with retry_budget(RETRY_BUDGET_PER_PRODUCT) as budget:
+            result = await scheduler.run(lambda: RETRY_POLICY.run(lambda: agent.run(prompt)))
+        if budget.retries:
+            print(f'[RETRIED] {product_title}: {budget.retries} retries, {budget.retry_seconds:.1f}s waiting')
         reviews = result.output
+        usage = result.usage()
+        if sink is not None:
+            # The product is only marked as done once its reviews have been flushed to the JSONL file
+            records = [{'product': product_title, 'review': review.model_dump(mode='json')} for review in reviews]
+            sink.add(records, on_flush=lambda: manifest.mark_done(product_title, usage))
+            print(f'[OK] {product_title}: {len(reviews)} reviews added to {sink.path}')
+            return
         safe_title = product_title.replace(' ', '_').replace('/', '_')
         product_dir = OUTPUTS_DIR / safe_title
-        os.makedirs(product_dir, exist_ok=True)
         for i, review in enumerate(reviews, 1):
-            output_path = product_dir / f'review_{i}.json'
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(review.model_dump_json(indent=2))
+            atomic_write(product_dir / f'review_{i}.json', review.model_dump_json(indent=2))
+        manifest.mark_done(product_title, usage)
         print(f'[OK] {product_title}: {len(reviews)} reviews saved to {product_dir}')
     except Exception as e:
+        manifest.mark_failed(product_title, f'{type(e).__name__}: {e}')
         print(f'[ERROR] {product_title}: {e}')
 
 async def main():
@@ -79,7 +104,9 @@ async def main():
         return
     with open(INPUT_FILE, 'r', encoding='utf-8') as f:
         products = [line.strip() for line in f if line.strip()]
-    print(f'Loaded {len(products)} product titles.')
+    manifest = RunManifest(MANIFEST_FILE)
+    pending = manifest.pending(products)
+    print(f'Loaded {len(products)} product titles, {len(products) - len(pending)} already done.')
 
     # Set up the agent to output List[InputText] objects
     agent = WriterAgent(
@@ -89,11 +116,27 @@ async def main():
         output_type=List[InputText]
     )
 
-    # Process each product sequentially
-    for idx, product in enumerate(products, 1):
-        print(f'Processing {idx}/{len(products)}: {product}')
-        await process_product(product, agent)
-        time.sleep(60)
+    scheduler = RateLimitedScheduler(
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE,
+        max_concurrency=MAX_CONCURRENCY,
+        estimated_tokens=ESTIMATED_TOKENS_PER_PRODUCT
+    )
+
+    sink = JsonlSink(OUTPUT_JSONL) if OUTPUT_JSONL else None
+
+    # Process the products concurrently. The Firecrawl MCP server is started once and shared by all products
+    try:
+        await asyncio.gather(*[process_product(product, agent, scheduler, manifest, sink) for product in pending])
+    finally:
+        if sink is not None:
+            sink.close()
+        await agent.close()
+    stats = scheduler.stats()
+    manifest_stats = manifest.stats()
+    print(f'Done: {stats["completed"]}/{len(pending)} products in this run, {stats["used_tokens"]} tokens, {stats["rate_limit_errors"]} rate limit errors.')
+    print(f'Retries: {RETRY_POLICY.stats()}')
+    print(f'Manifest: {manifest_stats["done"]}/{len(products)} done, {manifest_stats["failed"]} failed, {manifest_stats["total_tokens"]} tokens in total.')
 
 if __name__ == '__main__':
     asyncio.run(main()) 
\ No newline at end of file
@@ -0,0 +1,44 @@
+from pydantic_ai.result import StreamedRunResult
+from typing import Any, AsyncIterator, List, Optional
+from schemas import OutputText, Outline, Paragraph
+
+
+def paragraphs_field(output_type: Any) -> Optional[str]:
+    '''
+    Returns the name of the field holding the paragraphs of an output type, or None if it has none.
+    '''
+    if output_type is OutputText:
+        return 'body'
+    elif output_type is Outline:
+        return 'paragraphs'
+    return None
+
+
+def get_paragraphs(output: Any) -> List[Paragraph]:
+    '''
+    Returns the paragraphs of an OutputText or an Outline.
+    '''
+    field = paragraphs_field(type(output))
+    return getattr(output, field) if field is not None else []
+
+
+async def stream_completed_paragraphs(result: StreamedRunResult, output_type: Any, debounce_by: Optional[float] = 0.1) -> AsyncIterator[Any]:
+    '''
+    Yields partial outputs of a streamed run each time a paragraph has been completed. The last paragraph of a
+    partial output may still be growing, so it is only included once the model has started the next one.
+    The last item yielded is the complete, fully validated output.
+    Output types without paragraphs only yield the complete output.
+    '''
+    field = paragraphs_field(output_type)
+    completed = 0
+    previous = None
+    # Stay one item behind so the final, fully validated output isn't also yielded as a partial one
+    async for output in result.stream(debounce_by=debounce_by):
+        if previous is not None and field is not None:
+            paragraphs = getattr(previous, field)
+            if len(paragraphs) - 1 > completed:
+                completed = len(paragraphs) - 1
+                yield previous.model_copy(update={field: paragraphs[:completed]})
+        previous = output
+    if previous is not None:
+        yield previous
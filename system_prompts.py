@@ -1,4 +1,4 @@
-from schemas import InputText, OutputText, Outline
+from schemas import InputText, OutputText, Outline, PromptEncoding, PromptLayout
 import json
 
 
@@ -7,15 +7,30 @@ output_text_schema = json.dumps(OutputText.model_json_schema(), indent=2)
 outline_schema = json.dumps(Outline.model_json_schema(), indent=2)
 
 
-from_file_system_prompt = f'''Your job is to repurpose one or more texts into a new text depending on the user's request. Here are the rules:
+def prefix_layout_note(encoding: PromptEncoding, layout: PromptLayout, block: str) -> str:
+    '''
+    Describes that the user prompt follows separately in the prefix layout. The markdown layout reads the same.
+    '''
+    if layout != 'prefix' or encoding == 'markdown':
+        return ''
+    return f'\n- The {block} and the user_prompt are sent as two separate JSON objects: first the {block}, then an object with only the user_prompt.'
 
-## 1. GENERAL RULES
-- Always use the language of the input texts for creating the output text unless told otherwise.
-- The resulting text must have the length given to you by the users instructions. If no length is specified, make it as long as necessary.
-- Pay attention to additional user instructions on style, format, etc. of the output to generate. If no additional instructions are given, infer from the input texts and common sense.
 
-## 2. FORMATS
-- You will receive input in the following format:
+def input_texts_format(encoding: PromptEncoding) -> str:
+    '''
+    Describes how the input texts and the user prompt are encoded in the user message.
+    '''
+    if encoding == 'compact':
+        return f'''- You will receive input as compact JSON in the following format. Fields that are empty are left out:
+```json
+{{"input_texts":[{json.dumps(InputText.model_json_schema(), separators=(',', ':'))}],"user_prompt":"string containing the user's specific request"}}
+```'''
+    elif encoding == 'markdown':
+        return '''- You will receive input as plain text in the following layout:
+  - Each input text starts with a line `=== INPUT TEXT n ===`, optionally followed by a line of metadata (`key: value; key: value`).
+  - Then follow the headline as `# Headline`, the teaser in italics and the paragraphs, if present. Paragraphs are separated by blank lines and can be preceded by a `## Subheadline`.
+  - The user's specific request follows after the line `=== USER PROMPT ===` at the end.'''
+    return f'''- You will receive input in the following format:
 ```json
 {{
   "user_prompt": "string containing the user's specific request",
@@ -23,11 +38,46 @@ from_file_system_prompt = f'''Your job is to repurpose one or more texts into a
     {input_text_schema}
   ]
 }}
-```
+```'''
+
+
+def outline_format(encoding: PromptEncoding) -> str:
+    '''
+    Describes how the outline and the user prompt are encoded in the user message.
+    '''
+    if encoding == 'compact':
+        return f'''- You will receive input as compact JSON in the following format. Fields that are empty are left out:
+```json
+{{"outline":{json.dumps(Outline.model_json_schema(), separators=(',', ':'))},"user_prompt":"string containing the user's specific request"}}
+```'''
+    elif encoding == 'markdown':
+        return '''- You will receive input as plain text in the following layout:
+  - The outline starts with a line `=== OUTLINE ===`, followed by its paragraphs. Paragraphs are separated by blank lines and can be preceded by a `## Subheadline`.
+  - The user's specific request follows after the line `=== USER PROMPT ===` at the end.'''
+    return f'''- You will receive input in the following format:
+```json
+{{
+  "user_prompt": "string containing the user's specific request",
+  "outline": {outline_schema}
+}}
+```'''
+
+
+def build_from_file_system_prompt(encoding: PromptEncoding = 'json', layout: PromptLayout = 'combined') -> str:
+    return f'''Your job is to repurpose one or more texts into a new text depending on the user's request. Here are the rules:
+
+## 1. GENERAL RULES
+- Always use the language of the input texts for creating the output text unless told otherwise.
+- The resulting text must have the length given to you by the users instructions. If no length is specified, make it as long as necessary.
+- Pay attention to additional user instructions on style, format, etc. of the output to generate. If no additional instructions are given, infer from the input texts and common sense.
+
+## 2. FORMATS
+{input_texts_format(encoding)}{prefix_layout_note(encoding, layout, 'input_texts')}
 '''
 
 
-from_file_with_outline_system_prompt = f'''Your job is to write a text from an outline given to you by either a human or another AI assistant. Here are the rules:
+def build_from_file_with_outline_system_prompt(encoding: PromptEncoding = 'json', layout: PromptLayout = 'combined') -> str:
+    return f'''Your job is to write a text from an outline given to you by either a human or another AI assistant. Here are the rules:
 
 ## 1. GENERAL RULES
 - Always use the language of the outline for creating the output text unless told otherwise.
@@ -36,13 +86,7 @@ from_file_with_outline_system_prompt = f'''Your job is to write a text from an o
 - Pay attention to additional user instructions on style, format, etc. of the output to generate. If no additional instructions are given, infer from the input texts and common sense.
 
 ## 2. FORMATS
-- You will receive input in the following format:
-```json
-{{
-  "user_prompt": "string containing the user's specific request",
-  "outline": {outline_schema}
-}}
-```
+{outline_format(encoding)}{prefix_layout_note(encoding, layout, 'outline')}
 '''
 
 
@@ -57,7 +101,8 @@ from_web_system_prompt = f'''Your job is to do a web search with firecrawl, visi
 '''
 
 
-outline_system_prompt = f'''Your job is to create an outline for a text based on the user's request and one or more input texts. The outline should be a list of paragraphs. Each paragraph has a subheadline and a text that is a summary of the main points of the paragraph. The goal is to make a reader able to write a new text from the outline without consulting the original input texts. Here are the rules:
+def build_outline_system_prompt(encoding: PromptEncoding = 'json', layout: PromptLayout = 'combined') -> str:
+    return f'''Your job is to create an outline for a text based on the user's request and one or more input texts. The outline should be a list of paragraphs. Each paragraph has a subheadline and a text that is a summary of the main points of the paragraph. The goal is to make a reader able to write a new text from the outline without consulting the original input texts. Here are the rules:
 
 ## 1. GENERAL RULES
 - Always use the language of the input texts for creating the outline.
@@ -67,13 +112,10 @@ outline_system_prompt = f'''Your job is to create an outline for a text based on
 - You can use bullet points to structure the content of each section.
 
 ## 2. FORMATS
-- You will receive input in the following format:
-```json
-{{
-  "user_prompt": "string containing the user's specific request",
-  "input_texts": [
-    {input_text_schema}
-  ]
-}}
-```
-'''
\ No newline at end of file
+{input_texts_format(encoding)}{prefix_layout_note(encoding, layout, 'input_texts')}
+'''
+
+
+from_file_system_prompt = build_from_file_system_prompt()
+from_file_with_outline_system_prompt = build_from_file_with_outline_system_prompt()
+outline_system_prompt = build_outline_system_prompt()
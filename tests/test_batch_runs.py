@@ -0,0 +1,86 @@
+import json
+import sys
+from pathlib import Path
+from pydantic_ai.usage import Usage
+
+# Add parent directory to Python path so we can import from the main codebase
+sys.path.append(str(Path(__file__).parent.parent))
+
+from batch_runs import JsonlSink, RunManifest, atomic_write
+
+# Offline tests of the run manifest and the JSONL sink, run with: python -m pytest tests/test_batch_runs.py
+
+
+def read_lines(path: Path):
+    return [json.loads(x) for x in path.read_text(encoding='utf-8').splitlines()]
+
+
+def test_atomic_write_replaces_the_file(tmp_path):
+    path = tmp_path / 'out' / 'review.md'
+    atomic_write(path, 'first')
+    atomic_write(path, 'second')
+    assert path.read_text(encoding='utf-8') == 'second'
+    # No temporary files are left behind
+    assert [x.name for x in path.parent.iterdir()] == ['review.md']
+
+
+def test_manifest_survives_a_restart(tmp_path):
+    path = tmp_path / 'manifest.json'
+    manifest = RunManifest(path)
+    for key in ('a', 'b', 'c'):
+        manifest.mark_running(key)
+    manifest.mark_done('a', Usage(requests=2, request_tokens=300, response_tokens=50))
+    manifest.mark_failed('b', 'TimeoutError')
+    # c was interrupted while running
+    manifest = RunManifest(path)
+    assert manifest.pending(['a', 'b', 'c', 'd']) == ['b', 'c', 'd']
+    assert manifest.items['a']['usage']['total_tokens'] == 350
+    assert manifest.stats() == {'done': 1, 'failed': 1, 'running': 1, 'total_tokens': 350}
+    manifest.mark_running('b')
+    assert manifest.items['b']['attempts'] == 2
+
+
+def test_sink_flushes_in_batches_and_runs_the_callbacks_after_the_write(tmp_path):
+    path = tmp_path / 'reviews.jsonl'
+    sink = JsonlSink(path, flush_every=3)
+    flushed = []
+    sink.add([{'id': 1}, {'id': 2}], on_flush=lambda: flushed.append(path.read_text(encoding='utf-8').count('\n')))
+    assert path.read_text(encoding='utf-8') == ''
+    assert flushed == []
+    sink.add([{'id': 3}], on_flush=lambda: flushed.append(3))
+    assert flushed == [3, 3]
+    sink.add([{'id': 4}])
+    sink.close()
+    assert read_lines(path) == [{'id': 1}, {'id': 2}, {'id': 3}, {'id': 4}]
+
+
+def test_sink_appends_to_existing_records(tmp_path):
+    path = tmp_path / 'reviews.jsonl'
+    path.write_text('{"id": 1}\n', encoding='utf-8')
+    sink = JsonlSink(path)
+    sink.add([{'id': 2}])
+    sink.close()
+    assert read_lines(path) == [{'id': 1}, {'id': 2}]
+
+
+def test_sink_truncates_a_partial_last_line(tmp_path):
+    path = tmp_path / 'reviews.jsonl'
+    path.write_text('{"id": 1}\n{"id": 2}\n{"id": 3, "te', encoding='utf-8')
+    sink = JsonlSink(path)
+    sink.add([{'id': 3}])
+    sink.close()
+    assert read_lines(path) == [{'id': 1}, {'id': 2}, {'id': 3}]
+
+
+def test_sink_truncates_a_partial_line_longer_than_the_tail(tmp_path):
+    path = tmp_path / 'reviews.jsonl'
+    path.write_text('{"id": 1}\n{"text": "' + 'x' * 100000, encoding='utf-8')
+    JsonlSink(path).close()
+    assert read_lines(path) == [{'id': 1}]
+
+
+def test_sink_truncates_a_file_with_only_a_partial_line(tmp_path):
+    path = tmp_path / 'reviews.jsonl'
+    path.write_text('{"id": 1', encoding='utf-8')
+    JsonlSink(path).close()
+    assert path.read_text(encoding='utf-8') == ''
@@ -0,0 +1,90 @@
+import random
+import sys
+from pathlib import Path
+
+# Add parent directory to Python path so we can import from the main codebase
+sys.path.append(str(Path(__file__).parent.parent))
+
+from schemas import InputText, InputTextMetadata, Paragraph
+from dedup import Deduplicator, remove_counts, word_hash
+
+# Offline tests of the near-duplicate removal, run with: python -m pytest tests/test_dedup.py
+
+
+def random_text(seed: int, num_words: int = 60) -> str:
+    rng = random.Random(seed)
+    return ' '.join(f'word{rng.randrange(100000)}' for _ in range(num_words))
+
+
+def change_one_word(text: str) -> str:
+    words = text.split()
+    words[len(words) // 2] = 'changed'
+    return ' '.join(words)
+
+
+def make_input_text(source: str, texts) -> InputText:
+    return InputText(
+        metadata=InputTextMetadata(source=source, num_words=500),
+        body=[Paragraph(text=x) for x in texts]
+    )
+
+
+def test_word_hash_is_stable_between_processes():
+    assert word_hash('newsletter') == 11067424262025288940
+
+
+def test_near_duplicates_are_removed():
+    release = random_text(1)
+    input_texts = [
+        make_input_text('a', [release, random_text(2)]),
+        make_input_text('b', [random_text(3), change_one_word(release)]),
+        make_input_text('c', [random_text(4)])
+    ]
+    output, report = Deduplicator().deduplicate(input_texts)
+    assert [[p.text for p in x.body] for x in output] == [[release, random_text(2)], [random_text(3)], [random_text(4)]]
+    assert report.paragraphs == 5
+    assert report.removed_paragraphs == 1
+    assert report.removed_words == 60
+    assert report.duplicates == [('a', 'b')]
+    # The input texts that are passed in are not changed
+    assert len(input_texts[1].body) == 2
+
+
+def test_short_and_distinct_paragraphs_are_kept():
+    input_texts = [
+        make_input_text('a', ['Read more', random_text(1)]),
+        make_input_text('b', ['Read more', random_text(2)])
+    ]
+    output, report = Deduplicator().deduplicate(input_texts)
+    assert output == input_texts
+    assert report.removed_paragraphs == 0
+
+
+def test_keep_longest_and_drop_empty_input_texts():
+    release = random_text(1)
+    longer = release + ' ' + 'end'
+    input_texts = [make_input_text('a', [release]), make_input_text('b', [longer, random_text(2)])]
+    output, report = Deduplicator(keep='longest').deduplicate(input_texts)
+    assert [x.metadata.source for x in output] == ['b']
+    assert output[0] is input_texts[1]
+    assert report.removed_input_texts == 1
+    assert report.removed_sources == ['a']
+
+
+def test_counts_of_removed_paragraphs_are_subtracted():
+    release = random_text(1)
+    input_text = make_input_text('b', [random_text(2), release])
+    input_text.metadata.num_tokens = 300
+    input_text.metadata.word_count = 120
+    for paragraph in input_text.body:
+        paragraph.num_words = 60
+        paragraph.num_tokens = 150
+    output, report = Deduplicator().deduplicate([make_input_text('a', [release]), input_text])
+    metadata = output[1].metadata
+    assert (metadata.num_tokens, metadata.word_count, metadata.num_words) == (150, 60, 500)
+    assert report.removed_tokens == 150
+
+
+def test_remove_counts_without_counts():
+    metadata = InputTextMetadata(num_words=10)
+    assert remove_counts(metadata, 5, 5) == metadata
@@ -3,7 +3,6 @@ import os
 import time
 from pathlib import Path
 from openai import OpenAI
-import tiktoken
 from dotenv import load_dotenv
 import sys
 # Add parent directory to Python path so we can import from the main codebase
@@ -11,15 +10,15 @@ sys.path.append(str(Path(__file__).parent.parent))
 
 from system_prompts import from_file_system_prompt
 from input_parser import InputParser
+import tokenizer
 
 # Load environment variables
 load_dotenv(dotenv_path=Path(__file__).parent.parent / '.env')
 
 def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
-    """Count tokens for a given text using the appropriate tokenizer."""
+    """Count tokens for a given text using the cached tokenizer of the model."""
     try:
-        enc = tiktoken.encoding_for_model(model)
-        return len(enc.encode(text))
+        return tokenizer.count_tokens(text, f"openai:{model}")
     except Exception as e:
         print(f"Error counting tokens: {e}")
         return 0
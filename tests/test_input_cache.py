@@ -0,0 +1,90 @@
+import os
+import sys
+from pathlib import Path
+
+# Add parent directory to Python path so we can import from the main codebase
+sys.path.append(str(Path(__file__).parent.parent))
+
+import tokenizer
+from input_cache import ParsedInputCache
+from input_parser import InputParser
+from tokenizer import TokenizerService
+
+# Offline tests of the parsed input cache, run with: python -m pytest tests/test_input_cache.py
+
+
+MARKDOWN = '# Headline\n\nA teaser\n\n## Sub\n\nFirst paragraph with some words\n\nSecond paragraph\n'
+
+
+def make_parser(tmp_path: Path, monkeypatch) -> InputParser:
+    # Tokens are estimated from the length, so the counts don't depend on a downloaded encoding
+    monkeypatch.setattr(tokenizer, 'load_encoding', lambda model_name: None)
+    cache = ParsedInputCache(str(tmp_path / 'cache' / 'inputs.sqlite'))
+    return InputParser(cache=cache, tokenizer=TokenizerService('test'))
+
+
+def counts(input_texts):
+    return [
+        (x.metadata.num_tokens, x.metadata.word_count, [(p.num_words, p.num_tokens) for p in x.body])
+        for x in input_texts
+    ]
+
+
+def test_unchanged_files_are_loaded_with_their_counts(tmp_path, monkeypatch):
+    path = tmp_path / 'text.md'
+    path.write_text(MARKDOWN, encoding='utf-8')
+    parser = make_parser(tmp_path, monkeypatch)
+    parsed = parser.parse(str(path))
+    cached = parser.parse(str(path))
+    assert parser.cache.stats() == {'hits': 1, 'reparsed': 1}
+    assert cached == parsed
+    assert counts(cached) == counts(parsed)
+    assert cached[0].metadata.word_count == 11
+
+
+def test_entries_survive_a_new_session(tmp_path, monkeypatch):
+    path = tmp_path / 'text.md'
+    path.write_text(MARKDOWN, encoding='utf-8')
+    parser = make_parser(tmp_path, monkeypatch)
+    parsed = parser.parse(str(path))
+    parser.cache.close()
+    parser = make_parser(tmp_path, monkeypatch)
+    assert counts(parser.parse(str(path))) == counts(parsed)
+    assert parser.cache.stats() == {'hits': 1, 'reparsed': 0}
+
+
+def test_changed_files_are_parsed_again(tmp_path, monkeypatch):
+    path = tmp_path / 'text.md'
+    path.write_text(MARKDOWN, encoding='utf-8')
+    parser = make_parser(tmp_path, monkeypatch)
+    parser.parse(str(path))
+    # Same size, newer modification time
+    path.write_text(MARKDOWN.replace('First', 'Third'), encoding='utf-8')
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert parser.parse(str(path))[0].body[1].text.startswith('Third')
+    # Different size
+    path.write_text(MARKDOWN + '\nThird paragraph\n', encoding='utf-8')
+    assert len(parser.parse(str(path))[0].body) == 4
+    assert parser.cache.stats() == {'hits': 0, 'reparsed': 3}
+
+
+def test_entries_of_another_parser_version_are_not_used(tmp_path):
+    path = tmp_path / 'text.md'
+    path.write_text(MARKDOWN, encoding='utf-8')
+    cache = ParsedInputCache(str(tmp_path / 'inputs.sqlite'))
+    stat = path.stat()
+    cache.set(str(path), stat, '1', InputParser().parse(str(path)))
+    assert cache.get(str(path), stat, '2') is None
+    assert cache.get(str(path), stat, '1') is not None
+
+
+def test_files_with_invalid_records_are_not_cached(tmp_path, monkeypatch):
+    path = tmp_path / 'texts.jsonl'
+    path.write_text('{"metadata": {}, "body": [{"text": "1"}]}\n{"metadata": {}}\n', encoding='utf-8')
+    parser = make_parser(tmp_path, monkeypatch)
+    parser.parse(str(tmp_path), include=['*.jsonl'])
+    parser.parse(str(tmp_path), include=['*.jsonl'])
+    # The invalid record is reported in every session
+    assert len(parser.errors) == 2
+    assert parser.cache.stats() == {'hits': 0, 'reparsed': 2}
@@ -0,0 +1,134 @@
+import sys
+import pytest
+from pathlib import Path
+from pydantic import ValidationError
+
+# Add parent directory to Python path so we can import from the main codebase
+sys.path.append(str(Path(__file__).parent.parent))
+
+from input_parser import InputParser
+
+# Offline tests of the input parser, run with: python -m pytest tests/test_input_parser.py
+
+
+def write_tree(root: Path, files: dict):
+    for name, content in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content, encoding='utf-8')
+
+
+def headlines(input_texts):
+    return [x.headline for x in input_texts]
+
+
+def test_directories_are_parsed_recursively_in_a_stable_order(tmp_path):
+    write_tree(tmp_path, {
+        'b.md': '# b\n\nText',
+        'a/2.md': '# a/2\n\nText',
+        'a/1.md': '# a/1\n\nText\n\n# a/1 second\n\nText',
+        'a/deep/x.json': '{"metadata": {}, "headline": "a/deep/x", "body": [{"text": "Text"}]}',
+        'c.csv': 'not,supported'
+    })
+    # The files of a directory come before its subdirectories
+    assert headlines(InputParser().parse(str(tmp_path))) == ['b', 'a/1', 'a/1 second', 'a/2', 'a/deep/x']
+
+
+def test_order_does_not_depend_on_the_number_of_workers(tmp_path):
+    write_tree(tmp_path, {f'{i:02d}.md': f'# {i}\n\nText' for i in range(30)})
+    parser = InputParser()
+    expected = [str(i) for i in range(30)]
+    assert headlines(parser.iter_parse(str(tmp_path), max_workers=1)) == expected
+    assert headlines(parser.iter_parse(str(tmp_path), max_workers=4)) == expected
+
+
+def test_include_and_exclude_patterns(tmp_path):
+    write_tree(tmp_path, {
+        'notes.md': '# notes\n\nText',
+        'draft.md': '# draft\n\nText',
+        '2024/jan.md': '# 2024/jan\n\nText',
+        '2024/jan.txt': 'Plain text',
+        'archive/old.md': '# archive/old\n\nText'
+    })
+    parser = InputParser()
+    # Patterns without a '/' match the file name in every directory
+    assert headlines(parser.parse(str(tmp_path), include=['*.md'], exclude=['draft*'])) == ['notes', '2024/jan', 'archive/old']
+    # Others match the relative path, and excluded directories are skipped entirely
+    assert headlines(parser.parse(str(tmp_path), include=['2024/*'])) == ['2024/jan', None]
+    assert headlines(parser.parse(str(tmp_path), exclude=['archive', '*.txt'])) == ['draft', 'notes', '2024/jan']
+
+
+def test_a_single_file_is_parsed_directly(tmp_path):
+    write_tree(tmp_path, {'text.txt': 'Plain text'})
+    input_texts = InputParser().parse(str(tmp_path / 'text.txt'))
+    assert [p.text for p in input_texts[0].body] == ['Plain text']
+
+
+def test_json_is_validated_from_bytes_and_strings():
+    parser = InputParser()
+    record = '{"metadata": {"source": "a"}, "body": [{"text": "Text"}]}'
+    assert parser._parse_json(record.encode()) == parser._parse_json(record)
+    input_texts = parser._parse_json(f'  [{record}, {record}]'.encode())
+    assert [x.metadata.source for x in input_texts] == ['a', 'a']
+
+
+def test_invalid_json_records_are_skipped_and_reported():
+    parser = InputParser()
+    data = b'[{"metadata": {}, "body": [{"text": "1"}]}, {"metadata": {}}, {"metadata": {}, "body": [{"text": "3"}]}]'
+    input_texts = parser._parse_json(data, 'texts.json')
+    assert [x.body[0].text for x in input_texts] == ['1', '3']
+    assert [(x.source, x.record) for x in parser.errors] == [('texts.json', 1)]
+    assert 'body' in parser.errors[0].message
+
+
+def test_invalid_json_raises():
+    with pytest.raises(ValueError, match='Invalid JSON'):
+        InputParser()._parse_json(b'[{"metadata": ')
+    with pytest.raises(ValidationError):
+        InputParser()._parse_json(b'{"metadata": {}}')
+
+
+def test_strict_parser_raises_on_invalid_records():
+    with pytest.raises(ValidationError):
+        InputParser(strict=True)._parse_json(b'[{"metadata": {}, "body": []}, {"metadata": {}}]')
+
+
+def test_jsonl_is_parsed_line_by_line(tmp_path):
+    path = tmp_path / 'texts.jsonl'
+    path.write_bytes(
+        b'{"metadata": {}, "body": [{"text": "1"}]}\n'
+        b'\n'
+        b'{"metadata": {}, "body": "not a list"}\n'
+        b'{"metadata": {}, "body": [{"text": "4"}]}'
+    )
+    parser = InputParser()
+    input_texts = parser.parse(str(path))
+    assert [x.body[0].text for x in input_texts] == ['1', '4']
+    # Line numbers start at 1 and count empty lines
+    assert [(x.source, x.record) for x in parser.errors] == [(str(path), 3)]
+
+
+def structure(input_texts):
+    return [(x.headline, [(p.subheadline, p.text) for p in x.body]) for x in input_texts]
+
+
+def test_markdown_headlines_start_new_input_texts():
+    markdown = 'Intro text\n\n# First\n\nOne\ntwo\n\n## Sub\nThree\n\nSecond\n=====\n\nFour\n\nA setext sub\n---\nFive\n'
+    assert structure(InputParser()._parse_markdown(markdown)) == [
+        (None, [(None, 'Intro text')]),
+        ('First', [(None, 'One\ntwo'), ('Sub', 'Three')]),
+        ('Second', [(None, 'Four'), ('A setext sub', 'Five')])
+    ]
+
+
+def test_markdown_fences_and_thematic_breaks():
+    markdown = '# Code\n\nBefore\n```python\n# not a headline\n\nx = 1\n```\nAfter\n\n* * *\nLast\n'
+    assert structure(InputParser()._parse_markdown(markdown)) == [
+        ('Code', [(None, 'Before'), (None, '```python\n# not a headline\n\nx = 1\n```'), (None, 'After'), (None, 'Last')])
+    ]
+
+
+def test_markdown_is_parsed_from_a_file_with_windows_line_endings(tmp_path):
+    path = tmp_path / 'text.md'
+    path.write_bytes(b'# Title\r\n\r\nFirst\r\n\r\nSecond\r\n')
+    assert structure(InputParser().parse(str(path))) == [('Title', [(None, 'First'), (None, 'Second')])]
@@ -0,0 +1,83 @@
+import asyncio
+import sys
+from pathlib import Path
+
+# Add parent directory to Python path so we can import from the main codebase
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / 'scripts' / 'benchmarks'))
+
+from schemas import InputText, InputTextMetadata, Paragraph
+from outline_agent import OutlineAgent
+from pipeline import MapReducePipeline
+from system_prompts import build_outline_system_prompt
+from offline_suite import make_text, stub_model
+
+# Offline tests of the map-reduce chunking, run with: python -m pytest tests/test_pipeline.py
+
+
+def make_input_texts(count: int, paragraphs: int, words: int):
+    return [
+        InputText(
+            metadata=InputTextMetadata(source=f'text {i}'),
+            headline=f'Headline {i}',
+            teaser='A teaser',
+            body=[Paragraph(text=make_text(i * paragraphs + j, words)) for j in range(paragraphs)]
+        )
+        for i in range(count)
+    ]
+
+
+def make_pipeline(max_chunk_tokens: int) -> MapReducePipeline:
+    outline_agent = OutlineAgent(None, 'test', build_outline_system_prompt('json'))
+    return MapReducePipeline(outline_agent, max_chunk_tokens=max_chunk_tokens)
+
+
+def texts(chunks):
+    return [p.text for chunk in chunks for x in chunk for p in x.body]
+
+
+def test_chunk_within_budget_keeps_order():
+    input_texts = make_input_texts(10, 3, 40)
+    pipeline = make_pipeline(max_chunk_tokens=800)
+    chunks = pipeline.chunk(input_texts)
+    assert len(chunks) > 1
+    assert texts(chunks) == [p.text for x in input_texts for p in x.body]
+    for chunk in chunks:
+        assert len(chunk) == 1 or sum(pipeline.count_tokens(x) for x in chunk) <= pipeline.max_chunk_tokens
+
+
+def test_small_input_is_one_chunk():
+    input_texts = make_input_texts(2, 2, 10)
+    assert make_pipeline(max_chunk_tokens=50000).chunk(input_texts) == [input_texts]
+
+
+def test_large_input_text_is_split_along_paragraphs():
+    input_text = make_input_texts(1, 12, 60)[0]
+    pipeline = make_pipeline(max_chunk_tokens=300)
+    parts = pipeline._split(input_text)
+    assert len(parts) > 1
+    assert [p.text for x in parts for p in x.body] == [p.text for p in input_text.body]
+    # The teaser belongs to the start of the text, every part keeps headline and metadata
+    assert parts[0].teaser == input_text.teaser
+    assert all(x.teaser is None for x in parts[1:])
+    assert all(x.headline == input_text.headline and x.metadata == input_text.metadata for x in parts)
+
+
+def test_create_outline_maps_and_reduces():
+    input_texts = make_input_texts(6, 3, 40)
+    pipeline = make_pipeline(max_chunk_tokens=800)
+    chunks = pipeline.chunk(input_texts)
+    model = stub_model(0, 2, 5, 1)
+    requests = []
+    function = model.function
+
+    async def counting_function(messages, info):
+        requests.append(messages)
+        return await function(messages, info)
+
+    model.function = counting_function
+    with pipeline.outline_agent.agent.override(model=model):
+        outline = asyncio.run(pipeline.create_outline(input_texts, 'Outline it'))
+    assert len(outline.paragraphs) == 2
+    # One run per chunk and at least one run that merges the partial outlines
+    assert len(requests) > len(chunks)
@@ -0,0 +1,86 @@
+import sys
+from pathlib import Path
+
+# Add parent directory to Python path so we can import from the main codebase
+sys.path.append(str(Path(__file__).parent.parent))
+
+from schemas import InputText, InputTextMetadata, Paragraph
+from relevance import RelevanceIndex
+from tokenizer import estimate_tokens
+
+# Offline tests of the BM25 trimming, run with: python -m pytest tests/test_relevance.py
+
+
+def make_input_text(source: str, texts) -> InputText:
+    return InputText(
+        metadata=InputTextMetadata(source=source),
+        headline=f'Headline of {source}',
+        body=[Paragraph(text=x) for x in texts]
+    )
+
+
+def make_corpus():
+    return [
+        make_input_text('a', ['The central bank raised interest rates again', 'A recipe for apple pie']),
+        make_input_text('b', ['Football results of the weekend', 'The weather stays sunny']),
+        make_input_text('c', ['Interest rates and inflation in the euro area', 'Rates of mortgages follow the interest rates'])
+    ]
+
+
+def kept_texts(input_texts):
+    return [p.text for x in input_texts for p in x.body]
+
+
+def test_scores_rank_matching_paragraphs_first():
+    index = RelevanceIndex(make_corpus())
+    scores = index.scores('interest rates')
+    assert [i for i, x in enumerate(scores) if x > 0] == [0, 4, 5]
+    assert scores[5] > scores[0]
+
+
+def test_input_texts_within_budget_are_unchanged():
+    input_texts = make_corpus()
+    output, report = RelevanceIndex(input_texts).trim('interest rates', max_tokens=10000)
+    assert output is input_texts
+    assert report.kept_paragraphs == report.paragraphs == 6
+
+
+def test_trim_keeps_the_best_paragraphs_in_order_within_the_budget():
+    input_texts = make_corpus()
+    index = RelevanceIndex(input_texts)
+    # Tokens are estimated from the length without a tokenizer or counts
+    assert index.tokens.tolist() == [estimate_tokens(p.text) for x in input_texts for p in x.body]
+    budget = int(index.tokens[[0, 4, 5]].sum())
+    output, report = index.trim('interest rates', max_tokens=budget)
+    assert kept_texts(output) == [
+        'The central bank raised interest rates again',
+        'Interest rates and inflation in the euro area',
+        'Rates of mortgages follow the interest rates'
+    ]
+    # The input text without relevant paragraphs is dropped, the others keep their headline
+    assert [x.metadata.source for x in output] == ['a', 'c']
+    assert output[0].headline == 'Headline of a'
+    assert (report.kept_paragraphs, report.kept_tokens) == (3, budget)
+
+
+def test_smaller_paragraphs_fill_the_rest_of_the_budget():
+    input_texts = [make_input_text('a', ['interest ' + 'long ' * 40, 'interest rates ' + 'long ' * 60, 'Short note'])]
+    index = RelevanceIndex(input_texts)
+    output, report = index.trim('interest rates', max_tokens=int(index.tokens[1] + index.tokens[2]))
+    # The first paragraph has a higher score than the note but doesn't fit anymore
+    assert kept_texts(output) == ['interest rates ' + 'long ' * 60, 'Short note']
+    assert report.kept_tokens <= index.tokens[1] + index.tokens[2]
+
+
+def test_counts_are_used_and_subtracted():
+    input_texts = make_corpus()
+    for input_text in input_texts:
+        for paragraph in input_text.body:
+            paragraph.num_tokens = 100
+            paragraph.num_words = 7
+        input_text.metadata.num_tokens = 200
+        input_text.metadata.word_count = 14
+    output, report = RelevanceIndex(input_texts).trim('apple pie', max_tokens=100)
+    assert kept_texts(output) == ['A recipe for apple pie']
+    assert (output[0].metadata.num_tokens, output[0].metadata.word_count) == (100, 7)
+    assert report.tokens == 600
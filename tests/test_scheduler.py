@@ -0,0 +1,122 @@
+import asyncio
+import sys
+from pathlib import Path
+from pydantic_ai.usage import Usage
+
+# Add parent directory to Python path so we can import from the main codebase
+sys.path.append(str(Path(__file__).parent.parent))
+
+import scheduler
+from scheduler import RateLimitedScheduler, TokenBucket
+
+# Offline tests of the token buckets and the rate-limited scheduler, run with: python -m pytest tests/test_scheduler.py
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakeResult():
+    def __init__(self, usage: Usage, cached: bool = False):
+        self._usage = usage
+        self.cached = cached
+
+
+    def usage(self) -> Usage:
+        return self._usage
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+def test_adjust_takes_and_gives_back_without_exceeding_capacity(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler.time, 'monotonic', clock)
+    bucket = TokenBucket(capacity=100, refill_per_second=10)
+    bucket.adjust(30)
+    assert bucket.level == 70
+    bucket.adjust(-50)
+    assert bucket.level == 100
+
+
+def test_adjust_can_go_into_debt_that_is_refilled(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler.time, 'monotonic', clock)
+    bucket = TokenBucket(capacity=100, refill_per_second=10)
+    bucket.adjust(150)
+    assert bucket.level == -50
+    clock.now += 6
+    bucket.adjust(0)
+    assert bucket.level == 10
+
+
+def test_acquire_takes_from_the_bucket(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler.time, 'monotonic', clock)
+    bucket = TokenBucket(capacity=100, refill_per_second=10)
+    asyncio.run(bucket.acquire(40))
+    assert bucket.level == 60
+    # Amounts larger than the capacity only wait for a full bucket
+    clock.now += 10
+    asyncio.run(bucket.acquire(500))
+    assert bucket.level == 0
+
+
+def test_run_corrects_the_buckets_with_the_real_usage(monkeypatch):
+    monkeypatch.setattr(scheduler.time, 'monotonic', FakeClock())
+    rate_limited = RateLimitedScheduler(requests_per_minute=60, tokens_per_minute=10000, estimated_tokens=1000)
+
+    async def call():
+        return FakeResult(Usage(requests=3, request_tokens=400, response_tokens=100, total_tokens=500))
+
+    asyncio.run(rate_limited.run(call))
+    # A run with tool calls makes several model requests
+    assert rate_limited.requests.level == 57
+    assert rate_limited.tokens.level == 9500
+    assert rate_limited.used_tokens == 500
+    assert rate_limited.estimated_tokens == 900
+
+
+def test_run_gives_back_the_reservation_of_cache_hits(monkeypatch):
+    monkeypatch.setattr(scheduler.time, 'monotonic', FakeClock())
+    rate_limited = RateLimitedScheduler(requests_per_minute=60, tokens_per_minute=10000, estimated_tokens=1000)
+
+    async def call():
+        return FakeResult(Usage(requests=1, total_tokens=500), cached=True)
+
+    asyncio.run(rate_limited.run(call))
+    assert rate_limited.requests.level == 60
+    assert rate_limited.tokens.level == 10000
+    assert rate_limited.used_tokens == 0
+
+
+def test_run_retries_rate_limit_errors():
+    rate_limited = RateLimitedScheduler(requests_per_minute=600, tokens_per_minute=100000, backoff_base=0.001, max_rate_limit_retries=2)
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RateLimitError()
+        return FakeResult(Usage(requests=1, total_tokens=10))
+
+    asyncio.run(rate_limited.run(call))
+    assert len(attempts) == 3
+    assert rate_limited.rate_limit_errors == 2
+
+
+def test_run_raises_after_the_last_retry():
+    rate_limited = RateLimitedScheduler(requests_per_minute=600, tokens_per_minute=100000, backoff_base=0.001, max_rate_limit_retries=1)
+
+    async def call():
+        raise RateLimitError()
+
+    results = asyncio.run(rate_limited.map([call]))
+    assert isinstance(results[0], RateLimitError)
+    assert rate_limited.rate_limit_errors == 1
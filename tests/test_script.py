@@ -3,7 +3,6 @@ import sys
 import time
 from pathlib import Path
 from pydantic_ai import Agent
-import tiktoken
 
 # Add parent directory to Python path so we can import from the main codebase
 sys.path.append(str(Path(__file__).parent.parent))
@@ -11,23 +10,16 @@ sys.path.append(str(Path(__file__).parent.parent))
 from schemas import InputText, OutputText
 from system_prompts import from_file_system_prompt
 from input_parser import InputParser
+import tokenizer
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv(dotenv_path=Path(__file__).parent.parent / '.env')
 
 def count_tokens(text: str, model: str) -> int:
-    """Count tokens for a given text using the appropriate tokenizer."""
+    """Count tokens for a given text using the cached tokenizer of the model."""
     try:
-        if model.startswith('openai:'):
-            model_name = model.split(':')[1]
-            enc = tiktoken.encoding_for_model(model_name)
-        elif model.startswith('anthropic:'):
-            # Anthropic uses a different tokenizer, but we can use GPT-4 as an approximation
-            enc = tiktoken.encoding_for_model('gpt-4')
-        else:
-            raise ValueError(f"Unsupported model: {model}")
-        return len(enc.encode(text))
+        return tokenizer.count_tokens(text, model)
     except Exception as e:
         print(f"Error counting tokens: {e}")
         return 0
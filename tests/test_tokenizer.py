@@ -0,0 +1,57 @@
+import sys
+from pathlib import Path
+
+# Add parent directory to Python path so we can import from the main codebase
+sys.path.append(str(Path(__file__).parent.parent))
+
+import tokenizer
+from schemas import InputText, InputTextMetadata, Paragraph
+from tokenizer import TokenizerService, estimate_tokens
+
+# Offline tests of the token and word counts, run with: python -m pytest tests/test_tokenizer.py
+
+
+def make_input_text() -> InputText:
+    return InputText(
+        metadata=InputTextMetadata(num_words=1000),
+        headline='A headline',
+        teaser='The teaser of the text',
+        body=[
+            Paragraph(subheadline='Sub', text='One two three four'),
+            Paragraph(text='Five six')
+        ]
+    )
+
+
+def test_estimate_rounds_up():
+    assert [estimate_tokens(x) for x in ('', 'a', 'abcd', 'abcde')] == [0, 1, 1, 2]
+
+
+def test_fill_counts_without_an_encoding(monkeypatch):
+    monkeypatch.setattr(tokenizer, 'load_encoding', lambda model_name: None)
+    service = TokenizerService('test')
+    input_text = make_input_text()
+    service.fill_counts([input_text])
+    assert service.key == 'estimate-4'
+    assert [(p.num_words, p.num_tokens) for p in input_text.body] == [(5, 1 + 5), (2, 2)]
+    # Headline and teaser are counted as one text
+    assert input_text.metadata.num_tokens == estimate_tokens('A headline\nThe teaser of the text') + 6 + 2
+    assert input_text.metadata.word_count == 2 + 5 + 5 + 2
+    # The num_words of the input is left as given
+    assert input_text.metadata.num_words == 1000
+
+
+def test_counts_are_not_serialized(monkeypatch):
+    monkeypatch.setattr(tokenizer, 'load_encoding', lambda model_name: None)
+    input_text = make_input_text()
+    before = input_text.model_dump_json()
+    TokenizerService('test').fill_counts([input_text])
+    assert input_text.model_dump_json() == before
+    assert 'word_count' not in repr(input_text.metadata)
+
+
+def test_count_batch_matches_count(monkeypatch):
+    monkeypatch.setattr(tokenizer, 'load_encoding', lambda model_name: None)
+    service = TokenizerService('test', num_threads=1)
+    texts = [f'text number {i} ' * i for i in range(10)]
+    assert service.count_batch(texts) == [service.count(x) for x in texts]
@@ -0,0 +1,125 @@
+import warnings
+from functools import lru_cache
+from typing import List
+from schemas import InputText
+
+
+# Characters per token of the estimate that is used if the encoding can't be loaded
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str):
+    '''
+    Returns the tiktoken encoding for a model name like 'openai:gpt-4o-mini'. Encodings are resolved once per model.
+    Other providers use different tokenizers, so the GPT-4 encoding is used as an approximation for them.
+    '''
+    import tiktoken
+    if model_name.startswith('openai:'):
+        try:
+            return tiktoken.encoding_for_model(model_name.split(':', 1)[1])
+        except KeyError:
+            return tiktoken.get_encoding('o200k_base')
+    return tiktoken.encoding_for_model('gpt-4')
+
+
+@lru_cache(maxsize=None)
+def load_encoding(model_name: str):
+    '''
+    Returns the encoding like get_encoding(), or None if it can't be loaded. tiktoken downloads the BPE file of an
+    encoding the first time it is used, so this fails offline until the file is in its cache.
+    '''
+    try:
+        return get_encoding(model_name)
+    except Exception as e:
+        warnings.warn(f'Could not load the tokenizer for {model_name}, token counts are estimated from the length: {e}')
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    '''
+    Counts the tokens of a text for the given model, or estimates them if the encoding can't be loaded.
+    '''
+    encoding = load_encoding(model_name)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode_ordinary(text))
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+class TokenizerService():
+    '''
+    Counts tokens for one model with the cached encoding and encodes batches of texts on a thread pool
+    (tiktoken releases the GIL while encoding). The encoding is loaded on first use. If it can't be loaded,
+    tokens are estimated from the length of the texts instead.
+
+    Args:
+        - model_name: The model the tokens are counted for, e.g. 'openai:gpt-4o-mini'.
+        - num_threads: The number of threads used for batches.
+    '''
+    def __init__(self, model_name: str, num_threads: int = 4):
+        self.model_name = model_name
+        self.num_threads = num_threads
+
+
+    @property
+    def encoding(self):
+        return load_encoding(self.model_name)
+
+
+    @property
+    def key(self) -> str:
+        '''
+        Identifies the counts, so counts of different encodings are not mixed up, e.g. in the input cache.
+        '''
+        encoding = self.encoding
+        return encoding.name if encoding is not None else f'estimate-{CHARS_PER_TOKEN}'
+
+
+    def count(self, text: str) -> int:
+        encoding = self.encoding
+        if encoding is None:
+            return estimate_tokens(text)
+        return len(encoding.encode_ordinary(text))
+
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        '''
+        Counts the tokens of many texts at once.
+        '''
+        encoding = self.encoding
+        if encoding is None or len(texts) < 2 * self.num_threads:
+            return [self.count(x) for x in texts]
+        return [len(x) for x in encoding.encode_ordinary_batch(texts, num_threads=self.num_threads)]
+
+
+    def fill_counts(self, input_texts: List[InputText]):
+        '''
+        Fills num_words and num_tokens of every paragraph and word_count and num_tokens of the metadata of every input
+        text in place. The counts of an input text are those of its headline, teaser, subheadlines and paragraph texts.
+        The num_words of the metadata is part of the input, so it is left as given.
+        '''
+        texts = []
+        for input_text in input_texts:
+            texts.append('\n'.join(x for x in (input_text.headline, input_text.teaser) if x))
+            for paragraph in input_text.body:
+                texts.append(paragraph.subheadline or '')
+                texts.append(paragraph.text)
+        counts = iter(self.count_batch(texts))
+        for input_text in input_texts:
+            num_tokens = next(counts)
+            num_words = sum(count_words(x) for x in (input_text.headline, input_text.teaser) if x)
+            for paragraph in input_text.body:
+                paragraph.num_tokens = next(counts) + next(counts)
+                paragraph.num_words = count_words(paragraph.text) + (count_words(paragraph.subheadline) if paragraph.subheadline else 0)
+                num_tokens += paragraph.num_tokens
+                num_words += paragraph.num_words
+            input_text.metadata.num_tokens = num_tokens
+            input_text.metadata.word_count = num_words